@@ -53,6 +53,11 @@ echo "Running test-amend.sh..."
 bash test-amend.sh
 printf "\n"
 
+# Test adding samples to a database
+echo "Running test-add-samples.sh..."
+bash test-add-samples.sh
+printf "\n"
+
 # Test query tool
 echo "Running test-query.sh..."
 bash test-query.sh
@@ -140,6 +145,11 @@ echo "Running test-unique.sh..."
 bash test-unique.sh
 printf "\n"
 
+# Test the per patient variant statistics
+echo "Running test-patient-stats.sh..."
+bash test-patient-stats.sh
+printf "\n"
+
 # Test somatic tools
 echo "Running test-somatic-tools.sh..."
 bash test-somatic-tools.sh
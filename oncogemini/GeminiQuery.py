@@ -3,12 +3,7 @@ from __future__ import absolute_import, print_function
 
 import os
 import sys
-import re
-try:
-    from compiler import compile
-except ImportError:
-    unicode = str
-    pass
+import sqlite3
 
 PY3 = sys.version_info[0] ==  3
 
@@ -23,12 +18,14 @@ flatten = chain.from_iterable
 import sqlalchemy as sql
 from . import gemini_utils as util
 from . import database
-from .gemini_constants import HOM_REF, HET, HOM_ALT, UNKNOWN
+from .gemini_constants import HOM_REF, HET, HOM_ALT, UNKNOWN, BUFFER_SIZE
 
 from .gemini_utils import (OrderedSet, itersubclasses)
 from .gemini_subjects import Subject
 from .pdict import PDict
 from . import compression
+from . import gt_filter as gtf
+from . import index_advisor
 from .sql_utils import ensure_columns, get_select_cols_and_rest
 from .gemini_subjects import get_subjects
 
@@ -168,100 +165,44 @@ class CarrierSummary(RowFormat):
 
 class TPEDRowFormat(RowFormat):
 
-    X_PAR_REGIONS = [(60001, 2699520), (154931044, 155260560)]
-    Y_PAR_REGIONS = [(10001, 2649520), (59034050, 59363566)]
-
     name = "tped"
-    NULL_GENOTYPES = ["."]
-    PED_MISSING = ["0", "0"]
-    VALID_CHROMOSOMES = list(map(str, range(1, 23))) + ["X", "Y", "XY", "MT"]
-    POSSIBLE_HAPLOID = ["X", "Y"]
 
     def __init__(self, args):
+        from .plink import Genotypes
         gq = GeminiQuery(args.db)
         subjects = get_subjects(args, skip_filter=True)
         # get samples in order of genotypes
         self.samples = [gq.idx_to_sample_object[x] for x in range(len(subjects))]
+        self.genotypes = Genotypes([s.sex for s in self.samples])
+
+    def code(self, row):
+        """ the TPED chrom, the alleles and the code of each sample's call, see plink """
+        from .plink import tped_chrom
+        chrom = tped_chrom(row['chrom'])
+        alleles, codes = self.genotypes.code(chrom, row['start'], row['ref'], row['alt'],
+                                             row['gt_types'], row['gts'])
+        return chrom, alleles, codes
 
     def format(self, row):
-        VALID_CHROMOSOMES = list(map(str, range(1, 23))) + ["X", "Y", "XY", "MT"]
-        chrom = row['chrom'].split("chr")[1]
-        chrom = chrom if chrom in VALID_CHROMOSOMES else "0"
-        start = str(row.row['start'])
-        end = str(row.row['end'])
-        ref = row['ref']
-        alt = row['alt']
-        geno = [re.split('\||/', util.to_str(x)) for x in row['gts']]
-        geno = [self._fix_genotype(chrom, start, genotype, self.samples[i].sex)
-                for i, genotype in enumerate(geno)]
-        genotypes = " ".join(list(flatten(geno)))
-        name = str(row['variant_id'])
-        return " ".join([chrom, name, "0", start, genotypes])
+        from .plink import tped_genotypes
+        chrom, alleles, codes = self.code(row)
+        return " ".join([chrom, str(row['variant_id']), "0", str(row['start']),
+                         tped_genotypes(alleles, codes)])
+
+    def bim(self, row, chrom, alleles):
+        """ the .bim line of `row` (PLINK's allele 1 is the alt) """
+        return "\t".join([chrom, str(row['variant_id']), "0", str(row['start']),
+                          alleles[1], alleles[0]])
 
     def format_query(self, query):
         NEED_COLUMNS = ["chrom", "rs_ids", "start", "ref", "alt", "gts", "type", "variant_id"]
         return ensure_columns(query, NEED_COLUMNS)
 
-
-    def predicate(self, row, _splitter=re.compile("\||/")):
-        if PY3:
-            geno = [_splitter.split(util.to_str(x)) for x in row['gts']]
-        else:
-            geno = [_splitter.split(x) for x in row['gts']]
-        geno = list(flatten(geno))
-        num_alleles = len(set(geno).difference(self.NULL_GENOTYPES))
-        return num_alleles > 0 and num_alleles <= 2 and row['type'] != "sv"
-
-    def _is_haploid(self, genotype):
-        return len(genotype) < 2
-
-    def _has_missing(self, genotype):
-        return any([allele in self.NULL_GENOTYPES for allele in genotype])
-
-    def _is_heterozygote(self, genotype):
-        return len(genotype) == 2 and (genotype[0] != genotype[1])
-
-    def _in_PAR(self, chrom, start):
-        if chrom == "X":
-            for region in self.X_PAR_REGIONS:
-                if start > region[0] and start < region[1]:
-                    return True
-        elif chrom == "Y":
-            for region in self.Y_PAR_REGIONS:
-                if start > region[0] and start < region[1]:
-                    return True
-        return False
-
-    def _fix_genotype(self, chrom, start, genotype, sex):
-        """
-        the TPED format has to have both alleles set, even if it is haploid.
-        this fixes that setting Y calls on the female to missing,
-        heterozygotic calls on the male non PAR regions to missing and haploid
-        calls on non-PAR regions to be the haploid call for both alleles
-        """
-        if sex == "2":
-            # set female Y calls and haploid calls to missing
-            if self._is_haploid(genotype) or chrom == "Y" or self._has_missing(genotype):
-                return self.PED_MISSING
-            return genotype
-        if chrom in self.POSSIBLE_HAPLOID and sex == "1":
-            # remove the missing genotype calls
-            genotype = [x for x in genotype if x not in self.NULL_GENOTYPES]
-            # if all genotypes are missing skip
-            if not genotype:
-                return self.PED_MISSING
-            # heterozygote males in non PAR regions are a mistake
-            if self._is_heterozygote(genotype) and not self._in_PAR(chrom, start):
-                return self.PED_MISSING
-            # set haploid males to be homozygous for the allele
-            if self._is_haploid(genotype):
-                return [genotype[0], genotype[0]]
-
-        # if a genotype is missing or is haploid set it to missing
-        if self._has_missing(genotype) or self._is_haploid(genotype):
-            return self.PED_MISSING
-        else:
-            return genotype
+    def predicate(self, row):
+        if row['type'] == "sv":
+            return False
+        alt = row['alt']
+        return self.genotypes.has_alleles(row['gts'], alt.split(",") if alt else [])
 
     def header(self, fields):
         return None
@@ -293,50 +234,13 @@ class VCFRowFormat(RowFormat):
     name = "vcf"
 
     def __init__(self, args):
-        self.gq = GeminiQuery(args.db)
+        from .vcf_writer import RecordFormatter
+        self.vcf = RecordFormatter(args.db)
 
     def format(self, row):
-        """Emit a VCF representation of a given row
-
-           TODO: handle multiple alleles
+        """Emit a VCF representation of a given row, see vcf_writer
         """
-        istr = self.gq._info_dict_to_string
-
-        # core VCF fields
-        vcf_rec = [row.row['chrom'], row.row['start'] + 1]
-        if row.row['vcf_id'] is None:
-            vcf_rec.append('.')
-        else:
-            vcf_rec.append(row.row['vcf_id'])
-        vcf_rec += [row.row['ref'], row.row['alt'], row.row['qual']]
-        if row.row['filter'] is None:
-            vcf_rec.append('PASS')
-        else:
-            vcf_rec.append(row.row['filter'])
-        vcf_rec += [istr(row['info']), 'GT']
-
-        # construct genotypes
-        gts = [util.to_str(r) for r in row['gts']]
-        gt_types = list(row['gt_types'])
-        gt_phases = list(row['gt_phases'])
-        for idx, gt_type in enumerate(gt_types):
-            phase_char = '/' if not gt_phases[idx] else '|'
-            gt = gts[idx]
-            alleles = gt.split(phase_char)
-            if gt_type == HOM_REF:
-                vcf_rec.append('0' + phase_char + '0')
-            elif gt_type == HET:
-                # if the genotype is phased, need to check for 1|0 vs. 0|1
-                if gt_phases[idx] and alleles[0] != row.row['ref']:
-                    vcf_rec.append('1' + phase_char + '0')
-                else:
-                    vcf_rec.append('0' + phase_char + '1')
-            elif gt_type == HOM_ALT:
-                vcf_rec.append('1' + phase_char + '1')
-            elif gt_type == UNKNOWN:
-                vcf_rec.append('.' + phase_char + '.')
-
-        return '\t'.join([str(c) if c is not None else "." for c in vcf_rec])
+        return self.vcf.record(row, row.query._info_dict_to_string(row['info']))
 
     def format_query(self, query):
         return query
@@ -345,13 +249,9 @@ class VCFRowFormat(RowFormat):
         return True
 
     def header(self, fields):
-        """Return the original VCF's header
+        """Return the original VCF's header for the samples of the database
         """
-        try:
-            self.gq.run('select vcf_header from vcf_header')
-            return str(next(self.gq)).strip()
-        except:
-            raise ValueError("Your database does not contain the vcf_header table. Therefore, you cannot use --header.\n")
+        return self.vcf.header()
 
 class SampleDetailRowFormat(RowFormat):
     """Retrieve queries with flattened sample information for samples present.
@@ -394,21 +294,52 @@ class SampleDetailRowFormat(RowFormat):
                 fields.remove(x)
         return "\t".join(fields + self.cols)
 
+class NpzRowFormat(RowFormat):
+    """Binary, columnar output (see columnar.py). The rows are not
+    formatted one at a time: the query command writes them to stdout in
+    batches of column arrays. The header is the list of column names.
+    """
+    name = "npz"
+    columnar = True
+
+    def __init__(self, args):
+        pass
+
+    def format(self, row):
+        return str(row.print_fields)
+
+    def format_query(self, query):
+        return query
+
+    def predicate(self, row):
+        return True
+
+    def header(self, fields):
+        return list(fields)
+
+class ArrowRowFormat(NpzRowFormat):
+    name = "arrow"
+
+class ParquetRowFormat(NpzRowFormat):
+    name = "parquet"
+
 class GeminiRow(object):
-    __slots__ = ('cache', 'genotype_dict', 'row', 'formatter', 'query',
+    __slots__ = ('cache', 'genotype_dict', 'row', 'index', 'formatter', 'query',
                  'print_fields', 'unpack')
 
     def __init__(self, row, query, formatter=DefaultRowFormat(None),
-                 print_fields=None, unpacker=None):
-        # row can be a dict() from the database or another GeminiRow (from the
+                 print_fields=None, unpacker=None, index=None):
+        # row can be a dict() from the database, a tuple whose values are
+        # looked up by column name in `index` or another GeminiRow (from the
         # same db entry). we try to re-use the cached stuff if possible.
-        self.cache = {}
-        self.genotype_dict = {}
-        self.row = getattr(row, "row", row)
-        self.cache = getattr(row, "cache", {})
-        self.genotype_dict = getattr(row, "genotype_dict", {})
+        if isinstance(row, GeminiRow):
+            self.row, self.index = row.row, row.index
+            self.cache, self.genotype_dict = row.cache, row.genotype_dict
+        else:
+            self.row, self.index = row, index
+            self.cache, self.genotype_dict = {}, {}
 
-        self.unpack = unpacker or compression.unpack_genotype_blob
+        self.unpack = unpacker or compression.unpack_typed_blob
 
         # for the eval.
         #self.cache['sample_info'] = dict(query.sample_info)
@@ -417,6 +348,11 @@ class GeminiRow(object):
         self.query = query
         self.print_fields = print_fields or {}
 
+    def _value(self, key):
+        if self.index is None:
+            return self.row[key]
+        return self.row[self.index[key]]
+
     def __getitem__(self, key):
         # we cache what we can.
         key = str(key)
@@ -440,20 +376,35 @@ class GeminiRow(object):
 
         if key == 'info':
             if 'info' not in self.cache:
-                self.cache['info'] = compression.unpack_ordereddict_blob(self.row['info'])
+                self.cache['info'] = compression.unpack_ordereddict_blob(self._value('info'))
             return self.cache['info']
         if key not in self.query.gt_cols:
-            return self.row[key]
+            return self._value(key)
         elif key in self.query.gt_cols:
             if key not in self.cache:
-                self.cache[key] = self.unpack(self.row[key])
+                self.cache[key] = self.unpack(self._value(key))
                 if PY3 and key == 'gts':
                     self.cache[key] = self.cache[key].astype(str)
             return self.cache[key]
         raise KeyError(key)
 
+    def gt_subset(self, key, indices):
+        """
+        Return the values of the gt column `key` for the samples at `indices`
+        only, e.g. the samples of one patient. With blocked genotype blobs
+        (oncogemini migrate-blobs --block-size) only the blocks holding those
+        samples are decompressed instead of the array for the whole cohort.
+        """
+        if key in self.cache:
+            return self.cache[key][indices]
+        vals = compression.unpack_subset(self._value(key), indices, self.unpack)
+        if PY3 and key == 'gts' and vals is not None:
+            vals = vals.astype(str)
+        return vals
+
     def keys(self):
-        return self.row.keys() + self.cache.keys()
+        keys = self.row.keys() if self.index is None else self.index
+        return list(keys) + list(self.cache.keys())
 
     def __iter__(self):
         return self
@@ -464,13 +415,47 @@ class GeminiRow(object):
 
     def next(self):
         try:
-            return self.row.keys()
+            return self.keys()
         except:
             raise StopIteration
 
     __next__ = next
 
 
+def _database_info(metadata):
+    """
+    what GeminiQuery needs to know about a database besides its schema.
+    """
+    info = {}
+    # save the gt_cols in the database and don't hard-code them anywhere.
+    info['gt_cols'] = util.get_gt_cols(metadata)
+
+    # extract the column names from the sample table.
+    # needed for gt-filter wildcard support.
+    try:
+        info['sample_column_names'] = [c.name for c in metadata.tables['samples'].columns]
+    except KeyError:
+        info['sample_column_names'] = []
+
+    # map sample names to indices. e.g. self.sample_to_idx[NA20814] -> 323
+    try:
+        samples = list(metadata.tables["samples"].select().execute())
+        info['sample_to_idx'] = {s['name']: s['sample_id'] -1 for s in samples}
+        info['idx_to_sample'] = {s['sample_id'] -1: s['name'] for s in samples}
+        info['idx_to_sample_object'] = {s['sample_id'] -1: Subject(s) for s in samples}
+        info['sample_to_sample_object'] = {s['name']: Subject(s) for s in samples}
+        # the names by index, to pick those of a genotype class at once
+        names = info['idx_to_sample']
+        info['sample_names'] = np.array([names.get(i) for i in
+                                         range(max(names) + 1 if names else 0)],
+                                        dtype=object)
+    except KeyError:
+        pass
+
+    info['unpacker'] = compression.get_unpacker(util.get_features(metadata))
+    return info
+
+
 class GeminiQuery(object):
 
     """
@@ -535,43 +520,33 @@ class GeminiQuery(object):
 
     def __init__(self, db, include_gt_cols=False,
                  out_format=DefaultRowFormat(None),
-                 variant_id_getter=None):
+                 variant_id_getter=None, batch_size=BUFFER_SIZE):
 
         self.db = db
         self.query_executed = False
         self.for_browser = False
         self.include_gt_cols = include_gt_cols
         self.variant_id_getter = variant_id_getter
+        # number of rows fetched and genotype-filtered at once. a false
+        # value filters one row at a time.
+        self.batch_size = batch_size
         self.result_proxy = None
+        self._batch = collections.deque()
+        self._rows = iter(())
+        # offset of each column of the result in its rows
+        self._index = {}
 
         # try to connect to the provided database
         self._connect_to_database()
 
-        # save the gt_cols in the database and don't hard-code them anywhere.
-        self.gt_cols = util.get_gt_cols(self.metadata)
+        # the gt_cols, sample maps and codec of the database are read once
+        # per process (and database version) and shared by all instances.
+        self.__dict__.update(database.cached(self.db, 'GeminiQuery', _database_info,
+                                              read_only=True))
 
-        # extract the column names from the sample table.
-        # needed for gt-filter wildcard support.
-        self._collect_sample_table_columns()
-
-        # list of samples ids for each clause in the --gt-filter
+        # list of samples ids for each wildcard in the --gt-filter
         self.sample_info = collections.defaultdict(list)
-
-        # map sample names to indices. e.g. self.sample_to_idx[NA20814] -> 323
-        try:
-            samples = list(self.metadata.tables["samples"].select().execute())
-            self.sample_to_idx = {s['name']: s['sample_id'] -1 for s in samples}
-            self.idx_to_sample = {s['sample_id'] -1: s['name'] for s in samples}
-            self.idx_to_sample_object = {s['sample_id'] -1: Subject(s) for s in samples}
-            self.sample_to_sample_object = {s['name']: Subject(s) for s in samples}
-        except KeyError:
-            pass
-
-        self.unpacker = compression.unpack_genotype_blob
-        if "features" in self.metadata.tables:
-            features = [x['feature'] for x in self.metadata.tables['features'].select().execute()]
-            if "snappy_compression" in features:
-                self.unpacker = compression.snappy_unpack_blob
+        self.gt_filter_tree = None
 
         self.formatter = out_format
         self.predicates = [self.formatter.predicate]
@@ -583,18 +558,46 @@ class GeminiQuery(object):
     def run(self, query, gt_filter=None, show_variant_samples=False,
             variant_samples_delim=',', predicates=None,
             needs_genotypes=False, needs_genes=False,
-            show_families=False, subjects=None):
+            show_families=False, subjects=None, variant_ids=None):
         """
         Execute a query against a Gemini database. The user may
         specify:
 
             1. (reqd.) an SQL `query`.
             2. (opt.) a genotype filter.
+            3. (opt.) the `variant_ids` the query is restricted to, e.g.
+               those passing a sample filter according to the gt index.
         """
+        self._prepare(query, gt_filter, show_variant_samples,
+                      variant_samples_delim, predicates, needs_genotypes,
+                      needs_genes, show_families, subjects, variant_ids)
+
+        self._batch.clear()
+        self._rows = iter(())
+        self._res = self._apply_query()
+        self.result_proxy = res = iter(self._res)
+        self.query_executed = True
+        return res
+
+    def sql(self, query, gt_filter=None, **kwargs):
+        """
+        Return the SQL statement that run() issues for the same arguments,
+        i.e. with the genotype columns and wildcards expanded, without
+        running it.
+        """
+        self._prepare(query, gt_filter, **kwargs)
+        self._rewrite_query()
+        return self.query
+
+    def _prepare(self, query, gt_filter=None, show_variant_samples=False,
+                 variant_samples_delim=',', predicates=None,
+                 needs_genotypes=False, needs_genes=False,
+                 show_families=False, subjects=None, variant_ids=None):
         self.query = self.formatter.format_query(query)
         self.gt_filter = gt_filter
-        if self._is_gt_filter_safe() is False:
-            raise ValueError("ERROR: invalid --gt-filter command.")
+        self.gt_filter_tree = None
+        if gt_filter is not None and len(gt_filter.strip()) == 0:
+            self.gt_filter = None
 
         self.show_variant_samples = show_variant_samples
         self.variant_samples_delim = variant_samples_delim
@@ -619,40 +622,40 @@ class GeminiQuery(object):
             if self.gt_filter is None:
                 self.query_type = "no-genotypes"
             else:
-                self.gt_filter = self._correct_genotype_filter()
+                self._parse_gt_filter()
                 self.query_type = "filter-genotypes"
         else:
             if self.gt_filter is None:
                 self.query_type = "select-genotypes"
             else:
-                self.gt_filter = self._correct_genotype_filter()
+                self._parse_gt_filter()
                 self.query_type = "filter-genotypes"
 
         if self.gt_filter:
             # here's how we use the fast
             if self.variant_id_getter:
                 if os.environ.get('GEMINI_DEBUG') == 'TRUE':
-                    sys.stderr.write("bcolz: using index\n")
+                    sys.stderr.write("gt index: using index\n")
 
                 user_dict = dict(HOM_REF=0, HET=1, UNKNOWN=2, HOM_ALT=3,
                                  sample_info=self.sample_info,
+                                 gt_filter_tree=self.gt_filter_tree,
                                  MISSING=None, UNAFFECTED=1, AFFECTED=2)
                 import time
                 t0 = time.time()
                 vids = self.variant_id_getter(self.db, self.gt_filter, user_dict)
                 if vids is None:
-                    sys.stderr.write("bcolz: can't parse this filter (falling back to gemini): %s\n" % self.gt_filter)
+                    sys.stderr.write("gt index: can't use the index for this filter (falling back to gemini): %s\n" % self.gt_filter)
                 else:
                     if os.environ.get('GEMINI_DEBUG') == 'TRUE':
-                        sys.stderr.write("bcolz: %.2f seconds to get %d rows.\n" % (time.time() - t0, len(vids)))
+                        sys.stderr.write("gt index: %.2f seconds to get %d rows.\n" % (time.time() - t0, len(vids)))
                     self.add_vids_to_query(vids)
 
-        if self.gt_filter:
-            self.gt_filter_compiled = compile(self.gt_filter, self.gt_filter, 'eval')
+        if variant_ids is not None:
+            self.query = add_variant_ids_to_query(self.query, variant_ids)
 
-        self.result_proxy = res = iter(self._apply_query())
-        self.query_executed = True
-        return res
+        if self.gt_filter_tree is not None and os.environ.get('GEMINI_DEBUG') == 'TRUE':
+            sys.stderr.write("gt_filter: %r\n" % self.gt_filter_tree)
 
     def __iter__(self):
         return self
@@ -665,6 +668,7 @@ class GeminiQuery(object):
         if q:
             self.query = q
             self.gt_filter = None
+            self.gt_filter_tree = None
 
     @property
     def header(self):
@@ -723,66 +727,43 @@ class GeminiQuery(object):
         # can quickly exceed the stack.
         while (1):
             try:
-                row = GeminiRow(next(self.result_proxy), self,
-                        unpacker=self.unpacker)
+                if self.gt_filter_tree is not None:
+                    row = self._next_in_batch()
+                else:
+                    row = GeminiRow(self._next_row(), self,
+                            unpacker=self.unpacker, index=self._index)
             except StopIteration:
+                self._res.close()
                 self.conn.close()
                 raise StopIteration
 
-            # skip the record if it does not meet the user's genotype filter
-            # short circuit some expensive ops
-            if self.gt_filter:
-                try:
-                    if 'False' == self.gt_filter: continue
-                    unpacked = {'sample_info': self.sample_info, 'HET': HET,
-                            'HOM_REF': HOM_REF, 'HOM_ALT': HOM_ALT}
-                    for col in self.gt_cols:
-                        if col in self.gt_filter:
-                            unpacked[col] = row[col]
-
-                    if not eval(self.gt_filter_compiled, unpacked):
-                        continue
-                # eval on a phred_ll column that was None
-                except TypeError:
-                    continue
-
             fields = PDict()
 
-            for idx, col in enumerate(self.report_cols):
-                if col == "*":
-                    continue
-                if not col[:2] in ("gt", "GT"):
+            for col, orig_col, source, idx in self._report_plan:
+                if source is None:
                     # need to use add in case of duplicated fields (from
                     # variants and variant_impacts)
                     fields.add(col, row[col])
+                elif idx is None:
+                    # asked for "gts" or "gt_types", e.g.
+                    if row[col] is not None:
+                        fields[col] = row[col]
+                    else:
+                        fields[col] = str(None)
                 else:
-                    # reuse the original column name user requested
-                    # e.g. replace gts[1085] with gts.NA20814
-                    if '[' in col:
-                        orig_col = self.gt_idx_to_name_map[col]
-
-                        source, extra = col.split('[', 1)
-                        assert extra[-1] == ']'
-                        if source.startswith('gt_phred_ll') and row[source] is None:
-                            fields[orig_col] = None
-                            continue
-
-                        idx = int(extra[:-1])
-                        val = row[source][idx]
-
-                        if type(val) in (np.int8, np.int32, np.bool_):
-                            fields.add(orig_col, int(val))
-
-                        elif type(val) in (np.float32,):
-                            fields.add(orig_col, float(val))
-                        else:
-                            fields.add(orig_col, val)
+                    if source.startswith('gt_phred_ll') and row[source] is None:
+                        fields[orig_col] = None
+                        continue
+
+                    val = row[source][idx]
+
+                    if type(val) in (np.int8, np.int32, np.bool_):
+                        fields.add(orig_col, int(val))
+
+                    elif type(val) in (np.float32,):
+                        fields.add(orig_col, float(val))
                     else:
-                        # asked for "gts" or "gt_types", e.g.
-                        if row[col] is not None:
-                            fields[col] = row[col]
-                        else:
-                            fields[col] = str(None)
+                        fields.add(orig_col, val)
 
             if self.show_variant_samples:
                 fields["variant_samples"] = \
@@ -800,13 +781,78 @@ class GeminiQuery(object):
                 continue
 
             if not self.for_browser:
-                # need to use new row for formatter.
-                return GeminiRow(row, self, formatter=self.formatter,
-                        print_fields=fields, unpacker=self.unpacker)
+                row.formatter = self.formatter
+                row.print_fields = fields
+                return row
             else:
                 return fields
     __next__ = next
 
+    def _next_row(self):
+        """
+        Return the values of the next row of the result, fetching the rows
+        from the cursor batch_size at a time.
+        """
+        try:
+            return next(self._rows)
+        except StopIteration:
+            rows = self._res.fetchmany(self.batch_size or 1)
+            if not rows:
+                raise
+            self._rows = iter(rows)
+            return next(self._rows)
+
+    def _next_in_batch(self):
+        """
+        Return the next row passing the genotype filter, refilling the
+        block of pre-filtered rows from the database as needed.
+        """
+        while not self._batch:
+            rows = self._res.fetchmany(self.batch_size or 1)
+            if not rows:
+                raise StopIteration
+            self._filter_batch(rows)
+        return self._batch.popleft()
+
+    def _filter_batch(self, rows):
+        """
+        Decode the gt columns used by the --gt-filter for a block of rows
+        into variants x samples matrices, evaluate the filter tree once for
+        the whole block and queue GeminiRows for the rows that pass. The
+        decoded arrays are put in the row cache so they are not unpacked again.
+        """
+        keep = np.ones(len(rows), dtype=bool)
+        decoded = {}
+        for col in self.gt_filter_tree.columns:
+            j = self._index[col]
+            arrays = [self.unpacker(r[j]) for r in rows]
+            # a NULL blob (e.g. gt_phred_ll) can't pass the filter.
+            missing = [i for i, a in enumerate(arrays) if a is None]
+            if len(missing) == len(arrays):
+                return
+            if missing:
+                fill = next(a for a in arrays if a is not None)
+                keep[missing] = False
+                arrays = [fill if a is None else a for a in arrays]
+            mat = np.vstack(arrays)
+            if PY3 and col == 'gts':
+                mat = mat.astype(str)
+            decoded[col] = mat
+
+        source = gtf.MatrixSource(decoded, len(rows))
+        try:
+            keep &= gtf.evaluate(self.gt_filter_tree, source)
+        except TypeError:
+            # e.g. comparing the strings in gts to a number
+            return
+
+        for i in np.flatnonzero(keep):
+            row = GeminiRow(rows[i], self, unpacker=self.unpacker,
+                            index=self._index)
+            for col, mat in decoded.items():
+                row.cache[col] = mat[i]
+            self._batch.append(row)
+
     def _filter_samples(self, samples):
         """Respect --sample-filter when outputting lists of sample information.
         """
@@ -820,74 +866,40 @@ class GeminiQuery(object):
         make list keyed by genotype of list of samples with that genotype
         so index 0 is HOM, 1 is HET, 2 is UKNOWN, 3 is HOM_ALT.
         """
-        d = [[], [], [], []]
-        lookup = self.idx_to_sample
-        for i, x in enumerate(gt_types):
-            d[x].append(lookup[i])
-        return d
+        gt_types = np.asarray(gt_types)
+        return [self.sample_names[gt_types == gt].tolist()
+                for gt in (HOM_REF, HET, UNKNOWN, HOM_ALT)]
 
     def _connect_to_database(self):
         """
         Establish a connection to the requested Gemini database.
         """
         # open up a new database
-        self.conn, self.metadata = database.get_session_metadata(self.db)
+        self.conn, self.metadata = database.get_session_metadata(self.db, read_only=True)
         self.res = None
 
 
-    def _collect_sample_table_columns(self):
+    def _execute_query(self):
         """
-        extract the column names in the samples table into a list
+        Run the query on a cursor of the sqlite3 connection itself: its rows
+        are plain tuples, fetched in blocks (see _next_row), and the values
+        of a column are found through self._index.
         """
+        res = self.conn.connection().connection.cursor()
         try:
-            self.sample_column_names = [c.name for c in self.metadata.tables['samples'].columns]
-        except KeyError:
-
-            self.sample_column_names = []
-
-    def _is_gt_filter_safe(self, gt_filter=None):
-        """
-        Test to see if the gt_filter string is potentially malicious.
-
-        A future improvement would be to use pyparsing to
-        traverse and directly validate the string.
-        """
-        gt_filter = gt_filter or self.gt_filter
-        if gt_filter is None or len(gt_filter.strip()) == 0:
-            return True
-
-        # avoid builtins
-        # http://nedbatchelder.com/blog/201206/eval_really_is_dangerous.html
-        if "__" in gt_filter:
-            return False
-
-        # avoid malicious commands
-        evil = [" rm ", "os.system"]
-        if any(s in gt_filter for s in evil):
-            return False
-
-        # make sure a "gt" col is in the string
-        valid_cols = list(flatten(("%s." % gtc, "(%s)." % gtc) for gtc in self.gt_cols))
-        if any(s in gt_filter for s in valid_cols):
-            return True
-
-        # assume the worst
-        return False
-
-    def _execute_query(self):
-        try:
-            res = self.conn.execute(sql.text(self.query))
-        except sql.exc.OperationalError as e:
+            res.execute(self.query)
+        except sqlite3.OperationalError as e:
             msg = "SQL error: {0}\n".format(e)
             print(msg)
             sys.stderr.write(msg)
             raise ValueError("The query issued (%s) has a syntax error." % self.query)
+        self._index = {d[0]: i for i, d in enumerate(res.description)}
         return res
 
-    def _apply_query(self):
+    def _rewrite_query(self):
         """
-        Execute a query. Intercept gt* columns and
-        replace sample names with indices where necessary.
+        Intercept gt* columns and replace sample names with indices
+        where necessary. Return whether the query needs genotype info.
         """
         if self.needs_genes:
             self.query = self._add_gene_col_to_query()
@@ -904,10 +916,22 @@ class GeminiQuery(object):
             # we only need genotype information if the user is
             # querying the variants table
             self.query = self._add_gt_cols_to_query()
+            return True
+        return False
+
+    def _apply_query(self):
+        """
+        Execute a query.
+        """
+        needs_genotype_info = self._rewrite_query()
+        # a no-op unless the index_advisor section of the config says so
+        index_advisor.record(self.db, self.query)
+
+        if needs_genotype_info:
             res = self._execute_query()
 
             self.all_query_cols = [
-                str(tuple[0]) for tuple in res.cursor.description
+                str(tuple[0]) for tuple in res.description
                 if not tuple[0][:2] == "gt" and ".gt" not in tuple[0]
                 ]
 
@@ -923,12 +947,36 @@ class GeminiQuery(object):
         # and as such, we don't need to do anything fancy.
         else:
             res = self._execute_query()
-            self.all_query_cols = [str(tuple[0]) for tuple in res.cursor.description
+            self.all_query_cols = [str(tuple[0]) for tuple in res.description
                     if not tuple[0][:2] == "gt"]
             self.report_cols = self.all_query_cols
 
+        self._report_plan = self._plan_report_cols()
         return res
 
+    def _plan_report_cols(self):
+        """
+        Work out once per query how next() reports each of the report_cols:
+        as (col, orig_col, source, idx), where source is None for a plain
+        column and idx is None for a whole gt column.
+        """
+        plan = []
+        for col in self.report_cols:
+            if col == "*":
+                continue
+            if not col[:2] in ("gt", "GT"):
+                plan.append((col, col, None, None))
+            elif '[' in col:
+                # reuse the original column name user requested
+                # e.g. replace gts[1085] with gts.NA20814
+                source, extra = col.split('[', 1)
+                assert extra[-1] == ']'
+                plan.append((col, self.gt_idx_to_name_map[col], source,
+                             int(extra[:-1])))
+            else:
+                plan.append((col, col, col, None))
+        return plan
+
     def _correct_genotype_col(self, raw_col):
         """
         Convert a _named_ genotype index to a _numerical_
@@ -969,149 +1017,30 @@ class GeminiQuery(object):
             sample_info.append((int(row['sample_id']) - 1, str(row['name'])))
         return sample_info
 
-    def _correct_genotype_filter(self, gt_filter=None):
+    def _parse_gt_filter(self):
         """
-        This converts a raw genotype filter that contains
-        'wildcard' statements into a filter that can be eval()'ed.
-        Specifically, we must convert a _named_ genotype index
-        to a _numerical_ genotype index so that the appropriate
-        value can be extracted for the sample from the genotype
-        numpy arrays.
+        Parse the raw --gt-filter into an expression tree (see gt_filter.py)
+        that is evaluated on blocks of variants. Sample names are converted
+        to genotype array offsets and wildcards to the offsets of the
+        matching samples, so that, for example:
 
-        For example, without WILDCARDS, this converts:
-        --gt-filter "(gt_types.1478PC0011 == 1)"
+            "(gt_types).(phenotype==1).(==HET).(all) and gt_depths.1478PC0011 > 20"
 
-        to:
-        (gt_types[11] == 1)
+        is evaluated as:
 
-        With WILDCARDS, this converts things like:
-            "(gt_types).(phenotype==1).(==HET)"
+            (gt_types[2] == 1 and gt_types[5] == 1) and gt_depths[11] > 20
 
-        to:
-            "gt_types[2] == HET and gt_types[5] == HET"
+        That expanded form is kept in self.gt_filter for the variant_id_getter.
         """
+        def match_samples(wildcard):
+            samples = self._get_matching_sample_ids(wildcard)
+            self.sample_info[len(self.sample_info)] = samples
+            return samples
 
-        def _swap_genotype_for_number(token):
-            """
-            This is a bit of a hack to get around the fact that eval()
-            doesn't handle the imported constants well when also having to
-            find local variables.  This requires some eval/globals()/locals() fu
-            that has evaded me thus far. Just replacing HET, etc. with 1, etc. works.
-            """
-            if any(g in token for g in ['HET', 'HOM_ALT', 'HOM_REF', 'UNKNOWN']):
-                token = token.replace('HET', str(HET))
-                token = token.replace('HOM_ALT', str(HOM_ALT))
-                token = token.replace('HOM_REF', str(HOM_REF))
-                token = token.replace('UNKNOWN', str(UNKNOWN))
-            return token
-
-        corrected_gt_filter = []
-
-        # first try to identify wildcard rules.
-        # (\s*gt\w+\) handles both
-        #    (gt_types).(*).(!=HOM_REF).(all)
-        # and
-        #    (   gt_types).(*).(!=HOM_REF).(all)
-        seen_count = False
-        wildcard_tokens = re.split(r'(\(\s*gt\w+\s*\)\.\(.+?\)\.\(.+?\)\.\(.+?\))', str(gt_filter or self.gt_filter))
-        for token_idx, token in enumerate(wildcard_tokens):
-            # NOT a WILDCARD
-            # We must then split on whitespace and
-            # correct the gt_* columns:
-            # e.g., "gts.NA12878" or "and gt_types.M10500 == HET"
-            if (token.find("gt") >= 0 or token.find("GT") >= 0) \
-                and not '.(' in token and not ')self.' in token:
-                tokens = re.split(r'[\s+]+', str(token))
-                for t in tokens:
-                    if len(t) == 0:
-                        continue
-                    if (t.find("gt") >= 0 or t.find("GT") >= 0):
-                        corrected = self._correct_genotype_col(t)
-                        corrected_gt_filter.append(corrected)
-                    else:
-                        t = _swap_genotype_for_number(t)
-                        if t.strip() in ("AND", "OR"):
-                            t = t.lower()
-                        corrected_gt_filter.append(t)
-            # IS a WILDCARD
-            # e.g., "gt_types.(affected==1).(==HET)"
-            elif (token.find("gt") >= 0 or token.find("GT") >= 0) \
-                and '.(' in token and ').' in token:
-                # break the wildcard into its pieces. That is:
-                # (COLUMN).(WILDCARD).(WILDCARD_RULE).(WILDCARD_OP)
-                # e.g, (gts).(phenotype==2).(==HET).(any)
-                if token.count('.') != 3 or \
-                   token.count('(') != 4 or \
-                   token.count(')') != 4:
-                    toks = token.split(".")
-                    raise ValueError("Wildcard filter should consist of 4 elements. Exiting.")
-                (column, wildcard, wildcard_rule, wildcard_op) = token.split('.')
-
-                # remove the syntactic parentheses
-                column = column.strip('(').strip(')').strip()
-                # allow commands like (gt_quals).(=HET).(>=20).(all)
-                wildcard = wildcard.strip('(').strip(')').strip()
-                is_gt_expression = "=HET" == wildcard or "=HOM_REF" == wildcard or "=HOM_ALT" == wildcard
-
-                wildcard_rule = wildcard_rule.strip('(').strip(')').strip()
-                wildcard_op = wildcard_op.strip('(').strip(')').strip()
-                extra_filter = None
-
-                # collect and save all of the samples that meet the wildcard criteria
-                # for each clause.
-                # these will be used in the list comprehension for the eval expression
-                # constructed below.
-                if is_gt_expression:
-                    self.sample_info[token_idx] = self._get_matching_sample_ids("*")
-                    extra_filter = " if gt_types[sample[0]] == %s" % wildcard[1:]
-                else:
-                    self.sample_info[token_idx] = self._get_matching_sample_ids(wildcard)
-
-                # Replace HET, etc. with 1, et.c to avoid eval() issues.
-                wildcard_rule = _swap_genotype_for_number(wildcard_rule)
-
-                # build the rule based on the wildcard the user has supplied.
-                if wildcard_op in ["all", "any"]:
-                    if self.variant_id_getter:
-                        joiner = " and " if wildcard_op == "all" else " or "
-                        rule = joiner.join("{column}[{sample}]{rule}".format(column=column, sample=s[0],
-                                                                             rule=wildcard_rule) for s in self.sample_info[token_idx])
-                        rule = "(" + rule + ")"
-                    else:
-                        rule = wildcard_op + "(" + column + '[sample[0]]' + wildcard_rule + " for sample in sample_info[" + str(token_idx) + "]%s)"
-                        rule %= (extra_filter or "")
-                elif wildcard_op == "none":
-                    if self.variant_id_getter:
-                        rule = " or ".join("%s[%s]%s" % (column, s[0], wildcard_rule) for s in self.sample_info[token_idx])
-                        rule = "~ ((" + rule + "))"
-                    else:
-                        rule = "not any(" + column + '[sample[0]]' + wildcard_rule + " for sample in sample_info[" + str(token_idx) + "]%s)"
-                        rule %= (extra_filter or "")
-                elif "count" in wildcard_op:
-                    # break "count>=2" into ['', '>=2']
-                    tokens = wildcard_op.split('count')
-                    count_comp = tokens[len(tokens) - 1]
-                    if self.variant_id_getter:
-                        rule = "|count|".join("((%s[%s]%s))" % (column, s[0], wildcard_rule) for s in self.sample_info[token_idx])
-                        rule = "%s|count|%s" % (rule, count_comp.strip())
-                        seen_count = True
-                    else:
-                        rule = "sum(" + column + '[sample[0]]' + wildcard_rule + " for sample in sample_info[" + str(token_idx) + "]%s)" + count_comp
-                        rule %= (extra_filter or "")
-                else:
-                    raise ValueError("Unsupported wildcard operation: (%s). Exiting." % wildcard_op)
-
-                corrected_gt_filter.append(rule)
-            else:
-                if len(token) > 0:
-                    if token.strip() in ("AND", "OR"):
-                        token = token.lower()
-                    corrected_gt_filter.append(token)
-        if seen_count and len(corrected_gt_filter) > 1 and self.variant_id_getter:
-            raise GeminiError("count operations can not be combined with other operations")
-
-        return " ".join(corrected_gt_filter)
-
+        self.sample_info.clear()
+        self.gt_filter_tree = gtf.parse(self.gt_filter, self.gt_cols,
+                                        self.sample_to_idx, match_samples)
+        self.gt_filter = self.gt_filter_tree.to_python()
 
     def _add_gt_cols_to_query(self):
         """
@@ -1285,6 +1214,8 @@ class GeminiQuery(object):
     def _query_needs_genotype_info(self):
         if self.include_gt_cols or self.show_variant_samples or self.needs_genotypes:
             return True
+        if self.gt_filter_tree is not None:
+            return True
 
         tokens = self._tokenize_query()
         requested_genotype = "variants" in tokens and \
@@ -1317,9 +1248,9 @@ def add_variant_ids_to_query(query, vids):
     "select gene, chrom, start, end from variants where gene = 'asdf' and  variant_id IN (1,2,3) order by gene limit 10"
     >>> add_variant_ids_to_query("select gene, chrom, start, end from variants", vids)
     'select gene, chrom, start, end from variants where  variant_id IN (1,2,3)'
+    >>> add_variant_ids_to_query("select gene, chrom, start, end from variants limit 10", [])
+    'select gene, chrom, start, end from variants where  variant_id IN ()  limit 10'
     """
-    if len(vids) == 0:
-        return vids
     extra = " variant_id IN (%s)" % ",".join(np.char.mod("%i", vids))
 
     # order by, then limit.
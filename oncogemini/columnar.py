@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Binary, columnar output of query results (query --format npz, arrow or
+parquet), for loading into pandas, R or numpy without parsing text.
+
+The rows of a query are collected BUFFER_SIZE at a time into one array per
+column, as GeminiQuery decoded them: plain columns become 1-d arrays and
+whole genotype columns (e.g. gts, gt_types) 2-d (rows x samples) arrays.
+Values are never formatted as text:
+
+    npz      an .npz archive of one array per column, with a boolean
+             <column>.mask array for columns with NULLs (numpy only)
+    arrow    an Arrow IPC file of record batches, genotype columns as
+             fixed size lists (needs pyarrow)
+    parquet  a Parquet file, genotype columns as fixed size lists (needs
+             pyarrow)
+
+Repeated column names (e.g. from a join) get a _2, _3 ... suffix.
+"""
+from __future__ import absolute_import
+
+import itertools
+
+import numpy as np
+
+from .gemini_constants import BUFFER_SIZE
+
+FORMATS = ("npz", "arrow", "parquet")
+
+
+def _names(keys):
+    """
+    >>> _names(['variant_id', 'gene', 'variant_id'])
+    ['variant_id', 'gene', 'variant_id_2']
+    """
+    seen, names = {}, []
+    for k in keys:
+        seen[k] = seen.get(k, 0) + 1
+        names.append(k if seen[k] == 1 else "%s_%d" % (k, seen[k]))
+    return names
+
+
+def _column(values):
+    """
+    the values of a column of a batch as an array and the mask of the
+    NULLs (None if there are none). missing values are 0, '' or False; the
+    array is None if all of them are.
+
+    >>> data, mask = _column([1, None, 3])
+    >>> data.tolist(), mask.tolist()
+    ([1, 0, 3], [False, True, False])
+    >>> data, mask = _column([np.array([0, 1]), np.array([3, 2])])
+    >>> data.shape, mask
+    ((2, 2), None)
+    """
+    missing = np.array([v is None for v in values], dtype=bool)
+    present = [v for v in values if v is not None]
+    if not present:
+        return None, missing
+    if isinstance(present[0], np.ndarray):
+        fill = np.zeros_like(present[0])
+        data = np.vstack([fill if v is None else v for v in values])
+    else:
+        fill = np.array(present).dtype.type()
+        data = np.array([fill if v is None else v for v in values])
+    return data, (missing if missing.any() else None)
+
+
+def batches(rows, size=BUFFER_SIZE):
+    """
+    the (names, [(data, mask), ...]) batches of up to `size` of the
+    GeminiRows `rows` (e.g. a GeminiQuery that was run).
+    """
+    rows = iter(rows)
+    while True:
+        fields = [row.print_fields for row in itertools.islice(rows, size)]
+        if fields:
+            names = _names(fields[0].keys())
+            yield names, [_column([f.values()[j] for f in fields]) for j in range(len(names))]
+        # a GeminiQuery can't be iterated past its end
+        if len(fields) < size:
+            return
+
+
+class NpzWriter(object):
+    """ collects the batches and writes them as one .npz archive on close """
+
+    def __init__(self, fh, names):
+        self.fh = fh
+        self.names = _names(names or [])
+        self.batches = []
+
+    def write(self, batch):
+        self.batches.append(batch)
+
+    def close(self):
+        arrays = {}
+        if self.batches:
+            names = self.batches[0][0]
+            for j, name in enumerate(names):
+                columns = [columns[j] for _, columns in self.batches]
+                like = next((data for data, _ in columns if data is not None), np.zeros(0))
+                arrays[name] = np.concatenate(
+                    [np.zeros((len(mask),) + like.shape[1:], dtype=like.dtype)
+                     if data is None else data for data, mask in columns])
+                if any(mask is not None for _, mask in columns):
+                    arrays[name + ".mask"] = np.concatenate(
+                        [np.zeros(len(data), dtype=bool) if mask is None else mask
+                         for data, mask in columns])
+        else:
+            for name in self.names:
+                arrays[name] = np.zeros(0)
+        np.savez_compressed(self.fh, **arrays)
+
+
+class ArrowWriter(object):
+    """
+    writes each batch as an Arrow record batch to an IPC file or a Parquet
+    file. the schema is that of the first batches: the batches are held
+    until every column had a value (all NULL columns have no type yet).
+    """
+
+    def __init__(self, fh, names, parquet=False):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ValueError("--format %s needs pyarrow, which is not installed"
+                             % ("parquet" if parquet else "arrow"))
+        self.pa = pyarrow
+        self.fh = fh
+        self.names = _names(names or [])
+        self.parquet = parquet
+        self.schema = None
+        self.writer = None
+        self.pending = []
+
+    def _array(self, data, mask):
+        pa = self.pa
+        if data is None:
+            return pa.nulls(len(mask))
+        if data.ndim == 1:
+            return pa.array(data, mask=mask)
+        n = data.shape[1]
+        if mask is None:
+            return pa.FixedSizeListArray.from_arrays(pa.array(data.ravel()), n)
+        values = pa.array(data[:0].ravel()).type
+        return pa.array([None if m else row.tolist() for row, m in zip(data, mask)],
+                        type=pa.list_(values, n))
+
+    def _open(self, schema):
+        self.schema = schema
+        if self.parquet:
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(self.fh, schema)
+        else:
+            self.writer = self.pa.ipc.new_file(self.fh, schema)
+
+    def _schema(self, tables):
+        """ the first type of each column that isn't null """
+        fields = []
+        for j, name in enumerate(tables[0].schema.names):
+            types = [t.schema.field(j).type for t in tables]
+            typ = next((t for t in types if t != self.pa.null()), types[0])
+            fields.append(self.pa.field(name, typ))
+        return self.pa.schema(fields)
+
+    def write(self, batch):
+        names, columns = batch
+        table = self.pa.Table.from_arrays([self._array(d, m) for d, m in columns],
+                                          names=names)
+        if self.writer is None:
+            self.pending.append(table)
+            if any(f.type == self.pa.null() for f in self._schema(self.pending)):
+                return
+            self._flush()
+        else:
+            self.writer.write_table(table.cast(self.schema))
+
+    def _flush(self):
+        self._open(self._schema(self.pending))
+        for table in self.pending:
+            self.writer.write_table(table.cast(self.schema))
+        self.pending = []
+
+    def close(self):
+        if self.writer is None:
+            if self.pending:
+                self._flush()
+            else:
+                self._open(self.pa.schema([(name, self.pa.null()) for name in self.names]))
+        self.writer.close()
+
+
+def writer(format, fh, names=None):
+    """ the writer of `format` to the binary file `fh` """
+    if format == "npz":
+        return NpzWriter(fh, names)
+    return ArrowWriter(fh, names, parquet=format == "parquet")
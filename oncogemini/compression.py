@@ -1,6 +1,6 @@
 """
 >>> a = np.arange(20)
->>> (a == snappy_unpack_blob(snappy_pack_blob(a))).all()
+>>> bool((a == snappy_unpack_blob(snappy_pack_blob(a))).all())
 True
 
 >>> a = np.arange(20, dtype=np.uint8)
@@ -30,8 +30,57 @@ True
 
 >>> b = snappy_unpack_blob(snappy_pack_blob(np.array([False, True, False, True])))
 >>> b[2] = True
+
+blobs written by older versions (a dtype character or 'S' and the joined
+strings before the snappy data) still decode:
+
+>>> snappy_unpack_blob(b'S' + snappy.compress(SEP.join([b'A/A', b'C|T']))).tolist()
+['A/A', 'C|T']
+>>> snappy_unpack_blob(b'i' + snappy.compress(np.arange(3, dtype=np.int32).tobytes())).tolist()
+[0, 1, 2]
+
+typed blobs round-trip without pickle and keep dtype and shape for every
+codec and every kind of gt_* column:
+
+>>> for c in available_codecs():
+...     for a in _gt_corpus(7):
+...         for block_size in (None, 3):
+...             b = unpack_typed_blob(pack_typed_blob(a, c, block_size))
+...             assert b.dtype == a.dtype and b.shape == a.shape, (c, a, b)
+...             assert ((a == b) | ((a != a) & (b != b))).all(), (c, a, b)
+...             if a.ndim == 1 and len(a):
+...                 idx = [len(a) - 1, 0, 4]
+...                 b = unpack_subset(pack_typed_blob(a, c, block_size), idx)
+...                 assert (a[idx].astype(str) == b.astype(str)).all(), (c, a, b)
+...         if 'snappy' in CODECS:
+...             b = snappy_unpack_blob(snappy_pack_blob(a))
+...             assert b.dtype == a.dtype and (a.astype(str) == b.astype(str)).all()
+>>> unpack_typed_blob(pack_typed_blob(None)) is None
+True
+
+appending values to a typed blob gives the blob of the whole array, wherever
+the old values end:
+
+>>> for c in available_codecs():
+...     for a in _gt_corpus(150)[:8]:
+...         for k in (0, 20, 64, 128, 149):
+...             for block_size in (None, 64):
+...                 b = append_blob(pack_typed_blob(a[:k], c, block_size), a[k:])
+...                 b = unpack_typed_blob(b)
+...                 assert b.dtype == a.dtype, (c, a, k, block_size)
+...                 assert (a.astype(str) == b.astype(str)).all(), (c, a, k, block_size)
+>>> unpack_typed_blob(None) is None
+True
+
+and the typed unpacker still reads the old pickled blobs:
+
+>>> unpack_typed_blob(pack_blob(np.array([1, 3, 0]))).tolist()
+[1, 3, 0]
+>>> get_unpacker(["genotype_codec:zlib"]) is unpack_typed_blob
+True
 """
 from __future__ import absolute_import
+import struct
 import sys
 import zlib
 try:
@@ -70,7 +119,7 @@ def unpack_ordereddict_blob(blob):
 try:
     import snappy
 except ImportError:
-    pass
+    snappy = None
 
 import numpy as np
 
@@ -79,26 +128,374 @@ import numpy as np
 lookup = {dt(1).dtype.char: dt for dt in (np.uint8, np.uint32, np.int32,
           np.float32, np.int64, np.float64, np.bool_)}
 
-SEP = '\0'
+SEP = b'\0'
 
 def snappy_pack_blob(obj, sep=SEP):
-    if obj is None: return ''
-    c = obj.dtype.char
-    if c == 'S': return 'S' + snappy.compress(sep.join(obj))
-    return buffer(c + snappy.compress(obj.tobytes()))
+    """
+    snappy compressed genotype blob. these are typed blobs (see below) with the
+    snappy codec, so string arrays are stored as a fixed-width buffer rather
+    than joined with `sep`; snappy_unpack_blob still reads the old layout.
+    """
+    return pack_typed_blob(obj, 'snappy')
+
+def _snappy_unpack_legacy(blob, sep=SEP):
+    # a one character dtype code followed by the snappy compressed buffer, or
+    # 'S' and the sep-joined strings.
+    c = bytes(blob[:1]).decode('ascii')
+    data = snappy.decompress(bytes(blob[1:]))
+    if c == 'S':
+        return np.array([x.decode('utf-8') for x in data.split(sep)])
+    return np.frombuffer(data, dtype=lookup[c])
 
 def snappy_unpack_blob(blob, sep=SEP):
-    if len(blob) == 0: return None
-    if blob[0] == 'S':
-        return np.array(snappy.decompress(blob[1:]).split(sep))
-    dt = lookup[blob[0]]
-    arr = np.frombuffer(snappy.decompress(blob[1:]), dtype=dt)
+    if blob is None or len(blob) == 0: return None
+    if bytes(blob[:len(TYPED_MAGIC)]) == TYPED_MAGIC:
+        arr = unpack_typed_blob(blob)
+    else:
+        arr = _snappy_unpack_legacy(blob, sep)
     # hack since arrays arent writable from buffer and we need this for comp_het
     # phasing.
-    if blob[0] == '?':
-        arr.setflags(write=True)
+    if arr is not None and arr.dtype.char == '?':
+        arr = arr.copy()
     return arr
 
+
+# typed genotype blobs
+# --------------------
+# A fixed header:
+#
+#     magic (4s), version (B), codec id (B), len(dtype) (B), dtype, ndim (B),
+#     shape (ndim x uint32)
+#
+# followed by the raw little-endian buffer of the array, compressed with the
+# codec. dtype is numpy's dtype.str (e.g. '<i4', '<f4', '|b1', '<U3') so it can
+# be decoded with np.frombuffer and no pickle. None is stored with an empty
+# dtype and no payload.
+#
+# version 2 (blocked) blobs add block size (I), number of blocks (I) and the
+# offsets of the blocks ((n + 1) x uint32) after the shape; each block of
+# samples is compressed on its own.
+TYPED_MAGIC = b'\x93OGT'
+TYPED_VERSION = 2
+_TYPED_HEADER = struct.Struct('<4sBBB')
+
+# prefix of the row recorded in the features table of databases whose
+# genotype blobs use this format, e.g. "genotype_codec:zstd"
+TYPED_FEATURE = "genotype_codec"
+
+# codec name -> (id stored in the header, compress, decompress). the ids must
+# never be reused.
+CODECS = OrderedDict()
+CODECS['none'] = (0, bytes, bytes)
+CODECS['zlib'] = (1, lambda b: zlib.compress(b, 1), zlib.decompress)
+
+try:
+    import lz4.frame
+    CODECS['lz4'] = (2, lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+try:
+    import zstandard
+    CODECS['zstd'] = (3, lambda b: zstandard.ZstdCompressor(level=3).compress(b),
+                      lambda b: zstandard.ZstdDecompressor().decompress(b))
+except ImportError:
+    pass
+
+if snappy is not None:
+    CODECS['snappy'] = (4, lambda b: snappy.compress(bytes(b)), snappy.decompress)
+
+_CODEC_BY_ID = {v[0]: (k, v[2]) for k, v in CODECS.items()}
+
+
+def available_codecs():
+    return list(CODECS)
+
+
+def pack_typed_blob(obj, codec='zlib', block_size=None):
+    """
+    encode an array as a typed blob. with a block_size, 1-D arrays longer than
+    that are compressed in independent blocks of block_size samples so that
+    unpack_subset only has to decompress the blocks holding the requested
+    samples.
+    """
+    if codec not in CODECS:
+        raise ValueError("unknown or unavailable codec: %s (available: %s)"
+                         % (codec, ", ".join(CODECS)))
+    codec_id, compress, _ = CODECS[codec]
+    if obj is None:
+        return buffer(_TYPED_HEADER.pack(TYPED_MAGIC, 1, 0, 0))
+
+    arr = np.asarray(obj)
+    if arr.dtype.kind == 'O':
+        # e.g. gts that were built from a list of python strings.
+        arr = np.array(arr.tolist())
+    if arr.dtype.byteorder == '>':
+        arr = arr.astype(arr.dtype.newbyteorder('<'))
+    arr = np.ascontiguousarray(arr)
+    blocked = bool(block_size) and arr.ndim == 1 and len(arr) > block_size
+    if not blocked:
+        return buffer(_typed_header(1, codec_id, arr.dtype, arr.shape)
+                      + compress(arr.tobytes()))
+
+    blocks = [compress(arr[i:i + block_size].tobytes())
+              for i in range(0, len(arr), block_size)]
+    return _blocked_blob(codec_id, arr.dtype, len(arr), block_size, blocks)
+
+
+def _typed_header(version, codec_id, dtype, shape):
+    dt = dtype.str.encode('ascii')
+    return _TYPED_HEADER.pack(TYPED_MAGIC, version, codec_id, len(dt)) + dt \
+        + struct.pack('<B%dI' % len(shape), len(shape), *shape)
+
+
+def _blocked_blob(codec_id, dtype, n, block_size, blocks):
+    offsets = np.cumsum([0] + [len(b) for b in blocks]).astype('<u4')
+    return buffer(_typed_header(2, codec_id, dtype, (n,))
+                  + struct.pack('<II', block_size, len(blocks)) + offsets.tobytes()
+                  + b''.join(blocks))
+
+
+class _TypedHeader(object):
+    """
+    the parsed header of a typed blob. `offset` is where the payload starts;
+    for blocked (version 2) blobs `offsets` has the start of each block
+    relative to it.
+    """
+    def __init__(self, blob):
+        magic, self.version, self.codec_id, dtlen = _TYPED_HEADER.unpack_from(blob, 0)
+        if self.version > TYPED_VERSION:
+            raise ValueError("genotype blob version %d is newer than this oncogemini "
+                             "supports (%d)" % (self.version, TYPED_VERSION))
+        self.dtype = None
+        if dtlen == 0:
+            return
+        off = _TYPED_HEADER.size
+        self.dtype = np.dtype(bytes(blob[off:off + dtlen]).decode('ascii'))
+        off += dtlen
+        ndim = struct.unpack_from('<B', blob, off)[0]
+        self.shape = struct.unpack_from('<%dI' % ndim, blob, off + 1)
+        off += 1 + 4 * ndim
+        if self.version == 2:
+            self.block_size, n_blocks = struct.unpack_from('<II', blob, off)
+            off += 8
+            self.offsets = np.frombuffer(blob, dtype='<u4', count=n_blocks + 1, offset=off)
+            off += 4 * (n_blocks + 1)
+        self.offset = off
+        try:
+            self.decompress = _CODEC_BY_ID[self.codec_id][1]
+        except KeyError:
+            raise ValueError("genotype blob uses codec %d, which is not installed "
+                             "(available: %s)" % (self.codec_id, ", ".join(CODECS)))
+
+    def block(self, view, i):
+        start = self.offset + self.offsets[i]
+        data = view[start:self.offset + self.offsets[i + 1]]
+        if self.codec_id != 0:
+            data = self.decompress(data)
+        return np.frombuffer(data, dtype=self.dtype)
+
+
+def _is_typed(blob):
+    return blob is not None and bytes(blob[:len(TYPED_MAGIC)]) == TYPED_MAGIC
+
+
+def is_typed_with(blob, codec):
+    """
+    whether `blob` is a typed blob compressed with `codec` (or holding no
+    array), i.e. one a migration to `codec` doesn't have to rewrite.
+
+    >>> is_typed_with(pack_typed_blob(np.arange(3), 'zlib'), 'zlib')
+    True
+    >>> is_typed_with(pack_typed_blob(np.arange(3), 'none'), 'zlib')
+    False
+    >>> is_typed_with(pack_typed_blob(None), 'zlib'), is_typed_with(None, 'zlib')
+    (True, False)
+    """
+    if not _is_typed(blob):
+        return False
+    _, _, codec_id, dtlen = _TYPED_HEADER.unpack_from(blob, 0)
+    return dtlen == 0 or CODECS.get(codec, (None,))[0] == codec_id
+
+
+def _unpack_typed_or_snappy(blob):
+    """ the blobs of a migration from snappy blobs that hasn't finished """
+    if blob is None or _is_typed(blob):
+        return unpack_typed_blob(blob)
+    return snappy_unpack_blob(blob)
+
+
+def unpack_typed_blob(blob):
+    """
+    decode a typed blob. the arrays are read-only views of the decompressed
+    buffer. blobs without the magic (i.e. not yet migrated) are handed to
+    unpack_genotype_blob.
+    """
+    if blob is None:
+        return None
+    if not _is_typed(blob):
+        return unpack_genotype_blob(blob)
+    head = _TypedHeader(blob)
+    if head.dtype is None:
+        return None
+    view = memoryview(blob)
+    if head.version == 2:
+        return np.concatenate([head.block(view, i) for i in range(len(head.offsets) - 1)])
+    payload = view[head.offset:]
+    if head.codec_id != 0:
+        payload = head.decompress(payload)
+    return np.frombuffer(payload, dtype=head.dtype).reshape(head.shape)
+
+
+def unpack_subset(blob, indices, unpacker=unpack_typed_blob):
+    """
+    decode only the values at `indices` (e.g. the samples of one patient).
+    only blocked typed blobs can be partially decoded; anything else is fully
+    decoded with `unpacker` and then indexed.
+
+    >>> a = np.arange(1000, dtype=np.float32)
+    >>> unpack_subset(pack_typed_blob(a, block_size=64), [3, 999, 500, 4]).tolist()
+    [3.0, 999.0, 500.0, 4.0]
+    >>> unpack_subset(pack_blob(a), [3, 999]).tolist()
+    [3.0, 999.0]
+    >>> unpack_subset(pack_typed_blob(None, block_size=64), [1]) is None
+    True
+    """
+    if not _is_typed(blob) or bytes(blob[4:5]) != b'\x02':
+        arr = unpacker(blob)
+        return None if arr is None else arr[indices]
+    head = _TypedHeader(blob)
+    view = memoryview(blob)
+    indices = np.asarray(indices, dtype=np.intp)
+    blocks = indices // head.block_size
+    out = np.empty(len(indices), dtype=head.dtype)
+    for b in np.unique(blocks):
+        sel = blocks == b
+        out[sel] = head.block(view, b)[indices[sel] - b * head.block_size]
+    return out
+
+
+def append_blob(blob, values, unpacker=unpack_typed_blob, packer=pack_blob,
+                block_size=None):
+    """
+    the blob of the 1-D array of `blob` followed by `values` (e.g. the values
+    of samples added to a database), in the dtype of `blob` unless `values`
+    holds longer strings. a blocked typed blob keeps its codec and all its
+    blocks but the last, which is decoded to take the first values; other
+    typed blobs are decoded and encoded again with their codec (blocked with
+    `block_size`, if given) and anything else with `unpacker` and `packer`.
+    None stays None.
+
+    >>> a = np.arange(100, dtype=np.int32)
+    >>> b = append_blob(pack_typed_blob(a[:70], 'zlib', 64), a[70:].astype(np.int64))
+    >>> bytes(b) == bytes(pack_typed_blob(a, 'zlib', 64))
+    True
+    >>> unpack_typed_blob(append_blob(pack_blob(np.array(['A/A'])), np.array(['AT/A']),
+    ...                               packer=pack_typed_blob)).tolist()
+    ['A/A', 'AT/A']
+    >>> append_blob(None, a) is None
+    True
+    """
+    if blob is None:
+        return None
+    values = np.asarray(values)
+    if not _is_typed(blob):
+        arr = unpacker(blob)
+        if arr is None:
+            return blob
+        return packer(np.concatenate([arr, values.astype(_append_dtype(arr.dtype, values))]))
+    head = _TypedHeader(blob)
+    if head.dtype is None:
+        return blob
+    dtype = _append_dtype(head.dtype, values)
+    codec = _CODEC_BY_ID[head.codec_id][0]
+    if head.version != 2 or dtype != head.dtype:
+        arr = unpack_typed_blob(blob).astype(dtype)
+        if head.version == 2:
+            block_size = head.block_size
+        return pack_typed_blob(np.concatenate([arr, values.astype(dtype)]), codec,
+                               block_size)
+
+    view = memoryview(blob)
+    size, n = head.block_size, head.shape[0]
+    # the full blocks are kept as they are
+    keep = n // size
+    kept = [view[head.offset + head.offsets[i]:head.offset + head.offsets[i + 1]]
+            for i in range(keep)]
+    tail = head.block(view, keep) if n % size else values[:0].astype(dtype)
+    arr = np.concatenate([tail, values.astype(dtype)])
+    compress = CODECS[codec][1]
+    blocks = [compress(arr[i:i + size].tobytes()) for i in range(0, len(arr), size)]
+    return _blocked_blob(head.codec_id, dtype, n + len(values), size,
+                         [bytes(b) for b in kept] + blocks)
+
+
+def _append_dtype(dtype, values):
+    if dtype.kind in 'SU' and values.dtype.kind in 'SU':
+        return np.result_type(dtype, values.dtype)
+    return dtype
+
+
+def _gt_corpus(n, seed=42):
+    """
+    arrays shaped like the gt_* columns of a database with n samples,
+    including missing values, for the tests and benchmark below.
+    """
+    rs = np.random.RandomState(seed)
+    bases = np.array(['A/A', 'A/C', 'C|C', './.', 'AT/A', 'ACGTACGT/A'])
+    freqs = rs.rand(n)
+    freqs[::5] = -1
+    return [
+        bases[rs.randint(0, len(bases), n)],                 # gts
+        rs.choice([0, 1, 2, 3], n).astype(np.int8),          # gt_types
+        rs.choice([0, 1, 2, 3], n).astype(np.int32),
+        rs.rand(n) > 0.5,                                    # gt_phases
+        rs.randint(-1, 500, n).astype(np.int32),             # gt_depths, ...
+        freqs.astype(np.float32),                            # gt_alt_freqs
+        freqs,
+        np.where(freqs < 0, np.nan, freqs * 99).astype(np.float32),  # gt_quals
+        rs.randint(0, 255, (3, n)).astype(np.int32),         # gt_phred_ll
+        np.array([], dtype=np.float32),
+    ]
+
+
+def benchmark(n_samples=1000, n_rows=2000):
+    """
+    report size and encode/decode time per row of every codec, and of the
+    old pickled blobs, on random gt_* arrays: python -m oncogemini.compression bench
+    """
+    import timeit
+    corpus = _gt_corpus(n_samples)
+    formats = [('pickle+zlib', pack_blob, unpack_genotype_blob)]
+    formats += [(c, lambda a, c=c: pack_typed_blob(a, c), unpack_typed_blob)
+                for c in available_codecs()]
+    print("%-12s %12s %14s %14s" % ("codec", "bytes/row", "encode us/row", "decode us/row"))
+    for name, pack, unpack in formats:
+        blobs = [pack(a) for a in corpus]
+        size = sum(len(b) for b in blobs) / float(len(blobs))
+        n = max(1, n_rows // len(corpus))
+        enc = timeit.timeit(lambda: [pack(a) for a in corpus], number=n)
+        dec = timeit.timeit(lambda: [unpack(b) for b in blobs], number=n)
+        print("%-12s %12.0f %14.1f %14.1f" % (name, size, 1e6 * enc / (n * len(corpus)),
+                                              1e6 * dec / (n * len(corpus))))
+
+
+def get_unpacker(features):
+    """
+    pick the genotype blob decoder from the rows of the features table.
+    """
+    if any(f.startswith(TYPED_FEATURE) for f in features):
+        if "snappy_compression" in features:
+            return _unpack_typed_or_snappy
+        return unpack_typed_blob
+    if "snappy_compression" in features:
+        return snappy_unpack_blob
+    return unpack_genotype_blob
+
+
 if __name__ == "__main__":
-    import doctest
-    print(doctest.testmod())
+    if sys.argv[1:] == ["bench"]:
+        benchmark()
+    else:
+        import doctest
+        print(doctest.testmod())
@@ -58,13 +58,27 @@ def read_gemini_config(dirs=None, allow_missing=False, use_globals=True, args=No
             raise
     if fname:
         with open(fname) as in_handle:
-            config = yaml.load(in_handle)
+            config = yaml.safe_load(in_handle)
     if args and hasattr(args, "annotation_dir") and args.annotation_dir:
         # If --annotation-dir is given via commandline interface, we will overwrite the
         # location from the config file
         config["annotation_dir"] = args.annotation_dir
     return config
 
+def read_config_section(name, defaults):
+    """
+    a copy of the `defaults` of a section of the configuration, updated with
+    the settings of section `name` of the configuration file, if any.
+    """
+    section = dict(defaults)
+    custom = read_gemini_config(allow_missing=True).get(name) or {}
+    unknown = set(custom) - set(section)
+    if unknown:
+        raise ValueError("unknown %s setting(s) in the configuration: %s"
+                         % (name, ", ".join(sorted(unknown))))
+    section.update(custom)
+    return section
+
 def _find_best_config_file(dirs=None):
     dirs = [] if dirs is None else dirs
     dnames = dirs + get_config_dirs()
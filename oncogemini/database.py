@@ -3,13 +3,18 @@ from __future__ import absolute_import
 
 import os
 import contextlib
+import itertools
+import sqlite3
 import sys
+import time
 
+import numpy as np
 import sqlalchemy as sql
 from sqlalchemy.orm import mapper, create_session
 import sqlalchemy
 
 from .ped import get_ped_fields
+from .gemini_constants import BUFFER_SIZE
 
 
 def index_variation(cursor):
@@ -423,6 +428,90 @@ def create_sample_table(cursor, metadata, args):
     t.drop(checkfirst=True)
     metadata.create_all(tables=[t])
 
+def _to_int(v):
+    return None if v is None or v == "" else int(v)
+
+
+def _to_float(v):
+    return None if v is None or v == "" else float(v)
+
+
+def _to_bool(v):
+    if v is None:
+        return None
+    if isinstance(v, str):
+        v = v.lower() not in ("", "0", "false")
+    return int(bool(v))
+
+
+def _to_text(v):
+    if isinstance(v, bytes) and not isinstance(v, str):
+        return v.decode("utf8", "ignore")
+    return v if v is None or isinstance(v, str) else str(v)
+
+
+def _to_blob(v):
+    return v if v is None or isinstance(v, bytes) else bytes(v)
+
+
+_NONE = type(None)
+
+# the conversion of the values of each type of column, and the types of
+# values sqlite3 takes for it as they are
+_COERCERS = ((sql.Boolean, _to_bool, (bool, _NONE)),
+             (sql.Integer, _to_int, (int, bool, _NONE)),
+             (sql.Numeric, _to_float, (float, int, _NONE)),
+             (sql.LargeBinary, _to_blob, (bytes, memoryview, _NONE)),
+             (sql.String, _to_text, (str, _NONE)))
+
+
+def _coerce_column(values, fn, native):
+    types = set(map(type, values))
+    if types <= native:
+        return values
+    if fn is _to_text and types <= set((str, bytes, _NONE)):
+        return [v.decode("utf8", "ignore") if type(v) is bytes else v for v in values]
+    if fn is not _to_text and len(types) == 1 and issubclass(types.pop(), np.generic):
+        # a column of numpy numbers all of one type converts in one go
+        return np.array(values).tolist()
+    return [fn(v) for v in values]
+
+
+def _rows_coercer(tbl, keys=None):
+    """
+    a function that turns a list of dicts of the values of the columns of
+    `tbl` (or of its columns `keys`) into a list of tuples of those values
+    in column order, converted to the types of the columns (e.g. numpy
+    numbers to python ones and bytes to text) so that sqlite3 takes them.
+    missing values are NULL. a column is only converted if it holds values
+    of other types.
+    """
+    cols = []
+    for c in tbl.c:
+        if keys is not None and c.key not in keys:
+            continue
+        fn, native = next(((f, set(n)) for kind, f, n in _COERCERS
+                           if isinstance(c.type, kind)), (None, None))
+        cols.append((c.key, fn, native))
+
+    def coerce(rows):
+        columns = []
+        for key, fn, native in cols:
+            values = [r.get(key) for r in rows]
+            if fn is not None:
+                values = _coerce_column(values, fn, native)
+            columns.append(values)
+        return list(zip(*columns))
+    return coerce
+
+
+def _insert_statement(tbl, keys=None):
+    """ the insert of the values of the columns (`keys`) of tbl, in column order """
+    cols = [c for c in _get_cols(tbl) if keys is None or c in keys]
+    return 'INSERT INTO %s (%s) VALUES (%s)' % (
+        tbl.name, ", ".join('"%s"' % c for c in cols), ", ".join("?" * len(cols)))
+
+
 def insert_variation(session, metadata, buffer):
     """
     Populate the variants table with each variant in the buffer.
@@ -437,36 +526,11 @@ def insert_variation(session, metadata, buffer):
     left = set(buffer[0].keys()) - set(cols)
     assert len(left) == 0, left
 
-    try:
-        session.execute(tbl.insert(), buffer)
-        session.commit()
-    except:
-        try:
-            session.rollback()
-        except sql.exc.OperationalError:
-            pass
-
-        for b in buffer:
-            for k, v in b.items():
-                if isinstance(v, str):
-                    b[k] = v.decode('utf8', 'ignore')
-        try:
-            session.execute(tbl.insert(), buffer)
-            session.commit()
-        except:
-            sys.stderr.write("insert error trying 1 at a time:\n")
-            try:
-                session.rollback()
-            except sql.exc.OperationalError:
-                pass
-
-
-            stmt = tbl.insert()
-
-            with session.bind.begin() as trans:
-                for b in buffer:
-                    trans.execute(stmt, b)
-            #raise
+    # the values are coerced to the column types up front, so the whole
+    # buffer goes in with one executemany of the prepared insert.
+    cursor = session.connection().connection.cursor()
+    cursor.executemany(_insert_statement(tbl), _rows_coercer(tbl)(buffer))
+    session.commit()
 
 
 def insert_variation_impacts(session, metadata, buffer):
@@ -553,6 +617,119 @@ def close_and_commit(session):
     session.commit()
     session.close()
 
+# pragmas of the connection of a BulkLoader: nothing is synced to disk until
+# the end (a database whose load failed is thrown away anyway), and the pages
+# and the sorts of the index creation stay in memory.
+LOAD_PRAGMAS = ("PRAGMA synchronous = OFF",
+                "PRAGMA journal_mode = MEMORY",
+                "PRAGMA locking_mode = EXCLUSIVE",
+                "PRAGMA cache_size = -262144",
+                "PRAGMA temp_store = MEMORY")
+
+
+class BulkLoader(object):
+    """
+    load the rows of the tables of a database made by create_tables, with
+    no indexes yet: through a single sqlite3 connection (LOAD_PRAGMAS) in a
+    single transaction, with the values of each row coerced to the column
+    types up front and inserted by executemany of a prepared statement.
+    finish() builds the indexes and commits. see bulk_load().
+    """
+
+    def __init__(self, path, metadata):
+        self.metadata = metadata
+        self.conn = sqlite3.connect(sqlalchemy.engine.url.make_url(get_path(path)).database,
+                                    isolation_level=None)
+        self.conn.text_factory = str
+        for pragma in LOAD_PRAGMAS:
+            self.conn.execute(pragma)
+        self.conn.execute("BEGIN")
+        self.rows = {}
+        self.seconds = {}
+        self._inserts = {}
+
+    def insert(self, table, rows):
+        """
+        insert `rows`, dicts (or an iterable of them) of the values of the
+        columns of `table`, BUFFER_SIZE at a time.
+        """
+        if table not in self._inserts:
+            tbl = self.metadata.tables[table]
+            self._inserts[table] = (_insert_statement(tbl), _rows_coercer(tbl))
+            self.rows[table], self.seconds[table] = 0, 0.0
+        statement, coerce = self._inserts[table]
+        rows = iter(rows)
+        t0 = time.time()
+        while True:
+            batch = list(itertools.islice(rows, BUFFER_SIZE))
+            if not batch:
+                break
+            self.rows[table] += self.conn.executemany(statement, coerce(batch)).rowcount
+        self.seconds[table] += time.time() - t0
+
+    def finish(self, indexes=create_indices, threads=1):
+        """
+        build the indexes with indexes(cursor) and commit the rows with
+        them, so that nothing is committed if an index can't be built. with
+        threads > 1, sqlite sorts the rows of each index with that many
+        threads: the indexes themselves are built one after the other, as
+        only one connection can write to a database at a time.
+        """
+        for table in sorted(self.rows):
+            n, seconds = self.rows[table], self.seconds[table]
+            sys.stderr.write("loaded %d rows into %s in %.1f seconds (%d rows/sec)\n"
+                             % (n, table, seconds, n / seconds if seconds else 0))
+        if indexes is not None:
+            t0 = time.time()
+            self.conn.execute("PRAGMA threads = %d" % threads)
+            indexes(self.conn.cursor())
+            sys.stderr.write("built the indexes in %.1f seconds\n" % (time.time() - t0))
+        self.conn.execute("COMMIT")
+        self.conn.close()
+
+
+@contextlib.contextmanager
+def bulk_load(path, metadata, indexes=create_indices, threads=1):
+    """
+    load a database made by create_tables(path) and create_sample_table
+    (create_indices indexes the samples too) with a BulkLoader. the rows
+    are only committed, with the indexes, if the block and the indexes
+    succeed.
+
+    >>> import argparse, os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "bulk.db")
+    >>> session, metadata = create_tables(path)
+    >>> create_sample_table(None, metadata, argparse.Namespace(ped_file=None))
+    >>> with bulk_load(path, metadata) as loader:
+    ...     loader.insert("samples", [{"sample_id": 1, "name": "S1"}])
+    ...     loader.insert("variants", ({"variant_id": i, "chrom": "chr1", "start": i * 10,
+    ...                                 "end": i * 10 + 1} for i in range(1, 4)))
+    >>> conn = sqlite3.connect(path)
+    >>> conn.execute("SELECT count(*), max(start) FROM variants").fetchone()
+    (3, 30)
+    >>> conn.execute("SELECT count(*) FROM sqlite_master WHERE name = 'var_chr_start_idx'").fetchone()
+    (1,)
+
+    nothing is loaded when an index fails:
+
+    >>> def bad_index(cursor):
+    ...     cursor.execute("CREATE INDEX bad_idx ON no_such_table(x)")
+    >>> with bulk_load(path, metadata, indexes=bad_index) as loader:
+    ...     loader.insert("variants", [{"variant_id": 4, "chrom": "chr2", "start": 5, "end": 6}])
+    Traceback (most recent call last):
+    ...
+    sqlite3.OperationalError: no such table: main.no_such_table
+    >>> conn.execute("SELECT count(*) FROM variants").fetchone()
+    (3,)
+    """
+    loader = BulkLoader(path, metadata)
+    try:
+        yield loader
+        loader.finish(indexes, threads)
+    finally:
+        loader.conn.close()
+
+
 def empty_tables(cursor):
     cursor.execute('''delete * from variation''')
     cursor.execute('''delete * from samples''')
@@ -568,17 +745,180 @@ def update_gene_summary_w_cancer_census(session, metadata, genes):
     session.execute(stmt, [dict(zip(cols, g)) for g in genes])
 
 
-def get_session_metadata(path):
-    """return an engine"""
-    engine = sqlalchemy.create_engine(get_path(path), isolation_level=None)
-    engine.connect().connection.connection.text_factory = str
-    engine.raw_connection().connection.text_factory = str
+# how databases are opened for reading (GeminiQuery and the tools that only
+# query). the defaults can be overridden in the sqlite_read section of
+# gemini-config.yaml, e.g. `immutable: true` for databases nobody writes to.
+READ_PROFILE = dict(
+    read_only=True,          # open the file with mode=ro
+    immutable=False,         # immutable=1: no locking or change detection
+    mmap_size=256 * 1024 ** 2,
+    cache_size=-64 * 1024,   # negative: KiB
+    temp_store="MEMORY",
+    query_only=True,
+)
+
+_read_profile = None
+
+
+def get_read_profile():
+    """ READ_PROFILE updated with the sqlite_read section of the config file """
+    global _read_profile
+    if _read_profile is None:
+        from .config import read_config_section
+        _read_profile = read_config_section("sqlite_read", READ_PROFILE)
+    return _read_profile
+
+
+def _read_only_engine(url):
+    """
+    an engine for reading the sqlite file of `url` as configured by
+    get_read_profile().
+    """
+    profile = get_read_profile()
+    path = sqlalchemy.engine.url.make_url(url).database
+    pragmas = ["PRAGMA mmap_size = %d" % int(profile["mmap_size"]),
+               "PRAGMA cache_size = %d" % int(profile["cache_size"]),
+               "PRAGMA temp_store = %s" % profile["temp_store"],
+               "PRAGMA query_only = %d" % bool(profile["query_only"])]
+    kwargs = {}
+    if profile["read_only"] and sys.version_info[0] >= 3:
+        from urllib.request import pathname2url
+        uri = "file:%s?mode=ro" % pathname2url(os.path.abspath(path))
+        if profile["immutable"]:
+            uri += "&immutable=1"
+        kwargs["creator"] = lambda: sqlite3.connect(uri, uri=True)
+    engine = sqlalchemy.create_engine(url, isolation_level=None, **kwargs)
+
+    @sql.event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        # query_only last, as it forbids creating the view and setting
+        # temp_store drops it
+        for pragma in pragmas[:-1]:
+            cursor.execute(pragma)
+        if _variant_range is not None:
+            cursor.execute("CREATE TEMP VIEW variants AS SELECT * FROM main.variants "
+                           "WHERE variant_id >= %d AND variant_id < %d" % _variant_range)
+        cursor.execute(pragmas[-1])
+        cursor.close()
+
+    return engine
+
+
+# the variant_ids [lo, hi) read-only connections see, see restrict_variants
+_variant_range = None
+
+
+def variants_extent(conn):
+    """
+    the number of variants of the database of `conn` and their largest
+    variant_id. these are of the whole table, also in a worker of
+    parallel.imap, whose variants view only has its range.
+    """
+    n, max_vid = conn.execute(sql.text("SELECT count(*), max(variant_id) "
+                                       "FROM main.variants")).fetchone()
+    return int(n), int(max_vid or 0)
+
+
+def restrict_variants(lo, hi):
+    """
+    make the variants table of the read-only connections this process opens
+    from now on hold only the variants with lo <= variant_id < hi (the range
+    of a worker of parallel.imap).
+    """
+    global _variant_range
+    _variant_range = (int(lo), int(hi))
+
+
+# the engine and reflected metadata of each database opened by this process,
+# keyed by url and access mode, so that the GeminiQuery instances and
+# helpers of a command don't each reflect the schema again. an entry is
+# replaced when the file or its schema changes.
+_CACHE = {}
+
+
+class _CacheEntry(object):
+
+    def __init__(self, engine, metadata, state):
+        self.engine = engine
+        self.metadata = metadata
+        self.state = state
+        # values derived from the database by callers, see cached()
+        self.values = {}
+
+
+def _set_text_factory(dbapi_conn, connection_record):
+    dbapi_conn.text_factory = str
+
+
+def _db_file(url):
+    """ the file of a sqlite url, if it exists """
+    url = sqlalchemy.engine.url.make_url(url)
+    if url.get_backend_name() == "sqlite" and url.database and os.path.exists(url.database):
+        return url.database
+    return None
+
+
+def _state(engine):
+    """
+    the mtime and size of a sqlite database file and its schema version, or
+    None for databases that aren't (yet) a file and are not cached.
+    """
+    path = _db_file(engine.url)
+    if path is None:
+        return None
+    st = os.stat(path)
+    version = engine.execute("PRAGMA schema_version").scalar()
+    return (st.st_mtime, st.st_size, version)
+
+
+def _get_cache_entry(path, read_only=False):
+    url = get_path(path)
+    # only existing sqlite files are opened with the read profile
+    read_only = read_only and _db_file(url) is not None
+    key = (url, read_only)
+    entry = _CACHE.get(key)
+    if entry is not None and _state(entry.engine) == entry.state:
+        return entry
+    if read_only:
+        engine = _read_only_engine(url)
+    else:
+        engine = sqlalchemy.create_engine(url, isolation_level=None)
+    sql.event.listen(engine, "connect", _set_text_factory)
+    # taken before reflecting, so a change made meanwhile invalidates the entry
+    state = _state(engine)
     metadata = sql.MetaData(bind=engine)
     metadata.reflect(bind=engine)
-    session = create_session(bind=engine, autocommit=False, autoflush=False)
-    session.bind.connect().connection.connection.text_factory = str
-    session.bind.raw_connection().connection.text_factory = str
-    return session, metadata
+    entry = _CacheEntry(engine, metadata, state)
+    if state is None:
+        _CACHE.pop(key, None)
+    else:
+        _CACHE[key] = entry
+    return entry
+
+
+def cached(path, key, compute, read_only=False):
+    """
+    the value of compute(metadata) for the database at `path`, computed once
+    per version of the database (e.g. the sample maps of GeminiQuery). the
+    value is shared and must not be modified.
+    """
+    entry = _get_cache_entry(path, read_only)
+    if key not in entry.values:
+        entry.values[key] = compute(entry.metadata)
+    return entry.values[key]
+
+
+def get_session_metadata(path, read_only=False):
+    """
+    return a new session and the reflected metadata of the database at
+    `path`. the engine and metadata are cached until the database changes.
+    with read_only, the database is opened as configured by
+    get_read_profile() and can't be written to.
+    """
+    entry = _get_cache_entry(path, read_only)
+    session = create_session(bind=entry.engine, autocommit=False, autoflush=False)
+    return session, entry.metadata
 
 
 @contextlib.contextmanager
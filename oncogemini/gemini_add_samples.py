@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""
+Add the samples of a VCF (e.g. a new biopsy of a patient) to an existing
+database in one pass, without reloading it:
+
+    - the values of the new samples are appended to the genotype blobs of
+      every variant. blocked typed blobs (see migrate-blobs) keep all their
+      compressed blocks but the last.
+    - num_hom_ref, num_het, num_hom_alt, num_unknown, aaf and call_rate are
+      updated from the genotypes of the new samples.
+    - variants of the VCF that are not in the database are added with the
+      fields of the VCF and unknown genotypes for the samples already
+      loaded. they are not annotated.
+    - the samples are added to the samples table (from the ped file) and to
+      the #CHROM line of vcf_header.
+
+Samples of the VCF that are already in the database are ignored, and no
+other data is rewritten.
+"""
+from __future__ import absolute_import, print_function
+
+import collections
+import itertools
+import sys
+import time
+
+import numpy as np
+import sqlalchemy as sql
+
+from . import compression as Z
+from . import database
+from . import gemini_utils as util
+from .gemini_amend import add_columns
+from .gemini_constants import BUFFER_SIZE, HOM_REF, HET, HOM_ALT, UNKNOWN
+from .gemini_migrate_blobs import BLOCK_SIZE
+from .ped import get_ped_fields, load_ped_file
+
+COUNT_COLS = ["num_hom_ref", "num_het", "num_hom_alt", "num_unknown"]
+
+
+def _copy_numbers(v):
+    try:
+        cn = v.format("CN")
+    except KeyError:
+        # no CN in the header
+        cn = None
+    if cn is None:
+        return np.full(len(v.gt_types), -1, dtype=np.float32)
+    return cn[:, 0].astype(np.float32)
+
+
+# the values of the samples of a (cyvcf2) variant for each gt column, and the
+# value of a sample without a call
+GT_COLUMNS = {
+    "gts": (lambda v: v.gt_bases, "./."),
+    "gt_types": (lambda v: v.gt_types, UNKNOWN),
+    "gt_phases": (lambda v: v.gt_phases, False),
+    "gt_depths": (lambda v: v.gt_depths, -1),
+    "gt_ref_depths": (lambda v: v.gt_ref_depths, -1),
+    "gt_alt_depths": (lambda v: v.gt_alt_depths, -1),
+    "gt_alt_freqs": (lambda v: v.gt_alt_freqs, -1),
+    "gt_quals": (lambda v: v.gt_quals, -1),
+    "gt_copy_numbers": (_copy_numbers, -1),
+    "gt_phred_ll_homref": (lambda v: v.gt_phred_ll_homref, -1),
+    "gt_phred_ll_het": (lambda v: v.gt_phred_ll_het, -1),
+    "gt_phred_ll_homalt": (lambda v: v.gt_phred_ll_homalt, -1),
+}
+
+
+def _fill(n, fill, like):
+    """ n values without a call, in the dtype of the array `like` """
+    if like.dtype.kind in "SU":
+        return np.full(n, fill, dtype=np.result_type(like.dtype, np.array([fill]).dtype))
+    return np.full(n, fill, dtype=like.dtype)
+
+
+def _sample_values(v, cols, n):
+    """ the values of the n (new) samples of variant v for each of `cols` """
+    out = {}
+    for c in cols:
+        get, fill = GT_COLUMNS[c]
+        values = np.asarray(get(v))
+        if values.shape != (n,):
+            # e.g. no PL for the gt_phred_ll columns
+            values = np.full(n, fill)
+        out[c] = values
+    return out
+
+
+def _blob_dtypes(conn, gt_cols, unpack):
+    """
+    the dtypes of the (non-string) genotype blobs of the first variant, in
+    which the values of new variants are stored.
+    """
+    row = conn.execute("SELECT %s FROM variants LIMIT 1" % ", ".join(gt_cols)).fetchone()
+    dtypes = {}
+    for c in gt_cols if row is not None else ():
+        arr = unpack(row[c]) if row[c] is not None else None
+        if arr is not None and arr.dtype.kind not in "SUO":
+            dtypes[c] = arr.dtype
+    return dtypes
+
+
+def _aggregates(hom_ref, het, hom_alt, unknown):
+    """ the genotype counts, aaf and call_rate as computed by the loader """
+    called = hom_ref + het + hom_alt
+    return dict(num_hom_ref=hom_ref, num_het=het, num_hom_alt=hom_alt,
+                num_unknown=unknown,
+                aaf=(het + 2.0 * hom_alt) / (2.0 * called) if called else 0.0,
+                call_rate=float(called) / (called + unknown) if called + unknown else 0.0)
+
+
+def _counts(gt_types):
+    c = np.bincount(np.asarray(gt_types, dtype=np.intp), minlength=4)
+    return int(c[HOM_REF]), int(c[HET]), int(c[HOM_ALT]), int(c[UNKNOWN])
+
+
+def _packer(features):
+    """ the encoder of the genotype blobs of a database with `features` """
+    for f in features:
+        if f.startswith(Z.TYPED_FEATURE + ":"):
+            codec = f.split(":", 1)[1]
+            return lambda a: Z.pack_typed_blob(a, codec, BLOCK_SIZE)
+    if "snappy_compression" in features:
+        return Z.snappy_pack_blob
+    return Z.pack_blob
+
+
+def _info_value(v):
+    if isinstance(v, (tuple, list)):
+        return ",".join(str(x) for x in v)
+    return v
+
+
+class _Variants(object):
+    """
+    the variants table of the database being added to: appends the values
+    of the new samples to existing rows and inserts the new variants.
+    """
+
+    def __init__(self, conn, metadata, n_old, n_new):
+        self.conn = conn
+        self.tbl = metadata.tables["variants"]
+        self.columns = set(c.name for c in self.tbl.columns)
+        self.n_old, self.n_new = n_old, n_new
+        self.gt_cols = util.get_gt_cols(metadata)
+        unknown = [c for c in self.gt_cols if c not in GT_COLUMNS]
+        if unknown:
+            raise ValueError("add-samples can't fill the genotype columns %s"
+                             % ", ".join(unknown))
+        features = util.get_features(metadata)
+        self.unpack = Z.get_unpacker(features)
+        self.pack = _packer(features)
+        self.dtypes = _blob_dtypes(conn, self.gt_cols, self.unpack)
+
+        self.select = "SELECT variant_id, %s, %s FROM variants WHERE variant_id IN (%%s)" \
+            % (", ".join(COUNT_COLS), ", ".join(self.gt_cols))
+        cols = COUNT_COLS + ["aaf", "call_rate"] + self.gt_cols
+        self.update = sql.text("UPDATE variants SET %s WHERE variant_id = :key_"
+                               % ", ".join("%s = :%s" % (c, c) for c in cols))
+
+        self.keys = {}
+        for vid, chrom, start, ref, alt in conn.execute(
+                "SELECT variant_id, chrom, start, ref, alt FROM variants"):
+            self.keys[(chrom, start, ref, alt)] = vid
+        self.next_id = max(self.keys.values() or [0]) + 1
+        # the variants that have no values for the new samples yet
+        self.todo = set(self.keys.values())
+        self.updated = self.inserted = 0
+
+    def add(self, variants):
+        """ add the values of the new samples of a batch of cyvcf2 variants """
+        values, rows = {}, []
+        for v in variants:
+            key = (v.CHROM, v.start, v.REF, ",".join(v.ALT))
+            vid = self.keys.get(key)
+            if vid is None:
+                rows.append(self._new_row(v))
+            elif vid in self.todo:
+                self.todo.discard(vid)
+                values[vid] = _sample_values(v, self.gt_cols, self.n_new)
+        if values:
+            self._append(values)
+        if rows:
+            # a new row only has the columns it sets, so that the others
+            # get their defaults (e.g. is_somatic_<patient> 0): the rows
+            # that set the same columns are inserted together, coerced to
+            # the column types as by the loader.
+            groups = collections.OrderedDict()
+            for row in rows:
+                groups.setdefault(frozenset(row), []).append(row)
+            cursor = self.conn.connection.cursor()
+            for keys, group in groups.items():
+                cursor.executemany(database._insert_statement(self.tbl, keys),
+                                   database._rows_coercer(self.tbl, keys)(group))
+            self.inserted += len(rows)
+
+    def fill(self):
+        """
+        append unknown values for the new samples to the variants that
+        aren't in the VCF.
+        """
+        fills = {c: np.array([GT_COLUMNS[c][1]] * self.n_new) for c in self.gt_cols}
+        vids = sorted(self.todo)
+        self.todo = set()
+        for i in range(0, len(vids), BUFFER_SIZE):
+            self._append(dict((vid, fills) for vid in vids[i:i + BUFFER_SIZE]))
+
+    def _append(self, values):
+        res = self.conn.execute(self.select % ", ".join(str(vid) for vid in values))
+        params = []
+        for row in res:
+            new = values[row["variant_id"]]
+            p = {c: Z.append_blob(row[c], new[c], self.unpack, self.pack, BLOCK_SIZE)
+                 for c in self.gt_cols}
+            counts = [row[c] or 0 for c in COUNT_COLS]
+            if "gt_types" in new:
+                counts = [a + b for a, b in zip(counts, _counts(new["gt_types"]))]
+            else:
+                # no genotypes to count: the new samples are unknown
+                counts[-1] += self.n_new
+            p.update(_aggregates(*counts))
+            p["key_"] = row["variant_id"]
+            params.append(p)
+        self.conn.execute(self.update, params)
+        self.updated += len(params)
+
+    def _new_row(self, v):
+        new = _sample_values(v, self.gt_cols, self.n_new)
+        row = {}
+        for name, value in v.INFO:
+            if name in self.columns:
+                row[name] = _info_value(value)
+            elif name.lower() in self.columns:
+                row[name.lower()] = _info_value(value)
+        row.update(chrom=v.CHROM, start=v.start, end=v.end, vcf_id=v.ID,
+                   variant_id=self.next_id, ref=v.REF, alt=",".join(v.ALT),
+                   qual=v.QUAL, filter=v.FILTER, type=v.var_type,
+                   sub_type=v.var_subtype, info=Z.pack_blob(dict(v.INFO)))
+        for c in self.gt_cols:
+            if c in self.dtypes:
+                # e.g. gt_alt_freqs is float64 from cyvcf2, float32 in the blobs
+                new[c] = new[c].astype(self.dtypes[c])
+            fill = _fill(self.n_old, GT_COLUMNS[c][1], new[c])
+            row[c] = self.pack(np.concatenate([fill, new[c]]))
+        gt_types = new.get("gt_types", np.full(self.n_new, UNKNOWN))
+        hom_ref, het, hom_alt, unknown = _counts(gt_types)
+        row.update(_aggregates(hom_ref, het, hom_alt, unknown + self.n_old))
+        self.keys[(v.CHROM, v.start, v.REF, row["alt"])] = self.next_id
+        self.next_id += 1
+        return row
+
+
+def _add_to_samples(conn, ped_file, names, first_id):
+    """ add the samples `names` from the ped file, numbered from first_id """
+    header = get_ped_fields(ped_file)
+    ped = load_ped_file(ped_file)
+    add_columns(header, conn)
+    insert = sql.text("INSERT INTO samples (sample_id, %s) VALUES (:sample_id_, %s)"
+                      % (", ".join(header), ", ".join(":%s" % h for h in header)))
+    for i, name in enumerate(names):
+        p = dict(zip(header, ped[name]))
+        for h in header:
+            p.setdefault(h, None)
+        p["sample_id_"] = first_id + i
+        conn.execute(insert, p)
+
+
+def _add_to_header(conn, names):
+    res = conn.execute("SELECT rowid, vcf_header FROM vcf_header").fetchall()
+    for rowid, header in res:
+        lines = header.split("\n")
+        for i, line in enumerate(lines):
+            if line.startswith("#CHROM"):
+                lines[i] = "\t".join([line] + list(names))
+        conn.execute(sql.text("UPDATE vcf_header SET vcf_header = :h WHERE rowid = :r"),
+                     h="\n".join(lines), r=rowid)
+
+
+def add(db, vcf_file, ped_file):
+    from cyvcf2 import VCF
+
+    _, metadata = database.get_session_metadata(db)
+    if "sample_genotypes" in metadata.tables:
+        raise ValueError("add-samples can't update the sample_genotypes table of %s" % db)
+    vcf = VCF(vcf_file, gts012=False)
+    ped = load_ped_file(ped_file)
+
+    t0 = time.time()
+    # a single transaction so a failure leaves the database as it was
+    with database.database_transaction(db) as conn:
+        samples = dict(conn.execute("SELECT name, sample_id FROM samples").fetchall())
+        # the genotypes of a sample are at index sample_id - 1 of the blobs
+        if sorted(samples.values()) != list(range(1, len(samples) + 1)):
+            raise ValueError("the sample_ids of %s are not 1..%d" % (db, len(samples)))
+        names = [s for s in vcf.samples if s not in samples]
+        if not names:
+            raise ValueError("%s has no samples that are not in %s" % (vcf_file, db))
+        missing = [s for s in names if s not in ped]
+        if missing:
+            raise ValueError("samples not in %s: %s" % (ped_file, ", ".join(missing)))
+        vcf.set_samples(names)
+
+        variants = _Variants(conn, metadata, len(samples), len(names))
+        records = iter(vcf)
+        while True:
+            batch = list(itertools.islice(records, BUFFER_SIZE))
+            if not batch:
+                break
+            variants.add(batch)
+            sys.stderr.write("added the samples to %d variants\r"
+                             % (variants.updated + variants.inserted))
+        variants.fill()
+
+        _add_to_samples(conn, ped_file, names, len(samples) + 1)
+        if "vcf_header" in metadata.tables:
+            _add_to_header(conn, names)
+    sys.stderr.write("\nadded %d samples to %d variants (%d of them new) in %.1f seconds\n"
+                     % (len(names), variants.updated + variants.inserted,
+                        variants.inserted, time.time() - t0))
+
+
+def add_samples(parser, args):
+    add(args.db, args.vcf, args.ped)
@@ -17,7 +17,7 @@ def get_table_info(metadata, table_name, out_template):
 
 def db_info(parser, args):
 
-    conn, metadata = database.get_session_metadata(args.db)
+    conn, metadata = database.get_session_metadata(args.db, read_only=True)
     # column widths for the output
     out_template = "{0:20}{1:30}{2:10}"
 
@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 from __future__ import absolute_import
+import sys
+
 from . import compression as Z
 
 from . import database
 from . import gemini_utils as util
+from . import parallel
+from . import writer
 from .GeminiQuery import GeminiQuery
 import sqlalchemy as sql
 
@@ -31,47 +35,76 @@ def get_variants(conn, metadata, args):
                                   non_gt_idxs))
 
 
-def get_genotypes(conn, metadata, args):
-    """For each variant, report each sample's genotype
-       on a separate line.
-    """
-    idx_to_sample = util.map_indices_to_samples(metadata)
-
-    query = "SELECT  v.chrom, v.start, v.end, \
-                     v.ref, v.alt, \
-                     v.type, v.sub_type, \
-                     v.aaf, v.in_dbsnp, v.gene, \
-                     v.gts \
-             FROM    variants v \
-             ORDER BY chrom, start"
-    res = conn.execute(sql.text(query))
+# the variant columns of dump --genotypes, as far as the database has them
+GENOTYPE_COLUMNS = ["chrom", "start", "end", "ref", "alt", "type", "sub_type",
+                    "aaf", "in_dbsnp", "gene"]
 
-    # build a list of all the column indices that are NOT
-    # gt_* columns.  These will be the columns reported
-    (col_names, non_gt_idxs) = \
-        util.get_col_names_and_indices(metadata.tables["variants"], ignore_gt_cols=True)
-    col_names.append('sample')
-    col_names.append('genotype')
 
-    if args.use_header:
-        print(args.separator.join(col for col in col_names))
+def _genotype_lines(db, columns, gt_cols, samples, args, chrom=None):
+    """
+    the lines of each variant of `db` (on `chrom`) for dump --genotypes:
+    its columns are joined once and put in front of the line of each
+    sample (long layout) or of all samples (wide layout).
+    """
+    conn, metadata = database.get_session_metadata(db, read_only=True)
+    unpack = Z.get_unpacker(util.get_features(metadata))
+    query = "SELECT %s FROM variants %s ORDER BY chrom, start" % (
+        ", ".join('"%s"' % c for c in columns + gt_cols),
+        "" if chrom is None else "WHERE chrom = :chrom")
+    sep = args.separator
+    n = len(columns)
+    try:
+        for row in conn.execute(sql.text(query), {"chrom": chrom}):
+            prefix = sep.join(str(v) for v in row[:n])
+            values = [writer.strings(unpack(blob)) for blob in row[n:]]
+            if args.layout == "wide":
+                yield sep.join([prefix] + [sep.join(v) for v in values])
+            else:
+                lead = prefix + sep
+                yield lead + ("\n" + lead).join(map(sep.join, zip(samples, *values)))
+    finally:
+        conn.close()
 
-    unpack = Z.unpack_genotype_blob
-    import zlib
 
+def get_genotypes(conn, metadata, args):
+    """For each variant, report each sample's genotype
+       (and its other --gt-cols) on a separate line, or those
+       of all samples on one line with --layout wide.
+    """
+    samples = util.map_indices_to_samples(metadata)
+    variant_cols = [c.name for c in metadata.tables["variants"].columns]
+    columns = [c for c in GENOTYPE_COLUMNS if c in variant_cols]
+    gt_cols = ["gts"]
+    for col in (args.gt_cols or "").split(","):
+        col = col.strip()
+        if col and col not in gt_cols:
+            if col not in util.get_gt_cols(metadata):
+                raise ValueError("--gt-cols: %s is not a genotype column of %s"
+                                 % (col, args.db))
+            gt_cols.append(col)
 
-    for row in res:
-        try:
-            gts = unpack(row['gts'])
-        except zlib.error:
-            unpack = Z.snappy_unpack_blob
-            gts = unpack(row['gts'])
-
-        for idx, gt in enumerate(gts):
-            # range(len(row)-1) to avoid printing v.gts
-            a = args.separator.join(str(row[i]) for i in range(len(row)-1))
-            b = args.separator.join([idx_to_sample[idx], gt])
-            print(args.separator.join((a, b)))
+    if args.use_header:
+        if args.layout == "wide":
+            names = columns + ["%s.%s" % (c, s) for c in gt_cols for s in samples]
+        else:
+            names = columns + ["sample", "genotype"] + gt_cols[1:]
+        print(args.separator.join(names))
+    sys.stdout.flush()
+
+    # with --cores, the chromosomes are dumped by separate processes
+    chroms = [None]
+    if args.cores > 1:
+        chroms = [r[0] for r in conn.execute(sql.text(
+            "SELECT DISTINCT chrom FROM variants ORDER BY chrom"))]
+    conn.close()
+
+    def work(chrom):
+        return writer.blocks(_genotype_lines(args.db, columns, gt_cols, samples,
+                                             args, chrom))
+
+    for block in parallel.imap_chunks(args.cores, work, chroms):
+        sys.stdout.write(block)
+    sys.stdout.flush()
 
 def get_samples(conn, metadata, args):
     """
@@ -105,7 +138,7 @@ def tfam(args):
 
 def dump(parser, args):
 
-    conn, metadata = database.get_session_metadata(args.db)
+    conn, metadata = database.get_session_metadata(args.db, read_only=True)
 
     if args.variants:
         get_variants(conn, metadata, args)
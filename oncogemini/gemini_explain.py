@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Show how SQLite runs the SQL that GeminiQuery issues for a query (after
+the expansion of the genotype columns and wildcards), report the tables it
+scans in full and suggest, or create, the indexes that avoid those scans
+(see index_advisor). Without a query, list the indexes recorded by the
+index advisor.
+"""
+from __future__ import absolute_import, print_function
+
+from . import database
+from . import index_advisor
+from .GeminiQuery import GeminiQuery
+
+
+def _print_plan(plan):
+    for line in index_advisor.format_plan(plan).split("\n"):
+        print("    " + line)
+
+
+def explain_query(args):
+    gq = GeminiQuery(args.db)
+    query = gq.sql(args.query, args.gt_filter,
+                   show_variant_samples=args.show_variant_samples,
+                   needs_genotypes=bool(args.gt_filter or args.show_variant_samples))
+    cursor = gq.conn.connection().connection.cursor()
+    try:
+        advice = index_advisor.advise(cursor, query)
+    finally:
+        cursor.close()
+        gq.conn.close()
+
+    print("query:\n    " + query)
+    print("plan:")
+    _print_plan(advice.plan)
+    if not advice.scans:
+        print("no full table scans")
+        return
+    print("full table scans: " + ", ".join(advice.scans))
+    found = set(index.table for index in advice.indexes)
+    missing = [t for t in advice.scans if t not in found]
+    if missing:
+        print("no index would avoid scanning: " + ", ".join(missing))
+    if not advice.indexes:
+        return
+    print("suggested indexes:")
+    for index in advice.indexes:
+        print("    %s;" % index.statement)
+    if not args.create_indexes:
+        return
+
+    index_advisor.create(args.db, [index.statement for index in advice.indexes])
+    for index in advice.indexes:
+        print("created index " + index.name)
+    conn, _ = database.get_session_metadata(args.db, read_only=True)
+    try:
+        cursor = conn.connection().connection.cursor()
+        print("plan with the new indexes:")
+        _print_plan(index_advisor.query_plan(cursor, query))
+    finally:
+        conn.close()
+
+
+def explain_recorded(args):
+    recorded = index_advisor.recorded(args.db)
+    if not recorded:
+        print("no indexes recorded by the index advisor")
+        return
+    print("uses\tstatement")
+    for statement, uses in recorded:
+        print("%d\t%s;" % (uses, statement))
+    if not args.create_indexes:
+        return
+    statements = [s for s, uses in recorded if uses >= args.min_uses]
+    index_advisor.create(args.db, statements)
+    print("created %d indexes suggested at least %d times" % (len(statements), args.min_uses))
+
+
+def explain(parser, args):
+    if args.query is None:
+        explain_recorded(args)
+    else:
+        explain_query(args)
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+"""
+A columnar genotype index kept next to the database, used as the
+variant_id_getter of GeminiQuery (see docs/content/genotype_query_engines.rst).
+
+Each indexed gt column is stored as a single (samples x variants) .npy file,
+i.e. sample-major, so that a --gt-filter touching a handful of samples only
+reads (memory-maps) those samples' rows instead of decompressing every blob
+of every variant:
+
+    my.db.gts/
+        index.json          # columns, sample count and database fingerprint
+        variant_ids.npy     # variant_id of each column of the matrices
+        gt_types.npy        # (n_samples x n_variants)
+        gt_depths.npy
+        gt_depths.null.npy  # variants whose blob was NULL, if any
+        gt_types.bits.npy   # (4 x n_samples x n_variants / 64) uint64 bitmaps
+
+When gt_types is indexed, each sample also gets a bitmap of the variants
+for which it has each genotype (HOM_REF, HET, UNKNOWN, HOM_ALT), packed in
+uint64 words. A --sample-filter (--in any/all/none/only, --family-wise) is
+then answered with word-level ORs and ANDs of the bitmaps of the samples it
+names instead of testing the sample names of every row.
+"""
+from __future__ import absolute_import, print_function
+
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+import sqlalchemy as sql
+
+from . import database
+from . import gt_filter as gtf
+from .gemini_constants import BUFFER_SIZE, HET, HOM_ALT
+from .GeminiQuery import GeminiQuery
+
+# variants evaluated at once when answering a filter from the index.
+CHUNK_SIZE = 100000
+
+# the genotype bitmaps (one per gt_types value) and the samples whose
+# bitmaps are combined at once.
+BITMAPS = "gt_types.bits.npy"
+N_GT_TYPES = 4
+SAMPLE_BLOCK = 256
+
+
+def get_index_path(db):
+    return db + ".gts"
+
+
+def default_columns(gt_cols):
+    """
+    numeric columns with one value per sample. gts holds strings and the
+    gt_phred_ll_* columns hold several values per sample (or NULL).
+    """
+    return [c for c in gt_cols if c != "gts" and not c.startswith("gt_phred_ll")]
+
+
+def _fingerprint(conn):
+    return list(database.variants_extent(conn))
+
+
+def _pack(mask, n_words):
+    """
+    the bits of a boolean array in uint64 words, bit i of the array in bit
+    i % 64 of word i // 64.
+
+    >>> _pack(np.array([True, False, True] + [False] * 62 + [True]), 2).tolist()
+    [5, 2]
+    """
+    # packbits is big-endian within a byte, so reverse each byte's bits.
+    bits = np.zeros(n_words * 64, dtype=bool)
+    bits[:len(mask)] = mask
+    return np.packbits(bits.reshape(-1, 8)[:, ::-1]).view("<u8")
+
+
+def _unpack(words, n):
+    """
+    the first n bits of `words` as a boolean array (the inverse of _pack)
+
+    >>> _unpack(_pack(np.array([True, False, True]), 1), 3).tolist()
+    [True, False, True]
+    """
+    words = np.ascontiguousarray(words, dtype="<u8")
+    bits = np.unpackbits(words.view(np.uint8)).reshape(-1, 8)[:, ::-1]
+    return bits.ravel()[:n].astype(bool)
+
+
+def _write_bitmaps(path, gt_types):
+    """ the bitmaps of the variants with each genotype of each sample """
+    n_samples, n_variants = gt_types.shape
+    n_words = (n_variants + 63) // 64
+    bits = np.lib.format.open_memmap(path, mode="w+", dtype="<u8",
+                                     shape=(N_GT_TYPES, n_samples, n_words))
+    # a sample (a contiguous row of the matrix) at a time
+    for i in range(n_samples):
+        row = np.asarray(gt_types[i])
+        for gt in range(N_GT_TYPES):
+            bits[gt, i] = _pack(row == gt, n_words)
+    bits.flush()
+
+
+def create(db, cols=None):
+    """
+    (Re)build the index for `cols` (default: all numeric gt columns). The
+    index is written to a temporary directory and moved into place when done.
+    """
+    gq = GeminiQuery(db)
+    conn, unpacker = gq.conn, gq.unpacker
+    if cols is None:
+        cols = default_columns(gq.gt_cols)
+    for c in cols:
+        if c not in gq.gt_cols:
+            raise ValueError("%s is not a genotype column in %s" % (c, db))
+
+    fingerprint = _fingerprint(conn)
+    n_variants = fingerprint[0]
+    n_samples = len(gq.sample_to_idx)
+
+    path = get_index_path(db)
+    tmp = "%s.tmp-%d" % (path, os.getpid())
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    t0 = time.time()
+    res = conn.execute(sql.text("SELECT variant_id, %s FROM variants ORDER BY variant_id"
+                                % ", ".join(cols)))
+    vids = np.lib.format.open_memmap(os.path.join(tmp, "variant_ids.npy"), mode="w+",
+                                     dtype=np.int64, shape=(n_variants,))
+    mats, nulls = {}, {}
+    start = 0
+    while True:
+        rows = res.fetchmany(BUFFER_SIZE)
+        if not rows:
+            break
+        stop = start + len(rows)
+        vids[start:stop] = [r[0] for r in rows]
+        for j, col in enumerate(cols, start=1):
+            arrays = [unpacker(r[j]) for r in rows]
+            missing = [i for i, a in enumerate(arrays) if a is None]
+            if missing:
+                nulls.setdefault(col, []).extend(start + i for i in missing)
+                fill = next((a for a in arrays if a is not None), None)
+                if fill is None:
+                    continue
+                arrays = [fill if a is None else a for a in arrays]
+            block = np.vstack(arrays)
+            if col not in mats:
+                mats[col] = np.lib.format.open_memmap(os.path.join(tmp, col + ".npy"),
+                                                      mode="w+", dtype=block.dtype,
+                                                      shape=(n_samples, n_variants))
+            mats[col][:, start:stop] = block.T
+        start = stop
+        sys.stderr.write("indexed %d of %d variants\r" % (stop, n_variants))
+
+    for col, missing in nulls.items():
+        mask = np.zeros(n_variants, dtype=bool)
+        mask[missing] = True
+        np.save(os.path.join(tmp, col + ".null.npy"), mask)
+    for m in list(mats.values()) + [vids]:
+        m.flush()
+    if "gt_types" in mats:
+        _write_bitmaps(os.path.join(tmp, BITMAPS), mats["gt_types"])
+    del mats, vids
+
+    with open(os.path.join(tmp, "index.json"), "w") as fh:
+        json.dump(dict(columns=[c for c in cols if os.path.exists(os.path.join(tmp, c + ".npy"))],
+                       n_samples=n_samples, fingerprint=fingerprint,
+                       nulls=sorted(nulls),
+                       bitmaps=os.path.exists(os.path.join(tmp, BITMAPS))), fh)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+    conn.close()
+    sys.stderr.write("\nindexed %d variants in %.1f seconds\n" % (n_variants, time.time() - t0))
+
+
+class GtIndex(object):
+    """ read side of the index; columns are memory-mapped on first use. """
+
+    def __init__(self, db):
+        self.path = get_index_path(db)
+        with open(os.path.join(self.path, "index.json")) as fh:
+            self.meta = json.load(fh)
+        self.columns = set(self.meta["columns"])
+        self._mats = {}
+
+    def is_current(self, db):
+        conn, _ = database.get_session_metadata(db, read_only=True)
+        try:
+            # add-samples changes the samples but not the variants
+            n_samples = conn.execute(sql.text("SELECT count(*) FROM samples")).scalar()
+            return (_fingerprint(conn) == self.meta["fingerprint"]
+                    and n_samples == self.meta["n_samples"])
+        finally:
+            conn.close()
+
+    def variant_ids(self):
+        return np.load(os.path.join(self.path, "variant_ids.npy"), mmap_mode="r")
+
+    def matrix(self, column):
+        if column not in self._mats:
+            self._mats[column] = np.load(os.path.join(self.path, column + ".npy"),
+                                         mmap_mode="r")
+        return self._mats[column]
+
+    def bitmaps(self):
+        """ the (gt_types x samples x words) bitmaps, None if not indexed """
+        if not self.meta.get("bitmaps") or "gt_types" in self.meta["nulls"]:
+            return None
+        if BITMAPS not in self._mats:
+            self._mats[BITMAPS] = np.load(os.path.join(self.path, BITMAPS), mmap_mode="r")
+        return self._mats[BITMAPS]
+
+    def nulls(self, columns):
+        """ mask of the variants with a NULL blob in any of `columns` """
+        mask = None
+        for col in set(columns) & set(self.meta["nulls"]):
+            m = np.load(os.path.join(self.path, col + ".null.npy"))
+            mask = m if mask is None else mask | m
+        return mask
+
+
+class IndexSource(object):
+    """
+    gt_filter source over the variants [start, stop) of the index. Only the
+    sample rows a node asks for are read from the memory-mapped matrices.
+    """
+
+    def __init__(self, index, start, stop, rows=None):
+        self.index = index
+        self.start, self.stop = start, stop
+        self.rows = rows
+        self.n = stop - start if rows is None else len(rows)
+
+    def take(self, column, indices):
+        block = self.index.matrix(column)[indices, self.start:self.stop].T
+        if self.rows is not None:
+            block = block[self.rows]
+        return block
+
+    def subset(self, rows):
+        if self.rows is not None:
+            rows = self.rows[rows]
+        return IndexSource(self.index, self.start, self.stop, rows)
+
+
+def filter(db, gt_filter, user_dict):
+    """
+    variant_id_getter for GeminiQuery. Returns the variant_ids passing the
+    filter or None when the index can't answer it (no index, out of date,
+    or a column that is not indexed), in which case the query is filtered
+    as usual.
+    """
+    tree = user_dict.get("gt_filter_tree")
+    if tree is None or not os.path.exists(get_index_path(db)):
+        return None
+    index = GtIndex(db)
+    if not tree.columns.issubset(index.columns):
+        return None
+    if not index.is_current(db):
+        sys.stderr.write("genotype index for %s is out of date; re-run `oncogemini gt_index`\n" % db)
+        return None
+
+    vids = index.variant_ids()
+    nulls = index.nulls(tree.columns)
+    passed = []
+    for start in range(0, len(vids), CHUNK_SIZE):
+        stop = min(start + CHUNK_SIZE, len(vids))
+        try:
+            mask = gtf.evaluate(tree, IndexSource(index, start, stop))
+        except TypeError:
+            return None
+        if nulls is not None:
+            mask = mask & ~nulls[start:stop]
+        passed.append(vids[start:stop][mask])
+    if not passed:
+        return np.array([], dtype=np.int64)
+    return np.concatenate(passed)
+
+
+class Carriers(object):
+    """
+    the bitmaps of the variants each sample has (HET or HOM_ALT), combined
+    over sets of samples a block of samples at a time.
+    """
+
+    def __init__(self, bits, sample_to_idx):
+        self.bits = bits
+        self.sample_to_idx = sample_to_idx
+        self.n_words = bits.shape[2]
+
+    def _blocks(self, names):
+        idx = sorted(self.sample_to_idx[n] for n in set(names))
+        for i in range(0, len(idx), SAMPLE_BLOCK):
+            block = idx[i:i + SAMPLE_BLOCK]
+            yield self.bits[HET, block] | self.bits[HOM_ALT, block]
+
+    def any(self, names):
+        """ variants that any of the samples has """
+        words = np.zeros(self.n_words, dtype="<u8")
+        for block in self._blocks(names):
+            words |= np.bitwise_or.reduce(block, axis=0)
+        return words
+
+    def all(self, names):
+        """ variants that all of the samples have """
+        words = np.full(self.n_words, np.iinfo(np.uint64).max, dtype="<u8")
+        for block in self._blocks(names):
+            words &= np.bitwise_and.reduce(block, axis=0)
+        return words
+
+
+def sample_filter(db, groups, in_subject, min_groups=1):
+    """
+    variant_ids of the variants that pass the sample predicates of
+    gemini_query (subjects_predicate with `in_subject`) for at
+    least `min_groups` of the (subjects, subset) name lists in `groups`,
+    from the genotype bitmaps, or None when the index can't answer it (no
+    index, no gt_types bitmaps or out of date).
+    """
+    if not os.path.exists(get_index_path(db)):
+        return None
+    index = GtIndex(db)
+    bits = index.bitmaps()
+    if bits is None:
+        return None
+    if not index.is_current(db):
+        sys.stderr.write("genotype index for %s is out of date; re-run `oncogemini gt_index`\n" % db)
+        return None
+
+    conn, _ = database.get_session_metadata(db, read_only=True)
+    try:
+        sample_to_idx = dict((name, sample_id - 1) for name, sample_id in conn.execute(
+            sql.text("SELECT name, sample_id FROM samples")))
+    finally:
+        conn.close()
+    carriers = Carriers(bits, sample_to_idx)
+    everyone = list(sample_to_idx)
+    vids = index.variant_ids()
+
+    passed = np.zeros(len(vids), dtype=np.int32)
+    for subjects, subset in groups:
+        words = np.full(carriers.n_words, np.iinfo(np.uint64).max, dtype="<u8")
+        if "all" in in_subject:
+            words &= carriers.all(subjects)
+        if "none" in in_subject:
+            words &= ~carriers.any(subjects)
+        if "only" in in_subject:
+            # some of the checked samples and none of them but the subjects
+            check = subset if subset else everyone
+            words &= carriers.any(check) & ~carriers.any(set(check) - set(subjects))
+        if "any" in in_subject:
+            words &= carriers.any(subjects)
+        if "not" in in_subject:
+            words = ~words
+        passed += _unpack(words, len(vids))
+    return np.asarray(vids[passed >= min_groups])
+
+
+def gt_index(parser, args):
+    cols = None
+    if args.cols:
+        cols = [c.strip() for c in args.cols.split(",") if c.strip()]
+    create(args.db, cols)
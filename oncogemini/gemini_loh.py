@@ -1,7 +1,10 @@
 #!/usr/bin/env python
-from __future__ import absolute_import
+from __future__ import absolute_import, print_function
 from . import GeminiQuery
 from . import gemini_utils as utils
+from . import gemini_patient_stats as stats
+from . import tumor_engine as engine
+import operator
 import sys
 
 # LOH mutations are categorized as being heterozygous 
@@ -77,184 +80,83 @@ def loh(parser, args):
     # that patient will be used
     # also verify that patient is among possible patient_ids
     # sample names are saved to patient specific dict
+    # with --all-patients, every patient is processed in the same pass
     patients = []
     names = {}
     utils.get_names(gq,patients,names)
-    patient = utils.get_patient(patient,patients)
-    samples = utils.get_samples(patient,names,samples)
-    if somatic != 'none' and somatic not in samples:
-        sys.exit("Error: Specified sample name with --specific is not found, make sure a single sample only is provided and check the sample manifest file for available sample names")
-
-    # iterate again through each sample and save which sample is the normal
-    # non-normal, tumor sample names are saved to a list
-    # establish which timepoints belong to which samples names
-    # this is done for the specified --patient and --samples
-    # designate the last and first time points
-    gq.run(query)
-    normal_samples = []
-    tumor_samples = []
-    timepoints = {}
-    samples_tps = {}
-    utils.sort_samples(gq,normal_samples,tumor_samples,timepoints,samples_tps,patient,samples)
-    startpoint = min(timepoints.keys())
-
-    # if only sample included with --specific is the first timepoint, --specific won't work
-    if somatic != 'none':
-        if samples_tps[somatic] == startpoint:
-            sys.exit("Error: Specified sample with --specific is the first timepoint, specify a sample that has a preceding sample")
-
-    # check arrays to see if samples have been added
-    # if arrays are empty there is probably a problem in samples
-    # check the ped file being loaded into the db
-    if len(normal_samples) == 0 and somatic == 'none':
-        sys.exit("Error: There are no normal samples; check the sample manifest file for proper format and loading")
-    if len(tumor_samples) == 0 and somatic == 'none':
-        sys.exit("Error: There are no tumor samples; check the sample manifest file for proper format and loading")
-
-    # create a new connection to the database that includes the genotype columns
-    # using the database passed in as an argument via the command line
-    gq = GeminiQuery.GeminiQuery(args.db, include_gt_cols=True)
-    
-    # define the loh query
-    if args.columns is not None:
-        columns = args.columns
-        if cancers != 'none':
-            columns = args.columns + ",civic_gene_abbreviations,cgi_gene_abbreviations"
-    else:
-        columns = args.columns
-    if args.filter is not None:
-        filter = args.filter
-    else:
-        filter = str(1)
-    query = utils.make_query(columns,filter)
-
-    # execute a new query to process the variants
-    gq.run(query)#, gt_filter)
-
-    # get the sample index numbers so we can get sample specific GT info (AFs, DPs, etc.)
-    smp2idx = gq.sample_to_idx
-
-    # print header and add the AFs of included samples
-    addHeader = []
-    header = gq.header.split('\t')
-    if cancers != 'none':
-        addHeader.extend(header[:len(header)-2])
-    else:
-        addHeader.extend(header)
-    if somatic == 'none':
-        for key in timepoints:
-            for s in timepoints[key]:
-                if s in samples:
-                    af = 'alt_AF.' + s
-                    addHeader.append(af)
-                    if args.purity:
-                        raw = 'raw.alt_AF.' + s
-                        addHeader.append(raw)
-    elif somatic != 'none':
-        preceding = samples_tps[somatic] - 1
-        for s in timepoints[preceding]:
-            if s in samples:
-                af = 'alt_AF.' + s
-                addHeader.append(af)
-                if args.purity:
-                    raw = 'raw.alt_AF.' + s
-                    addHeader.append(raw)
-        af = 'alt_AF.' + somatic
-        addHeader.append(af)
-        if args.purity:
-            raw = 'raw.alt_AF.' + somatic
-            addHeader.append(raw)
-    print '\t'.join(addHeader)
-
-    # iterate through each row of the results and print
-    for row in gq:
-        output = []
-        out = str(row).split('\t')
-        if cancers != 'none':
-            output.extend(out[:len(out)-2])
-        else:
-            output.extend(out)
-        normAFs = []
-        tumsAFs = []
-        depths = []
-        quals = []
-        addEnd = []
+    if somatic != 'none' and args.all_patients:
+        sys.exit("Error: --specific names a single sample and can't be used with --all-patients")
+
+    def setup(patient):
+        patient_samples = engine.patient_samples(names, patient, samples, args.all_patients)
+        if somatic != 'none' and somatic not in patient_samples:
+            raise engine.PatientError("Error: Specified sample name with --specific is not found, make sure a single sample only is provided and check the sample manifest file for available sample names")
+
+        # iterate again through each sample and save which sample is the normal
+        # non-normal, tumor sample names are saved to a list
+        # establish which timepoints belong to which samples names
+        # this is done for the specified --patient and --samples
+        # designate the last and first time points
+        gq.run(query)
+        normal_samples = []
+        tumor_samples = []
+        timepoints = {}
+        samples_tps = {}
+        utils.sort_samples(gq,normal_samples,tumor_samples,timepoints,samples_tps,patient,patient_samples)
+        startpoint = min(timepoints.keys())
+
+        # if only sample included with --specific is the first timepoint, --specific won't work
+        if somatic != 'none':
+            if samples_tps[somatic] == startpoint:
+                raise engine.PatientError("Error: Specified sample with --specific is the first timepoint, specify a sample that has a preceding sample")
+
+        # check arrays to see if samples have been added
+        # if arrays are empty there is probably a problem in samples
+        # check the ped file being loaded into the db
+        if len(normal_samples) == 0 and somatic == 'none':
+            raise engine.PatientError("Error: There are no normal samples; check the sample manifest file for proper format and loading")
+        if len(tumor_samples) == 0 and somatic == 'none':
+            raise engine.PatientError("Error: There are no tumor samples; check the sample manifest file for proper format and loading")
+
+        # with --specific, the samples of the preceding timepoint take
+        # the place of the normal samples and --specific that of the tumors
         if somatic == 'none':
-            for key in timepoints:
-                for s in timepoints[key]:
-                    if s in samples:
-                        smpidx = smp2idx[s]
-                        if args.purity:
-                            sampleAF = utils.purityAF(row['gt_alt_freqs'][smpidx],purity[s])
-                            rawAF = row['gt_alt_freqs'][smpidx]
-                        else:
-                            sampleAF = row['gt_alt_freqs'][smpidx]
-                        if s in normal_samples and sampleAF >= 0:
-                            normAFs.append(sampleAF)
-                        if s in tumor_samples and sampleAF >= 0:
-                            tumsAFs.append(sampleAF)
-                        sampleDP = row['gt_depths'][smpidx]
-                        depths.append(sampleDP)
-                        sampleGQ = row['gt_quals'][smpidx]
-                        quals.append(sampleGQ)
-                        addEnd.append(str(sampleAF))
-                        if args.purity:
-                            addEnd.append(str(rawAF))
-        elif somatic != 'none':
+            cols = engine.ordered_samples(timepoints, patient_samples)
+            normal = engine.column_mask(cols, normal_samples)
+            tumor = engine.column_mask(cols, tumor_samples)
+        else:
             preceding = samples_tps[somatic] - 1
-            for s in timepoints[preceding]:
-                smpidx = smp2idx[s]
-                if args.purity:
-                    sampleAF = utils.purityAF(row['gt_alt_freqs'][smpidx],purity[s])
-                    rawAF = row['gt_alt_freqs'][smpidx]
-                else:
-                    sampleAF = row['gt_alt_freqs'][smpidx]
-                if sampleAF >= 0:
-                    normAFs.append(sampleAF)
-                sampleDP = row['gt_depths'][smpidx]
-                depths.append(sampleDP)
-                sampleGQ = row['gt_quals'][smpidx]
-                quals.append(sampleGQ)
-                addEnd.append(str(sampleAF))
-                if args.purity:
-                    addEnd.append(str(rawAF))
-            smpidx = smp2idx[somatic]
-            if args.purity:
-                sampleAF = utils.purityAF(row['gt_alt_freqs'][smpidx],purity[s])
-                rawAF = row['gt_alt_freqs'][smpidx]
-            else:
-                sampleAF = row['gt_alt_freqs'][smpidx]
-            if sampleAF >= 0:
-                tumsAFs.append(sampleAF)
-            sampleDP = row['gt_depths'][smpidx]
-            depths.append(sampleDP)
-            sampleGQ = row['gt_quals'][smpidx]
-            quals.append(sampleGQ)
-            addEnd.append(str(sampleAF))
-            if args.purity:
-                addEnd.append(str(rawAF))
+            cols = list(timepoints[preceding]) + [somatic]
+            normal = engine.column_mask(cols, timepoints[preceding])
+            tumor = engine.column_mask(cols, [somatic])
+
+        def select(chunk):
+            afs = chunk.afs
+            valid = afs.valid()
+            # normal AFs must all be between minNorm and maxNorm
+            # and tumor AFs all at least minTumor
+            passed = chunk.well_covered(minDP, minGQ)
+            passed &= (valid & normal).any(axis=1) & (valid & tumor).any(axis=1)
+            passed &= ~afs.any(operator.lt, minNorm, normal)
+            passed &= ~afs.any(operator.gt, maxNorm, normal)
+            passed &= ~afs.any(operator.lt, minTumor, tumor)
+            return passed
+
+        # the same thresholds on the patient's precomputed statistics, if any
+        pushdown = None
+        if somatic == 'none':
+            pushdown = stats.pushdown(args, patient, samples,
+                                      [("normal_min_af", ">=", minNorm),
+                                       ("normal_max_af", "<=", maxNorm),
+                                       ("tumor_min_af", ">=", minTumor)],
+                                      minDP, minGQ)
 
-        #check that requirements have been met
-        if min(depths) < minDP or min(quals) < minGQ:
-            continue
-        if len(normAFs) == 0 or len(tumsAFs) == 0:
-            continue
-        if any(af < minNorm or af > maxNorm for af in normAFs):
-            continue
-        if any(af < minTumor for af in tumsAFs):
-            continue
+        return engine.Report(cols, select, pushdown=pushdown)
 
-        # print results that meet the requirements
-        # if args.cancer has been used, filter results to cancer matches
-        # add selected sample AFs
-        output.extend(addEnd)
-        if cancers != 'none':
-            abbrevs = str(row['civic_gene_abbreviations']).split(',')  + str(row['cgi_gene_abbreviations']).split(',')
-            include = 0
-            for c in cancers:
-                if c in abbrevs:
-                    include += 1
-            if include > 0:
-                print '\t'.join(output)
-        else:
-            print '\t'.join(output)
+    reports = engine.patients_to_run(args, patient, patients, names, setup)
+
+    # query the variants with their genotype columns (split across --cores
+    # processes) and print the results that meet the requirements
+    # if args.cancer has been used, filter results to cancer matches
+    engine.run(args, reports, purity=purity if args.purity else None,
+               cancers=cancers)
@@ -20,6 +20,11 @@ def examples(parser, args):
     print( "   oncogemini query -q \"select chrom, pos, in_omim, clin_sigs from variants\" my.db")
     print("")
 
+    print( "[explain] - see how a query is run and which indexes would speed it up:")
+    print( "   oncogemini explain -q \"select chrom, start from variants where is_somatic_B == 1\" my.db")
+    print( "   oncogemini explain -q \"select * from variants where gene = 'TP53'\" --create-indexes my.db")
+    print("")
+
     print( "[dump] - convenient \"data dumps\":")
     print( "   oncogemini dump --variants my.db")
     print( "   oncogemini dump --genotypes my.db")
@@ -80,6 +85,30 @@ def main():
         gemini_amend.amend(parser, args)
     parser_amend.set_defaults(func=amend_fn)
 
+    #########################################
+    # $ gemini add-samples
+    #########################################
+    parser_add_samples = subparsers.add_parser('add-samples',
+            help='add the new samples of a VCF to a loaded database')
+    parser_add_samples.add_argument('db',
+            metavar='db',
+            help='The name of the database to be updated.')
+    parser_add_samples.add_argument('--vcf',
+            dest='vcf',
+            required=True,
+            help=('VCF with the new samples. Its samples that are already in the '
+                  'database are ignored.'))
+    parser_add_samples.add_argument('--ped',
+            dest='ped',
+            required=True,
+            help='Sample information file (PED) with the new samples.')
+
+    def add_samples_fn(parser, args):
+        from oncogemini import gemini_add_samples
+        gemini_add_samples.add_samples(parser, args)
+
+    parser_add_samples.set_defaults(func=add_samples_fn)
+
     #########################################
     # $ gemini query
     #########################################
@@ -145,7 +174,22 @@ def main():
     parser_query.add_argument('--format',
                               dest='format',
                               default='default',
-                              help='Format of output (JSON, TPED or default)')
+                              help=('Format of output (JSON, TPED, VCF, default or the '
+                                    'binary, columnar npz, arrow or parquet)'))
+    parser_query.add_argument('--bgzip',
+                              dest='bgzip',
+                              metavar='FILE',
+                              default=None,
+                              help=('With --format vcf, write the VCF (with its header) '
+                                    'bgzip compressed to FILE, which must end in .gz, '
+                                    'and index it with tabix.'))
+    parser_query.add_argument('--plink',
+                              dest='plink',
+                              metavar='PREFIX',
+                              default=None,
+                              help=('With --format tped, write the variants as a PLINK '
+                                    'binary fileset, PREFIX.bed, PREFIX.bim and PREFIX.fam, '
+                                    'instead of TPED.'))
     parser_query.add_argument('--region',
                               dest='region',
                               default=None,
@@ -157,6 +201,19 @@ def main():
                               help=('Output columns of counts of carriers and '
                                     'non-carriers stratified by the given '
                                     'sample phenotype column'))
+    parser_query.add_argument('--use-gt-index',
+                              dest='use_gt_index',
+                              action='store_true',
+                              default=False,
+                              help=('Apply the --gt-filter, --sample-filter with --in '
+                                    'and --family-wise using the genotype index built '
+                                    'with `oncogemini gt_index`.'))
+    parser_query.add_argument('--cores',
+                              dest='cores',
+                              type=int,
+                              default=1,
+                              help=('Number of processes to split the variants of the '
+                                    'query across. Rows are reported in variant_id order.'))
 
     def query_fn(parser, args):
         from oncogemini import gemini_query
@@ -164,6 +221,112 @@ def main():
 
     parser_query.set_defaults(func=query_fn)
 
+    #########################################
+    # $ gemini explain
+    #########################################
+    parser_explain = subparsers.add_parser('explain',
+            help='show how a query is run and suggest indexes for the tables it scans')
+    parser_explain.add_argument('db',
+            metavar='db',
+            help='The name of the database to be queried.')
+    parser_explain.add_argument('-q',
+            dest='query',
+            metavar='QUERY_STR',
+            help=('The query to be explained. Without it, list the indexes '
+                  'recorded by the index advisor.'))
+    parser_explain.add_argument('--gt-filter',
+            dest='gt_filter',
+            metavar='STRING',
+            help='Restrictions to apply to genotype values')
+    parser_explain.add_argument('--show-samples',
+                              dest='show_variant_samples',
+                              action='store_true',
+                              default=False,
+                              help='Explain the query as run with --show-samples.')
+    parser_explain.add_argument('--create-indexes',
+                              dest='create_indexes',
+                              action='store_true',
+                              default=False,
+                              help=('Create the suggested indexes (or, without -q, '
+                                    'the recorded ones used --min-uses times).'))
+    parser_explain.add_argument('--min-uses',
+            dest='min_uses',
+            type=int,
+            default=1,
+            help=('With --create-indexes and no -q, only create the indexes '
+                  'recorded for at least this many queries.'))
+
+    def explain_fn(parser, args):
+        from oncogemini import gemini_explain
+        gemini_explain.explain(parser, args)
+
+    parser_explain.set_defaults(func=explain_fn)
+
+    #########################################
+    # $ gemini gt_index
+    #########################################
+    parser_gt_index = subparsers.add_parser('gt_index',
+            help='build a columnar index of the genotype columns to speed --gt-filter queries')
+    parser_gt_index.add_argument('db',
+            metavar='db',
+            help='The name of the database to be indexed.')
+    parser_gt_index.add_argument('--cols',
+            dest='cols',
+            metavar='STRING',
+            default=None,
+            help=('Comma-separated list of gt columns to index '
+                  '(default: all numeric gt columns, e.g. gt_types,gt_depths).'))
+
+    def gt_index_fn(parser, args):
+        from oncogemini import gemini_gt_index
+        gemini_gt_index.gt_index(parser, args)
+
+    parser_gt_index.set_defaults(func=gt_index_fn)
+
+    #########################################
+    # $ gemini patient_stats
+    #########################################
+    parser_patient_stats = subparsers.add_parser('patient_stats',
+            help=('precompute per patient AF, depth and GQ statistics of the variants '
+                  'that truncal, loh and unique use to skip variants'))
+    parser_patient_stats.add_argument('db',
+            metavar='db',
+            help='The name of the database to be updated.')
+
+    def patient_stats_fn(parser, args):
+        from oncogemini import gemini_patient_stats
+        gemini_patient_stats.patient_stats(parser, args)
+
+    parser_patient_stats.set_defaults(func=patient_stats_fn)
+
+    #########################################
+    # $ gemini migrate-blobs
+    #########################################
+    parser_migrate = subparsers.add_parser('migrate-blobs',
+            help='rewrite the genotype columns in the typed, versioned blob format')
+    parser_migrate.add_argument('db',
+            metavar='db',
+            help='The name of the database to be updated.')
+    parser_migrate.add_argument('--codec',
+            dest='codec',
+            default='zlib',
+            help=('Compression for the genotype arrays: none, zlib, or '
+                  'lz4 / zstd / snappy if the lz4 / zstandard / python-snappy '
+                  'modules are installed.'))
+    parser_migrate.add_argument('--block-size',
+            dest='block_size',
+            type=int,
+            default=64,
+            help=('Compress the genotype arrays in blocks of this many samples so '
+                  'that tools reading a few samples only decode those blocks '
+                  '(0 to compress each array as a whole).'))
+
+    def migrate_blobs_fn(parser, args):
+        from oncogemini import gemini_migrate_blobs
+        gemini_migrate_blobs.migrate_blobs(parser, args)
+
+    parser_migrate.set_defaults(func=migrate_blobs_fn)
+
     #########################################
     # $ gemini dump
     #########################################
@@ -182,6 +345,25 @@ def main():
             action='store_true',
             help='Report all rows/columns from the variants table \nwith one line per sample/genotype.',
             default=False)
+    parser_dump.add_argument('--gt-cols',
+            dest='gt_cols',
+            metavar='COLS',
+            help=('With --genotypes, a comma separated list of genotype columns '
+                  '(e.g. gt_depths,gt_alt_freqs) to report after each genotype.'),
+            default=None)
+    parser_dump.add_argument('--layout',
+            dest='layout',
+            choices=['long', 'wide'],
+            help=('With --genotypes, report a line per sample and variant (long, '
+                  'the default) or a line per variant with a column per sample '
+                  'and genotype column (wide).'),
+            default='long')
+    parser_dump.add_argument('--cores',
+            dest='cores',
+            type=int,
+            default=1,
+            help=('With --genotypes, the number of processes to split the '
+                  'chromosomes across.'))
     parser_dump.add_argument('--samples',
             dest='samples',
             action='store_true',
@@ -290,6 +472,12 @@ def main():
             action='store_true',
             help='Report the pairwise genetic distance between the samples.',
             default=False)
+    parser_stats.add_argument('--cores',
+            dest='cores',
+            type=int,
+            default=1,
+            help=('With --mds, the number of processes to split the variants '
+                  'across.'))
     parser_stats.add_argument('--vars-by-sample',
             dest='variants_by_sample',
             action='store_true',
@@ -486,6 +674,11 @@ def main():
             action='store_true',
             help='Don\'t set the is_somatic flag, just report what _would_ be set. For testing parameters.',
             default=False)
+    parser_set_somatic.add_argument('--cores',
+            dest='cores',
+            type=int,
+            default=1,
+            help='Number of processes to split the variants across (default is 1)')
 
     def set_somatic_fn(parser, args):
         from oncogemini import gemini_set_somatic
@@ -561,8 +754,13 @@ def main():
             dest='samples',
             default=None,
             help='Comma separated list of samples to screen for ROHs. e.g S120,S450')
+    parser_hom_run.add_argument('--cores',
+            dest='cores',
+            type=int,
+            default=1,
+            help='Number of processes to split the chromosomes across.')
     def homozygosity_runs_fn(parser, args):
-        from gemini.tool_homozygosity_runs import run
+        from oncogemini.tool_homozygosity_runs import run
         run(parser, args)
     parser_hom_run.set_defaults(func=homozygosity_runs_fn)
 
@@ -646,6 +844,20 @@ def main():
             dest='cancers',
             metavar='STRING',
             help='Restrict results to variants/genes associated with specific cancer types by entering a comma-separated string of cancer type abbreviations (see documents for abbreviations) REQUIRES that db include civic_gene_abbrevations and/or cgi_gene_abbreviations')
+    parser_truncal.add_argument('--all-patients',
+            dest='all_patients',
+            action="store_true",
+            help='Process every patient in a single pass over the variants, writing the results of each patient to PREFIX.<patient_id>.txt')
+    parser_truncal.add_argument('--prefix',
+            dest='prefix',
+            metavar='STRING',
+            default='truncal',
+            help='Prefix of the per-patient output files of --all-patients (default is "truncal")')
+    parser_truncal.add_argument('--cores',
+            dest='cores',
+            type=int,
+            default=1,
+            help='Number of processes to split the variants across (default is 1)')
 
     def truncal_fn(parser, args):
         from oncogemini.gemini_truncal import truncal
@@ -707,6 +919,20 @@ def main():
             dest='cancers',
             metavar='STRING',
             help='Restrict results to variants/genes associated with specific cancer types by entering a comma-separated string of cancer type abbreviations (see documents for abbreviations) REQUIRES that db include civic_gene_abbrevations and/or cgi_gene_abbreviations')
+    parser_loh.add_argument('--all-patients',
+            dest='all_patients',
+            action="store_true",
+            help='Process every patient in a single pass over the variants, writing the results of each patient to PREFIX.<patient_id>.txt')
+    parser_loh.add_argument('--prefix',
+            dest='prefix',
+            metavar='STRING',
+            default='loh',
+            help='Prefix of the per-patient output files of --all-patients (default is "loh")')
+    parser_loh.add_argument('--cores',
+            dest='cores',
+            type=int,
+            default=1,
+            help='Number of processes to split the variants across (default is 1)')
 
     def loh_fn(parser, args):
         from oncogemini.gemini_loh import loh
@@ -775,6 +1001,20 @@ def main():
             dest='cancers',
             metavar='STRING',
             help='Restrict results to variants/genes associated with specific cancer types by entering a comma-separated string of cancer type abbreviations (see documents for abbreviations) REQUIRES that db include civic_gene_abbrevations and/or cgi_gene_abbreviations')
+    parser_bottleneck.add_argument('--all-patients',
+            dest='all_patients',
+            action="store_true",
+            help='Process every patient in a single pass over the variants, writing the results of each patient to PREFIX.<patient_id>.txt')
+    parser_bottleneck.add_argument('--prefix',
+            dest='prefix',
+            metavar='STRING',
+            default='bottleneck',
+            help='Prefix of the per-patient output files of --all-patients (default is "bottleneck")')
+    parser_bottleneck.add_argument('--cores',
+            dest='cores',
+            type=int,
+            default=1,
+            help='Number of processes to split the variants across (default is 1)')
 
     def bottleneck_fn(parser, args):
         from oncogemini.gemini_bottleneck import bottleneck
@@ -836,6 +1076,20 @@ def main():
             metavar='STRING',
             help='Restrict results to variants/genes associated with specific cancer types by entering a comma-separated string of cancer type abbreviations (see documents for abbreviations) RE\
 QUIRES that db include civic_gene_abbrevations and/or cgi_gene_abbreviations')
+    parser_unique.add_argument('--all-patients',
+            dest='all_patients',
+            action="store_true",
+            help='Process every patient in a single pass over the variants, writing the results of each patient to PREFIX.<patient_id>.txt')
+    parser_unique.add_argument('--prefix',
+            dest='prefix',
+            metavar='STRING',
+            default='unique',
+            help='Prefix of the per-patient output files of --all-patients (default is "unique")')
+    parser_unique.add_argument('--cores',
+            dest='cores',
+            type=int,
+            default=1,
+            help='Number of processes to split the variants across (default is 1)')
 
     def unique_fn(parser, args):
         from oncogemini.gemini_unique import unique
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Rewrite the genotype blobs of an existing database in the typed format of
+compression.pack_typed_blob and record the codec in the features table so
+that GeminiQuery (and dump, stats, ...) pick the matching unpacker.
+"""
+from __future__ import absolute_import, print_function
+
+import sys
+import time
+
+import sqlalchemy as sql
+
+from . import compression as Z
+from . import database
+from . import gemini_utils as util
+from .gemini_constants import BUFFER_SIZE
+
+# samples per independently compressed block of the variants' gt columns, so
+# tools that read a few samples (e.g. one patient) don't decompress the whole
+# cohort. arrays with fewer samples are stored as a single block.
+BLOCK_SIZE = 64
+
+
+def _migrate_table(engine, table, key, cols, unpack, codec, block_size=None):
+    """
+    re-encode `cols` of `table` in chunks of BUFFER_SIZE rows ordered by `key`,
+    committing each chunk. rows whose blobs are already in `codec` (e.g. from
+    a migration that was interrupted) are left as they are.
+    """
+    select = sql.text("SELECT %s, %s FROM %s WHERE %s > :last ORDER BY %s LIMIT %d"
+                      % (key, ", ".join(cols), table, key, key, BUFFER_SIZE))
+    update = sql.text("UPDATE %s SET %s WHERE %s = :key_"
+                      % (table, ", ".join("%s = :%s" % (c, c) for c in cols), key))
+    last, n = -1, 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(select, last=last).fetchall()
+            if not rows:
+                break
+            params = []
+            for row in rows:
+                if all(Z.is_typed_with(row[c], codec) for c in cols):
+                    continue
+                p = {c: Z.pack_typed_blob(unpack(row[c]), codec, block_size) for c in cols}
+                p["key_"] = row[key]
+                params.append(p)
+            if params:
+                conn.execute(update, params)
+        last = rows[-1][key]
+        n += len(rows)
+        sys.stderr.write("%s: migrated %d rows\r" % (table, n))
+    if n:
+        sys.stderr.write("\n")
+    return n
+
+
+def migrate(db, codec="zlib", block_size=BLOCK_SIZE):
+    if codec not in Z.available_codecs():
+        raise ValueError("codec %s is not available. choose from: %s"
+                         % (codec, ", ".join(Z.available_codecs())))
+    session, metadata = database.get_session_metadata(db)
+    engine = session.bind
+    session.close()
+    features = util.get_features(metadata)
+    gt_cols = util.get_gt_cols(metadata)
+
+    t0 = time.time()
+    # the codec is recorded first and the blobs are then rewritten a chunk
+    # (one transaction) at a time, so that a migration that is interrupted
+    # leaves a readable database (the typed unpacker reads the blobs not
+    # migrated yet, see compression.get_unpacker) and is finished by running
+    # it again.
+    with engine.begin() as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS features (feature text)")
+        conn.execute(sql.text("DELETE FROM features WHERE feature LIKE :typed"),
+                     typed=Z.TYPED_FEATURE + "%")
+        conn.execute(sql.text("INSERT INTO features (feature) VALUES (:f)"),
+                     f="%s:%s" % (Z.TYPED_FEATURE, codec))
+    unpack = Z.get_unpacker(features + ["%s:%s" % (Z.TYPED_FEATURE, codec)])
+
+    n = _migrate_table(engine, "variants", "variant_id", gt_cols, unpack, codec,
+                       block_size)
+    if "sample_genotypes" in metadata.tables:
+        _migrate_table(engine, "sample_genotypes", "sample_id", ["gt_types"],
+                       unpack, codec)
+
+    with engine.begin() as conn:
+        conn.execute("DELETE FROM features WHERE feature = 'snappy_compression'")
+    sys.stderr.write("migrated %d variants to %s in %.1f seconds\n"
+                     % (n, codec, time.time() - t0))
+
+
+def migrate_blobs(parser, args):
+    migrate(args.db, args.codec, args.block_size)
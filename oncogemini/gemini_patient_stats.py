@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""
+Per patient statistics of the genotype values of each variant, computed
+once (after loading or adding samples) so that truncal, loh and unique can
+select the variants that may pass their thresholds in SQL and only decode
+the genotypes of those:
+
+    patient_variant_stats
+        variant_id, patient_id
+        normal_min_af, normal_max_af  # valid AFs of the samples at time 0
+        tumor_min_af, tumor_max_af    # valid AFs of the samples at time > 0
+        min_dp, min_gq                # lowest depth and GQ of all samples
+        afs                           # AFs of all samples, by timepoint
+
+The min/max AFs are NULL if the samples have no valid (>= 0) AF. AFs are
+not corrected for purity. The statistics are only used while the variants
+and samples (names, patients and timepoints) are those they were computed
+for.
+"""
+from __future__ import absolute_import, print_function
+
+import hashlib
+import sys
+import time
+
+import numpy as np
+import sqlalchemy as sql
+
+from . import compression as Z
+from . import database
+from . import gemini_utils as util
+from .gemini_constants import BUFFER_SIZE
+
+TABLE = "patient_variant_stats"
+
+
+def _fingerprint(conn):
+    """ the variants and samples statistics are computed for """
+    n, max_vid = database.variants_extent(conn)
+    samples = conn.execute(sql.text("SELECT sample_id, name, patient_id, time FROM samples "
+                                    "ORDER BY sample_id")).fetchall()
+    digest = hashlib.md5(repr([tuple(s) for s in samples]).encode("utf8")).hexdigest()
+    return n, max_vid, digest
+
+
+def _patients(conn):
+    """
+    the indices (into the gt arrays) of the samples of each patient in
+    timepoint order, and the masks of its normal and tumor samples.
+    """
+    samples = {}
+    for sample_id, patient, t in conn.execute(sql.text(
+            "SELECT sample_id, patient_id, time FROM samples ORDER BY sample_id")):
+        samples.setdefault(patient, []).append((int(t), sample_id - 1))
+    patients = []
+    for patient in sorted(samples):
+        tps = sorted(samples[patient], key=lambda s: s[0])
+        times = np.array([t for t, _ in tps])
+        patients.append((patient, [i for _, i in tps], times == 0, times > 0))
+    return patients
+
+
+def _stack(rows, col, indices, unpack, fill):
+    values = []
+    for row in rows:
+        v = None if row[col] is None else Z.unpack_subset(row[col], indices, unpack)
+        values.append(np.full(len(indices), fill) if v is None else v)
+    return np.vstack(values)
+
+
+def _extreme(values, mask, op):
+    """ op (min or max) of each row's values where mask, None if none """
+    fill = np.inf if op is np.min else -np.inf
+    found = mask.any(axis=1)
+    ext = op(np.where(mask, values, fill), axis=1)
+    return [float(e) if f else None for e, f in zip(ext, found)]
+
+
+def _patient_stats(rows, patient, afs, depths, quals, normal, tumor):
+    """ the rows of patient_variant_stats of a patient for `rows` """
+    valid = afs >= 0
+    n_min = _extreme(afs, valid & normal, np.min)
+    n_max = _extreme(afs, valid & normal, np.max)
+    t_min = _extreme(afs, valid & tumor, np.min)
+    t_max = _extreme(afs, valid & tumor, np.max)
+    min_dp = depths.min(axis=1).tolist()
+    min_gq = quals.min(axis=1).astype(np.float64).tolist()
+    for i, row in enumerate(rows):
+        yield dict(v=row["variant_id"], p=patient, n_min=n_min[i], n_max=n_max[i],
+                   t_min=t_min[i], t_max=t_max[i], dp=min_dp[i], gq=min_gq[i],
+                   afs=Z.pack_typed_blob(afs[i]))
+
+
+def create(db):
+    """ (re)build the patient_variant_stats of `db` """
+    _, metadata = database.get_session_metadata(db)
+    unpack = Z.get_unpacker(util.get_features(metadata))
+
+    t0 = time.time()
+    with database.database_transaction(db) as conn:
+        conn.execute("DROP TABLE IF EXISTS %s" % TABLE)
+        conn.execute("DROP TABLE IF EXISTS %s_info" % TABLE)
+        conn.execute("CREATE TABLE %s (variant_id integer, patient_id text, "
+                     "normal_min_af float, normal_max_af float, tumor_min_af float, "
+                     "tumor_max_af float, min_dp integer, min_gq float, afs blob, "
+                     "PRIMARY KEY (patient_id, variant_id))" % TABLE)
+        conn.execute("CREATE TABLE %s_info (n_variants integer, max_variant_id integer, "
+                     "samples text)" % TABLE)
+        insert = sql.text("INSERT INTO %s VALUES (:v, :p, :n_min, :n_max, :t_min, :t_max, "
+                          ":dp, :gq, :afs)" % TABLE)
+
+        patients = _patients(conn)
+        select = sql.text("SELECT variant_id, gt_alt_freqs, gt_depths, gt_quals FROM variants "
+                          "WHERE variant_id > :last ORDER BY variant_id LIMIT %d" % BUFFER_SIZE)
+        last, n = -1, 0
+        while True:
+            rows = conn.execute(select, last=last).fetchall()
+            if not rows:
+                break
+            params = []
+            for patient, indices, normal, tumor in patients:
+                afs = _stack(rows, "gt_alt_freqs", indices, unpack, -1)
+                depths = _stack(rows, "gt_depths", indices, unpack, -1)
+                quals = _stack(rows, "gt_quals", indices, unpack, -1)
+                params.extend(_patient_stats(rows, patient, afs, depths, quals,
+                                             normal, tumor))
+            conn.execute(insert, params)
+            last = rows[-1]["variant_id"]
+            n += len(rows)
+            sys.stderr.write("computed the statistics of %d variants\r" % n)
+
+        conn.execute("CREATE INDEX %s_normal_max_idx ON %s (patient_id, normal_max_af)"
+                     % (TABLE, TABLE))
+        conn.execute("CREATE INDEX %s_tumor_min_idx ON %s (patient_id, tumor_min_af)"
+                     % (TABLE, TABLE))
+        conn.execute("ANALYZE %s" % TABLE)
+        conn.execute(sql.text("INSERT INTO %s_info VALUES (:n, :max_vid, :samples)" % TABLE),
+                     dict(zip(("n", "max_vid", "samples"), _fingerprint(conn))))
+    sys.stderr.write("\ncomputed the statistics of %d variants for %d patients in %.1f seconds\n"
+                     % (n, len(patients), time.time() - t0))
+
+
+def is_current(db):
+    """
+    whether `db` has patient_variant_stats for its current variants and
+    samples. out of date statistics are reported.
+    """
+    conn, metadata = database.get_session_metadata(db, read_only=True)
+    try:
+        if TABLE + "_info" not in metadata.tables:
+            return False
+        info = conn.execute(sql.text("SELECT n_variants, max_variant_id, samples FROM %s_info"
+                                     % TABLE)).fetchone()
+        if info is not None and tuple(info) == _fingerprint(conn):
+            return True
+    finally:
+        conn.close()
+    sys.stderr.write("%s of %s is out of date; re-run `oncogemini patient_stats`\n" % (TABLE, db))
+    return False
+
+
+def _loosest(op, threshold):
+    # AFs stored as float32 are compared to the float32 rounding of the
+    # threshold by the tools (see tumor_engine.AlleleFreqs.compare)
+    t32 = float(np.float32(threshold))
+    if op in ("<", "<="):
+        return max(threshold, t32)
+    return min(threshold, t32)
+
+
+def pushdown(args, patient, samples, conditions, minDP=-1, minGQ=-1):
+    """
+    the condition on the variants that selects those of `patient` whose
+    statistics meet `conditions`, (column, op, threshold[, or_null])
+    tuples, and minDP / minGQ, or None if the statistics can't be used: for
+    --all-patients, --purity, a subset of the patient's --samples, without
+    thresholds or if the database has no current statistics. it selects at least the variants
+    that meet the thresholds, the tools still check each of them.
+    """
+    if args.all_patients or args.purity or samples != 'All':
+        return None
+    conditions = list(conditions)
+    if minDP > -1:
+        conditions.append(("min_dp", ">=", minDP))
+    if minGQ > -1:
+        conditions.append(("min_gq", ">=", minGQ))
+    if not conditions or not is_current(args.db):
+        return None
+    where = ["patient_id = '%s'" % str(patient).replace("'", "''")]
+    for condition in conditions:
+        col, op, threshold = condition[:3]
+        c = "%s %s %r" % (col, op, _loosest(op, threshold))
+        if len(condition) > 3 and condition[3]:
+            c = "(%s IS NULL OR %s)" % (col, c)
+        where.append(c)
+    return "variant_id IN (SELECT variant_id FROM %s WHERE %s)" % (TABLE, " AND ".join(where))
+
+
+def patient_stats(parser, args):
+    create(args.db)
@@ -2,84 +2,107 @@
 from __future__ import absolute_import
 
 import os
+import sys
 from collections import defaultdict
 
+import numpy as np
+
 # gemini imports
 from oncogemini import GeminiQuery
+from oncogemini import columnar
+from oncogemini import parallel
+from oncogemini import plink
+from oncogemini import vcf_writer
+from oncogemini import writer
 from oncogemini.GeminiQuery import select_formatter
 from oncogemini.gemini_constants import *
 from oncogemini.gemini_region import add_region_to_query
-from oncogemini.gemini_subjects import (get_subjects, get_subjects_in_family,
-                             get_family_dict)
+from oncogemini.gemini_subjects import get_subjects, get_family_dict
 #from gemini.dgidb import query_dgidb
 
 def all_samples_predicate(args):
     """ returns a predicate that returns True if, for a variant,
     the only samples that have the variant have a given phenotype
     """
-    subjects = get_subjects(args).values()
-    return select_subjects_predicate(subjects, args)
+    return subjects_predicate(subject_groups(args), args)
 
 def family_wise_predicate(args):
-    formatter = select_formatter(args)
-    families = get_family_dict(args)
-    gq = GeminiQuery.GeminiQuery(args.db, out_format=formatter)
-    predicates = []
-    for f in families.values():
-        family_names = [x.name for x in f]
-        subjects = get_subjects_in_family(args, f).values()
-        predicates.append(select_subjects_predicate(subjects, args,
-                                                    family_names))
-    def predicate(row):
-        return sum([p(row) for p in predicates]) >= args.min_kindreds
-    return predicate
-
-def select_subjects_predicate(subjects, args, subset=None):
-    subjects = set([s.name for s in subjects])
-    predicates = []
-    if "all" in args.in_subject:
-        predicates.append(variant_in_all_subjects(subjects))
-    if "none" in args.in_subject:
-        predicates.append(variant_not_in_subjects(subjects))
-    if "only" in args.in_subject:
-        predicates.append(variant_only_in_subjects(subjects, subset))
-    if "any" in args.in_subject:
-        predicates.append(variant_in_any_subject(subjects))
-    if "not" in args.in_subject:
-        def predicate(row):
-            return not all([p(row) for p in predicates])
-    else:
-        def predicate(row):
-            return all([p(row) for p in predicates])
-    return predicate
-
-def variant_in_any_subject(subjects):
-    def predicate(row):
-        return subjects.intersection(samples_with_variant(row)) != set()
-    return predicate
+    return subjects_predicate(subject_groups(args), args, args.min_kindreds)
 
-def variant_in_all_subjects(subjects):
-    def predicate(row):
-        return subjects.issubset(samples_with_variant(row))
-    return predicate
+def subject_groups(args):
+    """
+    the (subjects, subset) sample names each variant is tested against by
+    the row predicates: those of each family with --family-wise, otherwise
+    all the subjects passing the --sample-filter.
+    """
+    if args.family_wise:
+        groups = []
+        for f in get_family_dict(args).values():
+            names = [x.name for x in f]
+            groups.append((names, names))
+        return groups
+    return [([s.name for s in get_subjects(args).values()], None)]
+
+def _group_indices(names, sample_to_idx):
+    """
+    the indices of the samples of each group's set of `names` and the
+    number of the group each of them is in.
+    """
+    idx, group = [], []
+    for g, group_names in enumerate(names):
+        idx.extend(sample_to_idx[n] for n in group_names)
+        group.extend([g] * len(group_names))
+    return np.array(idx, dtype=np.intp), np.array(group, dtype=np.intp)
 
-def variant_only_in_subjects(subjects, subset=None):
-    def predicate(row):
-        if subset:
-            check = set(subset).intersection(samples_with_variant(row))
-        else:
-            check = samples_with_variant(row)
-        return check and subjects.issuperset(check)
-    return predicate
+def subjects_predicate(groups, args, min_groups=1):
+    """
+    returns a predicate that returns True if a variant is in the samples of
+    at least `min_groups` of the (subjects, subset) `groups` as --in asks:
+    in any, all, none or only (of the subset, default all samples) of the
+    subjects. the samples of the groups are turned into index arrays once,
+    a row is tested with a count per group of the carriers in them.
+    """
+    sample_to_idx = GeminiQuery.GeminiQuery(args.db).sample_to_idx
+    everyone = set(sample_to_idx)
+    subjects, check, outside = [], [], []
+    for subj, subset in groups:
+        subj = set(subj)
+        # "only" checks the samples of the subset (default: all) that have
+        # the variant are subjects
+        checked = set(subset) if subset else everyone
+        subjects.append(subj)
+        check.append(checked)
+        outside.append(checked - subj)
+    n = len(groups)
+    sizes = np.array([len(subj) for subj in subjects], dtype=np.intp)
+    subjects = _group_indices(subjects, sample_to_idx)
+    check = _group_indices(check, sample_to_idx)
+    outside = _group_indices(outside, sample_to_idx)
+    in_subject = args.in_subject
 
-def variant_not_in_subjects(subjects):
     def predicate(row):
-        return subjects.intersection(samples_with_variant(row)) == set()
+        gt_types = row['gt_types']
+        carriers = (gt_types == HET) | (gt_types == HOM_ALT)
+
+        def count(indices):
+            idx, group = indices
+            return np.bincount(group, weights=carriers[idx], minlength=n)
+
+        passed = np.ones(n, dtype=bool)
+        in_subjects = count(subjects)
+        if "all" in in_subject:
+            passed &= in_subjects == sizes
+        if "none" in in_subject:
+            passed &= in_subjects == 0
+        if "only" in in_subject:
+            passed &= (count(check) > 0) & (count(outside) == 0)
+        if "any" in in_subject:
+            passed &= in_subjects > 0
+        if "not" in in_subject:
+            passed = ~passed
+        return passed.sum() >= min_groups
     return predicate
 
-def samples_with_variant(row):
-    return row['variant_samples']
-
 def queries_variants(query):
     return "variants" in query.lower()
 
@@ -111,26 +134,86 @@ def add_required_columns_to_query(args):
 
 
 def run_query(args):
-    predicates = get_row_predicates(args)
+    if getattr(args, 'bgzip', None) and args.format != 'vcf':
+        raise ValueError("--bgzip needs --format vcf")
+    if getattr(args, 'plink', None) and args.format != 'tped':
+        raise ValueError("--plink needs --format tped")
     add_required_columns_to_query(args)
-    formatter = select_formatter(args)
-    genotypes_needed = needs_genotypes(args)
-    try:
-        subjects = get_subjects(args)
-    except KeyError:
-        subjects = []
-    kwargs = {}
-
-    gq = GeminiQuery.GeminiQuery(args.db, out_format=formatter, **kwargs)
-    gq.run(args.query, args.gt_filter, args.show_variant_samples,
-           args.sample_delim, predicates, genotypes_needed,
-           args.show_families, subjects=subjects)
-
-    if args.use_header and gq.header:
-        print(gq.header)
-
-    for row in gq:
-        print(row)
+
+    def rows():
+        predicates = get_row_predicates(args)
+        formatter = select_formatter(args)
+        genotypes_needed = needs_genotypes(args)
+        try:
+            subjects = get_subjects(args)
+        except KeyError:
+            subjects = []
+        kwargs, variant_ids = {}, None
+        if args.use_gt_index:
+            from oncogemini import gemini_gt_index
+            kwargs['variant_id_getter'] = gemini_gt_index.filter
+            if predicates:
+                # the sample predicates from the genotype bitmaps, if indexed
+                min_groups = args.min_kindreds if args.family_wise else 1
+                variant_ids = gemini_gt_index.sample_filter(
+                    args.db, subject_groups(args), args.in_subject, min_groups)
+                if variant_ids is not None:
+                    predicates = []
+
+        gq = GeminiQuery.GeminiQuery(args.db, out_format=formatter, **kwargs)
+        gq.run(args.query, args.gt_filter, args.show_variant_samples,
+               args.sample_delim, predicates, genotypes_needed,
+               args.show_families, subjects=subjects, variant_ids=variant_ids)
+        yield gq.header
+        if getattr(formatter, 'columnar', False):
+            for batch in columnar.batches(gq):
+                yield batch
+            return
+        if getattr(args, 'plink', None):
+            for block in plink.blocks(gq, formatter):
+                yield block
+            return
+        if formatter.name == 'default':
+            # straight from the values, without the formatter
+            fmt = writer.LineFormatter()
+            lines = (fmt.line(row.print_fields.values()) for row in gq)
+        else:
+            lines = (str(row) for row in gq)
+        for block in writer.blocks(lines):
+            yield block
+
+    # with --cores, the variants are split across processes
+    cores = args.cores if parallel.can_split(args.query) else 1
+    output = parallel.imap(args.db, cores, rows, header=True)
+    header = next(output)
+    if args.format in columnar.FORMATS:
+        fh = getattr(sys.stdout, 'buffer', sys.stdout)
+        out = columnar.writer(args.format, fh, header)
+        for batch in output:
+            out.write(batch)
+        out.close()
+        fh.flush()
+        return
+    if getattr(args, 'plink', None):
+        out = plink.BedWriter(args.plink, args.db)
+        for block in output:
+            out.write(block)
+        out.close()
+        return
+    if getattr(args, 'bgzip', None):
+        # a bgzipped, tabix indexed VCF always has its header
+        out = vcf_writer.BgzfFile(args.bgzip)
+        out.write(header + "\n")
+    else:
+        out = sys.stdout
+        if args.use_header and header:
+            print(header)
+
+    for block in output:
+        out.write(block)
+    out.flush()
+    if out is not sys.stdout:
+        out.close()
 
 
 def query(parser, args):
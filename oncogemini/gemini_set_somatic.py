@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 from __future__ import absolute_import, print_function
+import operator
+import sys
+
+import numpy as np
+
 from .gemini_constants import *
 from . import GeminiQuery
 from . import gemini_utils as utils
+from . import parallel
+from . import tumor_engine as engine
 
 def tag_somatic_mutations(args):
 
@@ -67,15 +74,12 @@ def tag_somatic_mutations(args):
     utils.get_names(gq,patients,names)
     patients = sorted(list(set(patients)))
 
-    # iterate through each patient in the db
+    # sort each patient's samples as either normal or tumor
+    # based on time column in samples table
+    somatics = []
     for patient in patients:
-        print("Processing patient " + patient)
         samples = 'All'
         samples = utils.get_samples(patient,names,samples)
-        
-        # second query is to sort samples as either normal or tumor
-        # based on time column in samples table
-        # query uses same arguments as first query
         query = "select patient_id, name, time from samples"
         gq.run(query)
         normal_samples = []
@@ -83,178 +87,194 @@ def tag_somatic_mutations(args):
         timepoints = {}
         samples_tps = {}
         utils.sort_samples(gq,normal_samples,tumor_samples,timepoints,samples_tps,patient,samples)
+        somatics.append(Somatics(patient, samples, normal_samples, tumor_samples))
 
-        #check and make sure patient has normal samples
-        if len(normal_samples) == 0:
-            print('No normal samples for patient ' + patient)
-            print('Unable to identify somatics')
-            print('Skipping patient ' + patient)
-            continue
+    # a single pass over the variants finds the somatics of every patient
+    # that has normal samples
+    found = [s for s in somatics if s.normal.any()]
+    samples = []
+    for s in found:
+        samples.extend(smp for smp in s.samples if smp not in samples)
+        s.cols = [samples.index(smp) for smp in s.samples]
 
-        # final query will actually go through each of the variants
-        # and see if the variant matches supplied somatic criteria
+    def scan():
+        """
+        yield the (flags of the patients in found..., variant_id) of the
+        variants of a chunk that are somatic in at least one of them and
+        the output lines of each patient.
+        """
         query = "SELECT variant_id, chrom, start, end, ref, alt, gene, \
                         gts, gt_types, gt_ref_depths, gt_alt_depths, \
                         gt_alt_freqs, gt_depths, gt_quals \
                  FROM variants"
+        gq = GeminiQuery.GeminiQuery(args.db)
         gq.run(query)
-        smp2idx = gq.sample_to_idx
+        chunks = engine.iter_chunks(gq, samples, purity if args.purity else None,
+                                    gt_cols=('gt_types', 'gt_alt_depths'))
+        for chunk in chunks:
+            found_lines = []
+            flags = []
+            for s in found:
+                passed, lines = s.find(chunk.take(s.cols), args, minDP, minGQ,
+                                       normFlag, tumFlag)
+                flags.append(passed)
+                found_lines.append(lines)
+            flags = np.column_stack(flags)
+            yield [tuple(int(f) for f in flags[i]) + (chunk.rows[i]['variant_id'],)
+                   for i in np.flatnonzero(flags.any(axis=1))], found_lines
+
+    updates = []
+    if found:
+        # with --cores, the variants are split across processes
+        for chunk_updates, found_lines in parallel.imap(args.db, args.cores, scan):
+            updates.extend(chunk_updates)
+            for s, lines in zip(found, found_lines):
+                s.lines.extend(lines)
 
-        somatic_counter = 0
-        somatic_v_ids = []
+    if not args.dry_run and found:
+        write_somatics(args.db, found, updates)
 
+    for s in somatics:
+        print("Processing patient " + s.patient)
+        #check and make sure patient has normal samples
+        if not s.normal.any():
+            print('No normal samples for patient ' + s.patient)
+            print('Unable to identify somatics')
+            print('Skipping patient ' + s.patient)
+            continue
         if args.dry_run:
-            print('Somatics for patient ' + patient)
+            print('Somatics for patient ' + s.patient)
             print('\t'.join(['variant_id', 'chrom', 'start','end', 'ref', \
                         'alt', 'gene', 'normal_GTs', 'tumor_GTs', 'normal_DPs', \
                         'tumor_DPs', 'norm_counts', 'tum_counts', 'normal_AFs', \
                         'tumor_AFs']))
+        for line in s.lines:
+            print(line)
+        if not args.dry_run:
+            print("Identified and set", len(s.lines), "somatic mutations")
+            index_somatics(args.db, s.column)
+        else:
+            print("Would have identified and set", len(s.lines), "somatic mutations")
 
-        for row in gq:
-            normDPs = []
-            tumDPs = []
-            norm_counts = []
-            tum_counts = []
-            normAFs = []
-            tumAFs = []
-            normGTs = []
-            tumGTs = []
-            depths = []
-            quals = []
-        
-            # build lists of metrics for filtering
-            for s in samples:
-                smpidx = smp2idx[s]
-                sampleDP = row['gt_depths'][smpidx]
-                depths.append(sampleDP)
-                sampleGQ = row['gt_quals'][smpidx]
-                quals.append(sampleGQ)
-                sample_count = row['gt_alt_depths'][smpidx]
-                if args.purity:
-                    sampleAF = utils.purityAF(row['gt_alt_freqs'][smpidx],purity[s])
-                else:
-                    sampleAF = row['gt_alt_freqs'][smpidx]
-                sampleGT = row['gt_types'][smpidx]
-                if s in normal_samples:
-                    normDPs.append(sampleDP)
-                    norm_counts.append(sample_count)
-                    normAFs.append(sampleAF)
-                    normGTs.append(sampleGT)
-                if s in tumor_samples:
-                    tumDPs.append(sampleDP)
-                    tum_counts.append(sample_count)
-                    tumAFs.append(sampleAF)
-                    tumGTs.append(sampleGT)
-            
-            # start filtering
-            if min(depths) < minDP or min(quals) < minGQ:
-                continue
 
-            # normal samples filtering
-            if normFlag == 0:
-                if any(gt != HOM_REF for gt in normGTs):
-                    continue
-            elif normFlag == 1:
-                if args.normDP:
-                    if min(normDPs) < args.normDP: #or max(norm_counts) > args.normCount or max(normAFs) > args.normAF:
-                        continue
-                if args.normCount:
-                    if max(norm_counts) > args.normCount:
-                        continue
-                if args.normAF:
-                    if max(normAFs) > args.normAF:
-                        continue
+class Somatics(object):
+    """
+    the normal and tumor samples of a patient and the somatic variants found
+    for it, which are flagged in its is_somatic_<patient> column.
+    """
 
-            # tumor samples filtering
-            # if parameters are provided, have to make sure the same sample passes them
-            if tumFlag == 0:
-                if all(gt == HOM_REF for gt in tumGTs):
-                    continue
-                if any(gt == HET for gt in tumGTs) or any(gt == HOM_ALT for gt in tumGTs):
-                    somatic_counter += 1
-                    somatic_v_ids.append((1, row['variant_id']))
-                    print('\t'.join(str(s) for s in [row['variant_id'], row['chrom'], row['start'], row['end'], row['ref'], \
-                                                     row['alt'], row['gene'], normGTs, tumGTs, normDPs, tumDPs, norm_counts, \
-                                                     tum_counts, normAFs, tumAFs]))
-            elif tumFlag == 1:
-                tum_passed = {}
-                if args.tumDP:
-                    passed = [i for i, x in enumerate(tumDPs) if x >= args.tumDP]
-                    tum_passed['DP'] = passed
-                if args.tumCount:
-                    passed = [i for i, x in enumerate(tum_counts) if x >= args.tumCount]
-                    tum_passed['Count'] = passed
-                if args.tumAF:
-                    passed = [i for i, x in enumerate(tumAFs) if x >= args.tumAF]
-                    tum_passed['AF'] = passed
-                if len(tum_passed) == 0:
-                    continue
-                else:
-                    final = []
-                    for i in tum_passed:
-                        if len(final) == 0:
-                            final = final + tum_passed[i]
-                        else:
-                            final = list(set(final) & set(tum_passed[i]))
-                    if len(final) > 0:
-                        somatic_counter += 1
-                        somatic_v_ids.append((1, row['variant_id']))
-                        print('\t'.join(str(s) for s in [row['variant_id'], row['chrom'], row['start'], row['end'], row['ref'], \
-                                                        row['alt'], row['gene'], normGTs, tumGTs, normDPs, tumDPs, norm_counts, \
-                                                        tum_counts, normAFs, tumAFs]))
-#            if any(dp >= args.tumDP for dp in tumDPs):
-#                if any(count >= args.tumCount for count in tum_counts):
-#                    if any(af >= args.tumAF for af in tumAFs):
-#                        somatic_counter += 1
-#                        somatic_v_ids.append((1, row['variant_id']))                        
-#                        print('\t'.join(str(s) for s in [row['variant_id'], row['chrom'], row['start'], row['end'], row['ref'], \
-#                                                        row['alt'], row['gene'], normGTs, tumGTs, normDPs, tumDPs, norm_counts, \
-#                                                        tum_counts, normAFs, tumAFs]))
+    def __init__(self, patient, samples, normal_samples, tumor_samples):
+        self.patient = patient
+        self.column = 'is_somatic_' + patient
+        self.samples = samples
+        self.normal = engine.column_mask(samples, normal_samples)
+        self.tumor = engine.column_mask(samples, tumor_samples)
+        self.lines = []
 
-        if not args.dry_run:
-            # establish a connection to the database
-            from . import database
-            import sqlalchemy as sql
-            import sys
+    def find(self, chunk, args, minDP, minGQ, normFlag, tumFlag):
+        """
+        the mask of the somatic variants of a chunk of the patient's samples
+        and the output line of each of them.
+        """
+        GTs = chunk.gt['gt_types']
+        ADs = chunk.gt['gt_alt_depths']
+        DPs = chunk.depths
+        norm, tum = self.normal, self.tumor
 
-            conn, metadata = database.get_session_metadata(args.db)
-            
-            is_somatic = 'is_somatic_' + patient
+        # start filtering
+        passed = chunk.well_covered(minDP, minGQ)
 
-            # alter the database by adding a new is_somatic
-            alter_qry = "ALTER TABLE variants ADD " + is_somatic + " INTEGER DEFAULT 0"
-            try:
-                conn.execute(sql.text(alter_qry))
-            except sql.exc.OperationalError:
-                sys.stderr.write("WARNING: Column \"("
-                             + is_somatic
-                             + ")\" already exists in variants table. Overwriting values.\n")
+        # normal samples filtering
+        if normFlag == 0:
+            passed &= (GTs[:, norm] == HOM_REF).all(axis=1)
+        elif normFlag == 1:
+            if args.normDP:
+                passed &= (DPs[:, norm] >= args.normDP).all(axis=1)
+            if args.normCount:
+                passed &= (ADs[:, norm] <= args.normCount).all(axis=1)
+            if args.normAF:
+                passed &= ~chunk.afs.compare(operator.gt, args.normAF)[:, norm].any(axis=1)
+
+        # tumor samples filtering
+        # if parameters are provided, have to make sure the same sample passes them
+        if tumFlag == 0:
+            passed &= ((GTs[:, tum] == HET) | (GTs[:, tum] == HOM_ALT)).any(axis=1)
+        elif tumFlag == 1:
+            tum_passed = []
+            if args.tumDP:
+                tum_passed.append(DPs[:, tum] >= args.tumDP)
+            if args.tumCount:
+                tum_passed.append(ADs[:, tum] >= args.tumCount)
+            if args.tumAF:
+                tum_passed.append(chunk.afs.compare(operator.ge, args.tumAF)[:, tum])
+            # the samples passing every parameter so far; as it always has,
+            # a parameter no sample passed doesn't count against the next one
+            final = np.zeros(tum_passed[0].shape, dtype=bool)
+            for p in tum_passed:
+                final = np.where(final.any(axis=1)[:, None], final & p, p)
+            passed &= final.any(axis=1)
 
-            # reset values so that records don't retain old annotations.
-            cursor = conn.bind.connect()
-            cursor.execute("UPDATE variants SET " + is_somatic + " = 0")
+        normal = np.flatnonzero(norm)
+        tumor = np.flatnonzero(tum)
+        lines = []
+        for i in np.flatnonzero(passed):
+            row = chunk.rows[i]
+            AFs = [chunk.afs.value(i, j) for j in range(len(self.samples))]
+            lines.append('\t'.join(str(s) for s in [row['variant_id'], row['chrom'], row['start'], row['end'], row['ref'], \
+                                                     row['alt'], row['gene'], list(GTs[i, normal]), list(GTs[i, tumor]), \
+                                                     list(DPs[i, normal]), list(DPs[i, tumor]), list(ADs[i, normal]), \
+                                                     list(ADs[i, tumor]), [AFs[j] for j in normal], [AFs[j] for j in tumor]]))
+        return passed, lines
 
-            # now set the identified mutations to True.
-            update_qry = "UPDATE variants SET " + is_somatic + " = 1 "
-            update_qry += " WHERE variant_id IN (%s)"
-            update_qry %= ",".join(str(x[1]) for x in somatic_v_ids)
-            res = conn.execute(update_qry)
-            assert res.rowcount == somatic_counter
-            print("Identified and set", somatic_counter, "somatic mutations")
 
-            # create an index on is_somatic
-            cmd = 'create index var_som_idx on variants(' + is_somatic +')'
-            try:
-                conn.execute(cmd)
-            except sql.exc.OperationalError:
-                sys.stderr.write("WARNING: Index \"("
+def write_somatics(db, found, updates):
+    """
+    set the is_somatic_<patient> columns of the `found` patients from the
+    (flags..., variant_id) `updates`, in one pass over the variants to
+    reset them and one executemany per BUFFER_SIZE somatic variants.
+    """
+    # establish a connection to the database
+    from . import database
+
+    _, metadata = database.get_session_metadata(db)
+    existing = metadata.tables['variants'].columns
+    columns = [s.column for s in found]
+
+    with database.database_transaction(db) as conn:
+        # alter the database by adding a new is_somatic column per patient
+        for is_somatic in columns:
+            if is_somatic in existing:
+                sys.stderr.write("WARNING: Column \"("
                                  + is_somatic
-                                 + ")\" already exists for variants table. Overwriting index.\n")
+                                 + ")\" already exists in variants table. Overwriting values.\n")
+            else:
+                conn.execute("ALTER TABLE variants ADD " + is_somatic + " INTEGER DEFAULT 0")
 
-            # save the results
-            conn.commit()
-        else:
-            print("Would have identified and set", somatic_counter, "somatic mutations")
+        # reset values so that records don't retain old annotations.
+        conn.execute("UPDATE variants SET " + ", ".join(c + " = 0" for c in columns))
+
+        # now set the identified mutations to True.
+        update_qry = "UPDATE variants SET " + ", ".join(c + " = ?" for c in columns) \
+            + " WHERE variant_id = ?"
+        for i in range(0, len(updates), BUFFER_SIZE):
+            conn.execute(update_qry, updates[i:i + BUFFER_SIZE])
+
+
+def index_somatics(db, is_somatic):
+    """ create an index on is_somatic """
+    from . import database
+    import sqlalchemy as sql
+
+    conn, metadata = database.get_session_metadata(db)
+    cmd = 'create index var_som_idx on variants(' + is_somatic +')'
+    try:
+        conn.execute(cmd)
+    except sql.exc.OperationalError:
+        sys.stderr.write("WARNING: Index \"("
+                         + is_somatic
+                         + ")\" already exists for variants table. Overwriting index.\n")
+    # save the results
+    conn.commit()
 
 def set_somatic(parser, args):
 
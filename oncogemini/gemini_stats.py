@@ -6,7 +6,9 @@ from collections import Counter
 from . import compression as Z
 
 import sqlalchemy as sql
+from . import database
 from . import gemini_utils as util
+from . import parallel
 from .gemini_constants import *
 from . import GeminiQuery
 
@@ -138,6 +140,26 @@ def get_sfs(conn, metadata, args):
         print('\t'.join([str(row[0]), str(row[1])]))
 
 
+def _snp_gt_types(db):
+    """
+    the gt_types of the snps of `db` as (variants x samples) blocks of up
+    to BUFFER_SIZE variants.
+    """
+    conn, metadata = database.get_session_metadata(db, read_only=True)
+    unpack = Z.get_unpacker(util.get_features(metadata))
+    block = []
+    try:
+        for row in conn.execute(sql.text("SELECT gt_types FROM variants WHERE type = 'snp'")):
+            block.append(unpack(row[0]))
+            if len(block) == BUFFER_SIZE:
+                yield np.vstack(block)
+                block = []
+    finally:
+        conn.close()
+    if block:
+        yield np.vstack(block)
+
+
 def get_mds(conn, metadata, args):
     """
     Compute the pairwise genetic distance between each sample.
@@ -147,42 +169,25 @@ def get_mds(conn, metadata, args):
     for row in res:
         idx_to_sample[int(row['sample_id']) - 1] = row['name']
 
-    query = "SELECT DISTINCT v.variant_id, v.gt_types\
-    FROM variants v\
-    WHERE v.type = 'snp'"
-    res = conn.execute(query)
-
-    # keep a list of numeric genotype values
-    # for each sample
-    genotypes = collections.defaultdict(list)
-    import zlib
-    unpack = Z.unpack_genotype_blob
-
-    for row in res:
-
-        try:
-            gt_types = unpack(row['gt_types'])
-        except zlib.error:
-            unpack = Z.snappy_unpack_blob
-            gt_types = unpack(row['gt_types'])
+    # the gt_types of the snps as a (variants x samples) array. with
+    # --cores, the variants are read and decoded by separate processes.
+    blocks = list(parallel.imap(args.db, args.cores,
+                                lambda: _snp_gt_types(args.db)))
 
-        # at this point, gt_types is a numpy array
-        # idx:  0 1 2 3 4 5 6 .. #samples
-        # type [0 1 2 1 2 0 0 ..         ]
-        for idx, gt_type in enumerate(gt_types):
-            sample = idx_to_sample[idx]
-            genotypes[sample].append(gt_type)
+    # keep the numeric genotype values for each sample
+    genotypes = collections.OrderedDict()
+    if blocks:
+        # samples x variants, so each sample's values are contiguous
+        gt_types = np.ascontiguousarray(np.vstack(blocks).T)
+        for idx in range(len(gt_types)):
+            genotypes[idx_to_sample[idx]] = gt_types[idx]
 
     mds = collections.defaultdict(float)
-    # convert the genotype list for each sample
-    # to a numpy array for performance.
     # masks stores an array of T/F indicating which genotypes are
     # known (True, [0,1,2]) and unknown (False [-1]).
     masks = {}
     for s in genotypes:
         sample = str(s)
-        x = np.array(genotypes[sample])
-        genotypes[sample] = x
         masks[sample] = \
             np.ma.masked_where(genotypes[sample] != UNKNOWN,
                                genotypes[sample]).mask
@@ -283,7 +288,7 @@ def summarize_query_by_sample(args):
 def stats(parser, args):
 
     from . import database
-    conn, metadata = database.get_session_metadata(args.db)
+    conn, metadata = database.get_session_metadata(args.db, read_only=True)
 
     if args.tstv:
         get_tstv(conn, metadata, args)
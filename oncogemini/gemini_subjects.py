@@ -106,7 +106,7 @@ def get_families(db, selected_families=None):
     Query the samples table to return a list of Family
     objects that each contain all of the Subjects in a Family.
     """
-    conn, metadata = database.get_session_metadata(db)
+    conn, metadata = database.get_session_metadata(db, read_only=True)
 
     families_dict = Family.from_cursor(conn)
 
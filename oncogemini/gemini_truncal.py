@@ -1,7 +1,10 @@
 #!/usr/bin/env python
-from __future__ import absolute_import
+from __future__ import absolute_import, print_function
 from . import GeminiQuery
 from . import gemini_utils as utils
+from . import gemini_patient_stats as stats
+from . import tumor_engine as engine
+import operator
 import sys
 
 # Truncal mutations are categorized as being absent 
@@ -71,135 +74,64 @@ def truncal(parser, args):
     # that patient will be used
     # also verify that patient is among possible patient_ids
     # sample names are saved to patient specific dict
+    # with --all-patients, every patient is processed in the same pass
     patients = []
     names = {}
     utils.get_names(gq,patients,names)
-    patient = utils.get_patient(patient,patients)
-    if args.somatic_only:
-        is_somatic = 'is_somatic_' + patient
-    samples = utils.get_samples(patient,names,samples)
-    
-    # iterate again through each sample and save which sample is the normal
-    # non-normal, tumor sample names are saved to a list
-    # establish which timepoints belong to which samples names
-    # this is done for the specified --patient and --samples
-    # designate the last and first time points
-    gq.run(query)
-    normal_samples = []
-    tumor_samples = []
-    timepoints = {}
-    samples_tps = {}
-    utils.sort_samples(gq,normal_samples,tumor_samples,timepoints,samples_tps,patient,samples)
-
-    # check arrays to see if samples have been added
-    # if arrays are empty there is probably a problem in samples
-    # check the ped file being loaded into the db
-    if len(normal_samples) == 0:
-        sys.exit("There are no normal samples; check the sample manifest file for proper format and loading")
-    if len(tumor_samples) == 0:
-        sys.exit("There are no tumor samples; check the sample manifest file for proper format and loading")
-
-    # create a new connection to the database that includes the genotype columns
-    # using the database passed in as an argument via the command line
-    gq = GeminiQuery.GeminiQuery(args.db, include_gt_cols=True)
-    
-    # define the truncal query
-    if args.columns is not None:
-        columns = args.columns
-        if cancers != 'none':
-            columns = args.columns + ",civic_gene_abbreviations,cgi_gene_abbreviations"
-    else:
-        columns = args.columns
-    if args.filter is not None:
-        filter = args.filter
-        if args.somatic_only:
-            filter = args.filter + 'and ' + is_somatic + '==1'
-    else:
-        filter = str(1)
-        if args.somatic_only:
-            filter = is_somatic + '==1'
-    query = utils.make_query(columns,filter)
 
-    # execute the truncal query
-    gq.run(query)
+    def setup(patient):
+        patient_samples = engine.patient_samples(names, patient, samples, args.all_patients)
 
-    # get the sample index numbers so we can get sample specific GT info (AFs, DPs, etc.)
-    smp2idx = gq.sample_to_idx
-
-    # print header and add the AFs of included samples and the calculated slope
-    addHeader = []
-    header = gq.header.split('\t')
-    if cancers != 'none':
-        addHeader.extend(header[:len(header)-2])
-    else:
-        addHeader.extend(header)
-    for key in timepoints:
-        for s in timepoints[key]:
-            if s in samples:
-                af = 'alt_AF.' + s
-                addHeader.append(af)
-                if args.purity:
-                    raw = 'raw.alt_AF.' + s
-                    addHeader.append(raw)
-    print '\t'.join(addHeader)
-
-    # iterate through each row of the truncal results and print
-    for row in gq:
-        output = []
-        out = str(row).split('\t')
-        if cancers != 'none':
-            output.extend(out[:len(out)-2])
-        else:
-            output.extend(out)
-        normAFs = []
-        tumsAFs = []
-        depths = []
-        quals = []
-        addEnd = []
-        for key in timepoints:
-            for s in timepoints[key]:
-                if s in samples:
-                    smpidx = smp2idx[s]
-                    if args.purity:
-                        sampleAF = utils.purityAF(row['gt_alt_freqs'][smpidx],purity[s])
-                        rawAF = row['gt_alt_freqs'][smpidx]
-                    else:
-                        sampleAF = row['gt_alt_freqs'][smpidx]
-                    if s in normal_samples and sampleAF >= 0:
-                        normAFs.append(sampleAF)
-                    if s in tumor_samples and sampleAF >= 0:
-                        tumsAFs.append(sampleAF)
-                    sampleDP = row['gt_depths'][smpidx]
-                    depths.append(sampleDP)
-                    sampleGQ = row['gt_quals'][smpidx]
-                    quals.append(sampleGQ)
-                    addEnd.append(str(sampleAF))
-                    if args.purity:
-                        addEnd.append(str(rawAF))
-
-        # if there are now no values in normal or tumor list, skip variant
-        if len(normAFs) == 0 or len(tumsAFs) == 0:
-            continue
-
-        #check that requirements have been met
-        if min(depths) < minDP or min(quals) < minGQ:
-            continue
-        if len(normAFs) > 0 and max(normAFs) > maxNorm:
-            continue
-        if any(af <= (maxNorm + increase) for af in tumsAFs):
-            continue
-
-        # print results that meet the requirements
-        # if args.cancer has been used, filter results to cancer matches
-        # add selected sample AFs
-        output.extend(addEnd)
-        if cancers != 'none':
-            abbrevs = str(row['civic_gene_abbreviations']).split(',') + str(row['cgi_gene_abbreviations']).split(',')
-            include = 0
-            for c in cancers:
-                if c in abbrevs:
-                    include += 1
-            if include > 0:
-                print '\t'.join(output)
-        else:
-            print '\t'.join(output)
+        # iterate again through each sample and save which sample is the normal
+        # non-normal, tumor sample names are saved to a list
+        # establish which timepoints belong to which samples names
+        # this is done for the specified --patient and --samples
+        # designate the last and first time points
+        gq.run(query)
+        normal_samples = []
+        tumor_samples = []
+        timepoints = {}
+        samples_tps = {}
+        utils.sort_samples(gq,normal_samples,tumor_samples,timepoints,samples_tps,patient,patient_samples)
+
+        # check arrays to see if samples have been added
+        # if arrays are empty there is probably a problem in samples
+        # check the ped file being loaded into the db
+        if len(normal_samples) == 0:
+            raise engine.PatientError("There are no normal samples; check the sample manifest file for proper format and loading")
+        if len(tumor_samples) == 0:
+            raise engine.PatientError("There are no tumor samples; check the sample manifest file for proper format and loading")
+
+        # the AFs of the included samples are reported in timepoint order
+        cols = engine.ordered_samples(timepoints, patient_samples)
+        normal = engine.column_mask(cols, normal_samples)
+        tumor = engine.column_mask(cols, tumor_samples)
+
+        def select(chunk):
+            afs = chunk.afs
+            valid = afs.valid()
+            # there must be AFs for the normal and tumor samples,
+            # all normal AFs at most maxNorm and all tumor AFs
+            # above maxNorm plus the increase
+            passed = chunk.well_covered(minDP, minGQ)
+            passed &= (valid & normal).any(axis=1) & (valid & tumor).any(axis=1)
+            passed &= ~afs.any(operator.gt, maxNorm, normal)
+            passed &= ~afs.any(operator.le, maxNorm + increase, tumor)
+            return passed
+
+        # the same thresholds on the patient's precomputed statistics, if any
+        pushdown = stats.pushdown(args, patient, samples,
+                                  [("normal_max_af", "<=", maxNorm),
+                                   ("tumor_min_af", ">", maxNorm + increase)],
+                                  minDP, minGQ)
+
+        somatic = 'is_somatic_' + patient if args.somatic_only else None
+        return engine.Report(cols, select, somatic=somatic, pushdown=pushdown)
+
+    reports = engine.patients_to_run(args, patient, patients, names, setup)
+
+    # query the variants with their genotype columns (split across --cores
+    # processes) and print the results that meet the requirements
+    # if args.cancer has been used, filter results to cancer matches
+    engine.run(args, reports, purity=purity if args.purity else None,
+               cancers=cancers)
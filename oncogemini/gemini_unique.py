@@ -1,7 +1,10 @@
 #!/usr/bin/env python
-from __future__ import absolute_import
+from __future__ import absolute_import, print_function
 from . import GeminiQuery
 from . import gemini_utils as utils
+from . import gemini_patient_stats as stats
+from . import tumor_engine as engine
+import operator
 import sys
 
 #Unique mutations are unique to the individual sample(s)
@@ -70,148 +73,91 @@ def unique(parser, args):
     # that patient will be used
     # also verify that patient is among possible patient_ids
     # sample names are saved to patient specific dict
+    # with --all-patients, every patient with --specific samples
+    # is processed in the same pass
     patients = []
     names = {}
     utils.get_names(gq,patients,names)
-    patient = utils.get_patient(patient,patients)
-    if args.somatic_only:
-        is_somatic = 'is_somatic_' + patient
-    samples = utils.get_samples(patient,names,samples)
-
-    #Make sure the samples requested with --specific are present
-    for s in specific:
-        if s not in samples:
-            sys.exit("Sample listed with --specific, " + s + ", is not found, check the sample manifest file for available samples")
-
-    # iterate again through each sample and save which sample is the normal
-    # non-normal, tumor sample names are saved to a list
-    # establish which timepoints belong to which samples names
-    # this is done for the specified --patient and --samples
-    # designate the last and first time points
-    gq.run(query)
-    other_samples = []
-    unique_samples = []
-    timepoints = {}
-    for row in gq:
-        if row['patient_id'] == patient and row['name'] in samples:
-            if row['name'] in specific:
-                unique_samples.append(row['name'])
-            elif row['name'] not in specific:
-                other_samples.append(row['name'])
-            if int(row['time']) not in timepoints:
-                timepoints[int(row['time'])] = []
-            timepoints[int(row['time'])].append(row['name'])
-    
-    # check arrays to see if samples have been added
-    # if arrays are empty there is probably a problem in samples
-    # check the ped file being loaded into the db
-    if len(other_samples) == 0 and len(unique_samples) == 0:
-        sys.exit("There are no samples; check the sample manifest file for proper format and loading")
-    if len(other_samples) == 0 and len(unique_samples) > 0:
-        sys.exit("There are no other samples to compare --specific samples to; check the sample manifest file for proper format and loading")
-    if len(unique_samples) == 0:
-        sys.exit("There are no --specific samples; check the sample manifest file for proper format and loading")
-
-    # create a new connection to the database that includes the genotype columns
-    # using the database passed in as an argument via the command line
-    gq = GeminiQuery.GeminiQuery(args.db, include_gt_cols=True)
-    
-    # define the unique query
-    if args.columns is not None:
-        columns = args.columns
-        if cancers != 'none':
-            columns = args.columns + ",civic_gene_abbreviations,cgi_gene_abbreviations"
-    else:
-        columns = args.columns
-    if args.filter is not None:
-        filter = args.filter
-        if args.somatic_only:
-            filter = args.filter + 'and ' + is_somatic + '==1'
-    else:
-        filter = str(1)
-        if args.somatic_only:
-            filter = is_somatic + '==1'
-    query = utils.make_query(columns,filter)
-
-    # execute the unique query
-    gq.run(query)
 
-    # get the sample index numbers so we can get sample specific GT info (AFs, DPs, etc.)
-    smp2idx = gq.sample_to_idx
+    def setup(patient):
+        patient_samples = engine.patient_samples(names, patient, samples, args.all_patients)
 
-    # print header and add the AFs of included samples and the calculated slope
-    addHeader = []
-    header = gq.header.split('\t')
-    if cancers != 'none':
-        addHeader.extend(header[:len(header)-2])
-    else:
-        addHeader.extend(header)
-    for key in timepoints:
-        for s in timepoints[key]:
-            if s in specific:
-                af = 'alt_AF.' + s
-                addHeader.append(af)
-                if args.purity:
-                    raw = 'raw.alt_AF.' + s
-                    addHeader.append(raw)
-    print '\t'.join(addHeader)
-
-    # iterate through each row of the unique results and print
-    for row in gq:
-        output = []
-        out = str(row).split('\t')
-        if cancers != 'none':
-            output.extend(out[:len(out)-2])
+        #Make sure the samples requested with --specific are present
+        if args.all_patients:
+            patient_specific = [s for s in specific if s in patient_samples]
+            if len(patient_specific) == 0:
+                raise engine.PatientError("no --specific samples")
         else:
-            output.extend(out)
-        otherAFs = []
-        uniqAFs = []
-        depths = []
-        quals = []
-        addEnd = []
-        for key in timepoints:
-            for s in timepoints[key]:
-                if s in samples:
-                    smpidx = smp2idx[s]
-                    if args.purity:
-                        sampleAF = utils.purityAF(row['gt_alt_freqs'][smpidx],purity[s])
-                        rawAF = row['gt_alt_freqs'][smpidx]
-                    else:
-                        sampleAF = row['gt_alt_freqs'][smpidx]
-                    if s in specific:
-                        if sampleAF >= 0:
-                            uniqAFs.append(sampleAF)
-                        addEnd.append(str(sampleAF))
-                        if args.purity:
-                            addEnd.append(str(rawAF))
-                    if s not in specific and sampleAF >= 0:
-                        otherAFs.append(sampleAF)
-                    sampleDP = row['gt_depths'][smpidx]
-                    depths.append(sampleDP)
-                    sampleGQ = row['gt_quals'][smpidx]
-                    quals.append(sampleGQ)
-
-        #check that requirements have been met
-        if min(depths) < minDP or min(quals) < minGQ:
-            continue
-        if len(otherAFs) == 0 or len(uniqAFs) == 0:
-            continue
-        if len(otherAFs) > 0 and max(otherAFs) > maxOthers:
-            continue
-        if any(af <= (maxOthers + increase) for af in uniqAFs):
-            continue
-
-        # print results that meet the requirements
-        # if args.cancer has been used, filter results to cancer matches
-        # add selected sample AFs
-        output.extend(addEnd)
-        if cancers != 'none':
-            abbrevs = str(row['civic_gene_abbreviations']).split(',') + str(row['cgi_gene_abbreviations']).split(',')
-            include = 0
-            for c in cancers:
-                if c in abbrevs:
-                    include += 1
-            if include > 0:
-                print '\t'.join(output)
-        else:
-            print '\t'.join(output)
+            patient_specific = specific
+            for s in specific:
+                if s not in patient_samples:
+                    raise engine.PatientError("Sample listed with --specific, " + s + ", is not found, check the sample manifest file for available samples")
+
+        # iterate again through each sample and save which sample is the normal
+        # non-normal, tumor sample names are saved to a list
+        # establish which timepoints belong to which samples names
+        # this is done for the specified --patient and --samples
+        # designate the last and first time points
+        gq.run(query)
+        other_samples = []
+        unique_samples = []
+        timepoints = {}
+        for row in gq:
+            if row['patient_id'] == patient and row['name'] in patient_samples:
+                if row['name'] in patient_specific:
+                    unique_samples.append(row['name'])
+                elif row['name'] not in patient_specific:
+                    other_samples.append(row['name'])
+                if int(row['time']) not in timepoints:
+                    timepoints[int(row['time'])] = []
+                timepoints[int(row['time'])].append(row['name'])
+
+        # check arrays to see if samples have been added
+        # if arrays are empty there is probably a problem in samples
+        # check the ped file being loaded into the db
+        if len(other_samples) == 0 and len(unique_samples) == 0:
+            raise engine.PatientError("There are no samples; check the sample manifest file for proper format and loading")
+        if len(other_samples) == 0 and len(unique_samples) > 0:
+            raise engine.PatientError("There are no other samples to compare --specific samples to; check the sample manifest file for proper format and loading")
+        if len(unique_samples) == 0:
+            raise engine.PatientError("There are no --specific samples; check the sample manifest file for proper format and loading")
+
+        cols = engine.ordered_samples(timepoints, patient_samples)
+        uniq = engine.column_mask(cols, patient_specific)
+
+        def select(chunk):
+            afs = chunk.afs
+            valid = afs.valid()
+            # other AFs must all be at most maxOthers and the AFs
+            # of the --specific samples above maxOthers plus the increase
+            passed = chunk.well_covered(minDP, minGQ)
+            passed &= (valid & ~uniq).any(axis=1) & (valid & uniq).any(axis=1)
+            passed &= ~afs.any(operator.gt, maxOthers, ~uniq)
+            passed &= ~afs.any(operator.le, maxOthers + increase, uniq)
+            return passed
+
+        # on the patient's precomputed statistics, if any: the normals are
+        # among the other samples unless --specific names one, and some
+        # tumor AF is above maxOthers plus the increase if --specific only
+        # names tumors
+        normals = timepoints.get(0, [])
+        tumors = [s for t in timepoints if t > 0 for s in timepoints[t]]
+        conditions = []
+        if not set(patient_specific) & set(normals):
+            conditions.append(("normal_max_af", "<=", maxOthers, True))
+        if set(patient_specific) <= set(tumors):
+            conditions.append(("tumor_max_af", ">", maxOthers + increase))
+        pushdown = stats.pushdown(args, patient, samples, conditions, minDP, minGQ)
+
+        # only the AFs of the --specific samples are reported
+        somatic = 'is_somatic_' + patient if args.somatic_only else None
+        return engine.Report(cols, select, report=[s for s in cols if s in patient_specific],
+                             somatic=somatic, pushdown=pushdown)
+
+    reports = engine.patients_to_run(args, patient, patients, names, setup)
+
+    # query the variants with their genotype columns (split across --cores
+    # processes) and print the results that meet the requirements
+    # if args.cancer has been used, filter results to cancer matches
+    engine.run(args, reports, purity=purity if args.purity else None,
+               cancers=cancers)
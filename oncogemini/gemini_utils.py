@@ -35,6 +35,16 @@ def get_gt_cols(metadata):
         # if there's no variants table, there are no gt_cols.
         return []
 
+def get_features(metadata):
+    """
+    Return the rows of the features table, e.g. ["genotype_codec:zlib"]
+    """
+    try:
+        tbl = metadata.tables["features"]
+    except KeyError:
+        return []
+    return [row['feature'] for row in tbl.select().execute()]
+
 def map_indices_to_samples(metadata):
     """Return a dict mapping samples indices in the
        numpy arrays (key) to sample names.
@@ -0,0 +1,639 @@
+"""
+Parse --gt-filter expressions into a typed expression tree that is evaluated
+with numpy over blocks of variants.
+
+For example:
+
+    gt_types.S1 == HET and (gt_depths).(phenotype==2).(>=20).(all)
+
+becomes
+
+    And(Compare('==', SampleRef('gt_types', 0), Const(1)),
+        Wildcard('gt_depths', [3, 5], '>=', Const(20), 'all'))
+
+Every node evaluates against a "source" that hands out (variants x samples)
+slices of the decoded gt columns, so a wildcard over 500 samples costs one
+comparison and one reduction per block of variants rather than a Python loop
+per row. Only the constructs below are accepted, which replaces the old
+blacklist of dangerous strings for eval().
+
+>>> names = {'S1': 0, 'S2': 1, 'S3': 2}
+>>> match = lambda wildcard: [(0, 'S1'), (2, 'S3')]
+>>> tree = parse("gt_types.S2 == HET and (gt_depths).(phenotype==2).(>=20).(all)",
+...              ['gt_types', 'gt_depths'], names, match)
+>>> tree
+And(Compare('==', SampleRef('gt_types', 1), Const(1)), Wildcard('gt_depths', [0, 2], '>=', Const(20), 'all'))
+>>> sorted(tree.columns)
+['gt_depths', 'gt_types']
+>>> src = MatrixSource({'gt_types': np.array([[0, 1, 0], [1, 1, 1], [3, 0, 3]]),
+...                     'gt_depths': np.array([[30, 5, 20], [30, 50, 19], [40, 40, 40]])}, 3)
+>>> evaluate(tree, src).tolist()
+[True, False, False]
+>>> tree.to_python()
+'(gt_types[1] == 1 and ((gt_depths[0] >= 20) and (gt_depths[2] >= 20)))'
+
+>>> evaluate(parse("(gt_types).(*).(!=HOM_REF).(count>=3) or not gt_depths.S1 > 35",
+...                ['gt_types', 'gt_depths'], names, lambda w: [(0, 'S1'), (1, 'S2'), (2, 'S3')]),
+...          src).tolist()
+[True, True, False]
+
+>>> parse("__import__('os').system('ls')", ['gt_types'], names, match)
+Traceback (most recent call last):
+...
+ValueError: invalid --gt-filter: unexpected "__import__" at position 0
+>>> parse("(gt_alt_freqs).(*).(>0.2).(any)", ['gt_alt_freqs'], names, match)
+Wildcard('gt_alt_freqs', [0, 2], '>', Const(0.2), 'any')
+>>> parse("(gt_types).(*).(==HOM_ALT).(amy)", ['gt_types'], names, match)
+Traceback (most recent call last):
+...
+ValueError: Unsupported wildcard operation: (amy). Exiting.
+"""
+from __future__ import absolute_import
+
+import operator
+import re
+
+import numpy as np
+
+from .gemini_constants import HOM_REF, HET, HOM_ALT, UNKNOWN
+
+CONSTANTS = {'HOM_REF': HOM_REF, 'HET': HET, 'HOM_ALT': HOM_ALT,
+             'UNKNOWN': UNKNOWN, 'True': True, 'False': False, 'None': None}
+
+COMPARE = {'==': operator.eq, '!=': operator.ne, '<': operator.lt,
+           '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+ARITHMETIC = {'+': operator.add, '-': operator.sub, '*': operator.mul,
+              '/': operator.truediv, '%': operator.mod}
+
+# (COLUMN).(SAMPLE_WILDCARD).(SAMPLE_WILDCARD_RULE).(RULE_ENFORCEMENT)
+WILDCARD = re.compile(r'(\(\s*gt\w+\s*\)\.\(.+?\)\.\(.+?\)\.\(.+?\))')
+WILDCARD_PARTS = re.compile(r'^\(\s*(gt\w+)\s*\)\.\((.+?)\)\.\((.+?)\)\.\((.+?)\)$')
+MAYBE_WILDCARD = re.compile(r'\(\s*gt\w+\s*\)\.\(', re.IGNORECASE)
+
+TOKEN = re.compile(r"""\s*(?:
+      (?P<ref>[gG][tT]\w*\.[^\s()=!<>'"]+)
+    | (?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+    | (?P<str>'[^']*'|"[^"]*")
+    | (?P<word>[A-Za-z_]\w*)
+    | (?P<op>==|!=|<=|>=|<|>|\+|-|\*|/|%|,)
+    | (?P<paren>[()])
+    )""", re.VERBOSE)
+
+
+def _truth(values, n):
+    """boolean mask of length n from the result of a node."""
+    values = np.asarray(values)
+    if values.dtype.kind in 'SU':
+        values = values != values.dtype.type()
+    return np.broadcast_to(values.astype(bool), (n,))
+
+
+class MatrixSource(object):
+    """
+    Serve (variants x samples) slices from fully decoded gt columns, where
+    matrices[col] has one row per variant. `rows` restricts the source to a
+    subset of the variants (used to short-circuit and/or).
+    """
+
+    def __init__(self, matrices, n, rows=None):
+        self.matrices = matrices
+        self.n = n
+        self.rows = rows
+
+    def take(self, column, indices):
+        m = self.matrices[column]
+        if self.rows is None:
+            return m[:, indices]
+        return m[np.ix_(self.rows, indices)]
+
+    def subset(self, rows):
+        if self.rows is not None:
+            rows = self.rows[rows]
+        return self.__class__(self.matrices, len(rows), rows)
+
+
+class Node(object):
+    """
+    Base of the expression tree. `columns` is the set of gt columns a node
+    reads and `cost` the number of sample columns it touches, which is used
+    to order the operands of and/or so the cheap ones run first.
+    """
+    columns = frozenset()
+    cost = 0
+
+    def evaluate(self, source):
+        raise NotImplementedError
+
+    def to_python(self):
+        raise NotImplementedError
+
+
+class Const(Node):
+    def __init__(self, value):
+        self.value = value
+
+    def evaluate(self, source):
+        return self.value
+
+    def to_python(self):
+        return repr(self.value)
+
+    def __repr__(self):
+        return "Const(%r)" % (self.value,)
+
+
+class SampleRef(Node):
+    """ a single sample's value in a gt column, e.g. gt_types.S1 """
+    cost = 1
+
+    def __init__(self, column, idx):
+        self.column = column
+        self.idx = idx
+        self.columns = frozenset([column])
+
+    def evaluate(self, source):
+        return source.take(self.column, [self.idx])[:, 0]
+
+    def to_python(self):
+        return "%s[%d]" % (self.column, self.idx)
+
+    def __repr__(self):
+        return "SampleRef(%r, %d)" % (self.column, self.idx)
+
+
+class _Binary(Node):
+    OPS = {}
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+        self.columns = left.columns | right.columns
+        self.cost = left.cost + right.cost
+
+    def evaluate(self, source):
+        return self.OPS[self.op](self.left.evaluate(source),
+                                 self.right.evaluate(source))
+
+    def __repr__(self):
+        return "%s(%r, %r, %r)" % (self.__class__.__name__, self.op,
+                                   self.left, self.right)
+
+
+class Arithmetic(_Binary):
+    OPS = ARITHMETIC
+
+    def to_python(self):
+        return "(%s %s %s)" % (self.left.to_python(), self.op,
+                               self.right.to_python())
+
+
+class Compare(_Binary):
+    OPS = COMPARE
+
+    def to_python(self):
+        return "%s %s %s" % (self.left.to_python(), self.op,
+                             self.right.to_python())
+
+
+class Contains(Node):
+    """
+    `left` in (or not in) a tuple of constants, e.g. gt_types.S1 in (1, 3),
+    or a substring test when `right` is a string or a string column, e.g.
+    'C' in gts.S1.
+    """
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+        self.columns = left.columns | getattr(right, 'columns', frozenset())
+        self.cost = left.cost + getattr(right, 'cost', 0)
+
+    def evaluate(self, source):
+        left = self.left.evaluate(source)
+        if isinstance(self.right, tuple):
+            found = np.isin(left, np.array(self.right, dtype=object))
+        else:
+            right = np.asarray(self.right.evaluate(source)).astype(str)
+            found = np.char.find(right, np.asarray(left).astype(str)) >= 0
+        return ~found if self.op == 'not in' else found
+
+    def to_python(self):
+        right = self.right
+        right = repr(right) if isinstance(right, tuple) else right.to_python()
+        return "%s %s %s" % (self.left.to_python(), self.op, right)
+
+    def __repr__(self):
+        return "Contains(%r, %r, %r)" % (self.op, self.left, self.right)
+
+
+class Not(Node):
+    def __init__(self, child):
+        self.child = child
+        self.columns = child.columns
+        self.cost = child.cost
+
+    def evaluate(self, source):
+        return ~_truth(self.child.evaluate(source), source.n)
+
+    def to_python(self):
+        return "not (%s)" % self.child.to_python()
+
+    def __repr__(self):
+        return "Not(%r)" % (self.child,)
+
+
+class _Logical(Node):
+    # whether a row is settled once an operand evaluates to this value
+    SETTLED_BY = None
+    JOINER = None
+
+    def __init__(self, children):
+        self.children = sorted(children, key=lambda c: c.cost)
+        self.columns = frozenset().union(*[c.columns for c in children])
+        self.cost = sum(c.cost for c in children)
+
+    def evaluate(self, source):
+        # each operand is only evaluated on the rows that are still
+        # undecided, so e.g. a cheap single-sample test in front of a
+        # cohort-wide wildcard prunes most of the work.
+        result = np.empty(source.n, dtype=bool)
+        result.fill(not self.SETTLED_BY)
+        for child in self.children:
+            live = np.flatnonzero(result != self.SETTLED_BY)
+            if len(live) == 0:
+                break
+            sub = source if len(live) == source.n else source.subset(live)
+            result[live] = _truth(child.evaluate(sub), len(live))
+        return result
+
+    def to_python(self):
+        return "(%s)" % self.JOINER.join(c.to_python() for c in self.children)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__,
+                           ", ".join(repr(c) for c in self.children))
+
+
+class And(_Logical):
+    SETTLED_BY = False
+    JOINER = " and "
+
+
+class Or(_Logical):
+    SETTLED_BY = True
+    JOINER = " or "
+
+
+class Wildcard(Node):
+    """
+    (COLUMN).(SAMPLE_WILDCARD).(RULE).(all|any|none|countOPN) lowered to an
+    index array over the matching samples and a numpy reduction. When the
+    sample wildcard is =HET, =HOM_REF or =HOM_ALT the samples are instead
+    chosen per variant by their gt_types.
+    """
+
+    def __init__(self, column, indices, op, value, reducer, count_op=None,
+                 count_value=None, genotype=None):
+        self.column = column
+        self.indices = np.asarray(indices, dtype=np.intp)
+        self.op = op
+        self.value = value
+        self.reducer = reducer
+        self.count_op = count_op
+        self.count_value = count_value
+        self.genotype = genotype
+        columns = set([column]) | value.columns
+        if genotype is not None:
+            columns.add('gt_types')
+        self.columns = frozenset(columns)
+        self.cost = len(self.indices) * (1 + (genotype is not None)) + value.cost
+
+    def evaluate(self, source):
+        if len(self.indices) == 0:
+            passed = selected = np.zeros((source.n, 0), dtype=bool)
+        else:
+            value = np.asarray(self.value.evaluate(source))
+            if value.ndim == 1:
+                value = value[:, None]
+            passed = COMPARE[self.op](source.take(self.column, self.indices), value)
+            selected = None
+            if self.genotype is not None:
+                selected = source.take('gt_types', self.indices) == self.genotype
+                passed = passed & selected
+
+        if self.reducer == 'all':
+            if selected is None:
+                return passed.all(axis=1)
+            return (passed | ~selected).all(axis=1)
+        if self.reducer == 'any':
+            return passed.any(axis=1)
+        if self.reducer == 'none':
+            return ~passed.any(axis=1)
+        return COMPARE[self.count_op](passed.sum(axis=1), self.count_value)
+
+    def _sample_python(self, idx):
+        rule = "%s[%d] %s %s" % (self.column, idx, self.op, self.value.to_python())
+        if self.genotype is None:
+            return rule
+        return "gt_types[%d] == %d and %s" % (idx, self.genotype, rule)
+
+    def to_python(self):
+        rules = ["(%s)" % self._sample_python(i) for i in self.indices]
+        if self.reducer == 'count':
+            total = " + ".join("int%s" % r for r in rules) or "0"
+            return "(%s) %s %d" % (total, self.count_op, self.count_value)
+        if self.reducer == 'all':
+            if self.genotype is not None:
+                rules = ["(gt_types[%d] != %d or %s)" % (i, self.genotype, r)
+                         for i, r in zip(self.indices, rules)]
+            return "(%s)" % (" and ".join(rules) or "True")
+        anyone = "(%s)" % (" or ".join(rules) or "False")
+        return anyone if self.reducer == 'any' else "not " + anyone
+
+    def __repr__(self):
+        extra = ''
+        if self.reducer == 'count':
+            extra = ', %r, %r' % (self.count_op, self.count_value)
+        return "Wildcard(%r, %r, %r, %r, %r%s)" % (
+            self.column, self.indices.tolist(), self.op, self.value,
+            self.reducer, extra)
+
+
+def evaluate(tree, source):
+    """ boolean mask of the variants in `source` passing the filter """
+    return _truth(tree.evaluate(source), source.n)
+
+
+class _Parser(object):
+    """
+    Recursive descent over the tokens of a --gt-filter, following python's
+    precedence:
+
+        or < and < not < comparison, in, not in < +,- < *,/,% < unary minus
+    """
+
+    def __init__(self, gt_filter, gt_cols, sample_to_idx, match_samples):
+        self.gt_filter = gt_filter
+        self.gt_cols = set(gt_cols)
+        self.sample_to_idx = sample_to_idx
+        self.match_samples = match_samples
+        self.tokens = []
+        self.pos = 0
+
+    def error(self, msg):
+        raise ValueError("invalid --gt-filter: %s" % msg)
+
+    def parse(self):
+        for segment in WILDCARD.split(self.gt_filter):
+            if WILDCARD.match(segment):
+                self.tokens.append(('wild', self.wildcard(segment)))
+            elif MAYBE_WILDCARD.search(segment):
+                # something shaped like a wildcard, but not all 4 parts.
+                self.tokens.append(('wild', self.wildcard(segment.strip())))
+            else:
+                self.tokenize(segment)
+        if not self.tokens:
+            self.error("empty filter")
+        tree = self.or_expr()
+        if self.pos != len(self.tokens):
+            self.error("unexpected %r" % (self.tokens[self.pos][1],))
+        if not tree.columns:
+            self.error("no genotype column is referenced")
+        return tree
+
+    def tokenize(self, segment):
+        pos = 0
+        while segment[pos:].strip():
+            m = TOKEN.match(segment, pos)
+            if m is None:
+                start = len(segment) - len(segment[pos:].lstrip())
+                self.error('unexpected "%s" at position %d'
+                           % (segment[start:].split()[0], start))
+            kind = m.lastgroup
+            text = m.group(kind)
+            if kind == 'ref':
+                ref, consumed = self.sample_ref(text)
+                self.tokens.append(('ref', ref))
+                pos = m.start(kind) + consumed
+                continue
+            if kind == 'num':
+                value = float(text) if any(c in text for c in '.eE') else int(text)
+                self.tokens.append(('const', Const(value)))
+            elif kind == 'str':
+                self.tokens.append(('const', Const(text[1:-1])))
+            elif kind == 'word':
+                if text.lower() in ('and', 'or', 'not', 'in'):
+                    self.tokens.append((text.lower(), text))
+                elif text in CONSTANTS:
+                    self.tokens.append(('const', Const(CONSTANTS[text])))
+                elif text.lower() in self.gt_cols:
+                    self.error("%s needs a sample name, e.g. %s.SAMPLE"
+                               % (text, text))
+                else:
+                    self.error('unexpected "%s" at position %d'
+                               % (text, m.start(kind)))
+            else:
+                self.tokens.append((text, text))
+            pos = m.end()
+
+    def sample_ref(self, text):
+        """
+        split e.g. "gt_depths.S1+gt_depths.S2" into the reference to S1 and
+        the number of characters it used. sample names may themselves contain
+        '-' and friends, so prefer the longest known name.
+        """
+        column, sample = text.split('.', 1)
+        column = column.lower()
+        if column not in self.gt_cols:
+            self.error("unknown genotype column %s" % column)
+        end = len(sample)
+        while sample[:end] not in self.sample_to_idx:
+            cuts = [i for i, c in enumerate(sample[:end]) if c in '+-*/%']
+            if not cuts:
+                self.error("unknown sample %s" % sample)
+            end = cuts[-1]
+        return (SampleRef(column, self.sample_to_idx[sample[:end]]),
+                len(column) + 1 + end)
+
+    def wildcard(self, token):
+        m = WILDCARD_PARTS.match(token)
+        if m is not None:
+            # split on the regex so rules like (>0.2) are allowed
+            column, wildcard, rule, op = [t.strip() for t in m.groups()]
+        else:
+            if token.count('.') != 3 or token.count('(') != 4 or token.count(')') != 4:
+                raise ValueError("Wildcard filter should consist of 4 elements. Exiting.")
+            column, wildcard, rule, op = [t.strip()[1:-1].strip() for t in token.split('.')]
+        column = column.lower()
+        if column not in self.gt_cols:
+            self.error("unknown genotype column %s" % column)
+
+        genotype = None
+        # allow commands like (gt_quals).(=HET).(>=20).(all)
+        if wildcard in ("=HET", "=HOM_REF", "=HOM_ALT"):
+            genotype = CONSTANTS[wildcard[1:]]
+            wildcard = "*"
+        indices = [s[0] for s in self.match_samples(wildcard)]
+
+        rule_op, value = self.rule(rule, token)
+
+        count_op = count_value = None
+        if op in ("all", "any", "none"):
+            reducer = op
+        elif op.startswith("count"):
+            reducer = 'count'
+            count_op, count_value = self.rule(op[len("count"):], token)
+            if count_value.columns or not isinstance(count_value.value, int):
+                self.error("count must be compared to an integer in %s" % token)
+            count_value = count_value.value
+        else:
+            raise ValueError("Unsupported wildcard operation: (%s). Exiting." % op)
+        return Wildcard(column, indices, rule_op, value, reducer,
+                        count_op, count_value, genotype)
+
+    def rule(self, text, token):
+        """ parse e.g. '!= HOM_REF' into ('!=', Const(0)) """
+        sub = _Parser(text, self.gt_cols, self.sample_to_idx, self.match_samples)
+        sub.tokenize(text)
+        if not sub.tokens or sub.tokens[0][0] not in COMPARE:
+            self.error("expected a comparison in %s" % token)
+        op = sub.tokens[0][0]
+        sub.pos = 1
+        value = sub.sum_expr()
+        if sub.pos != len(sub.tokens):
+            self.error("unexpected %r in %s" % (sub.tokens[sub.pos][1], token))
+        return op, value
+
+    def peek(self, ahead=0):
+        if self.pos + ahead < len(self.tokens):
+            return self.tokens[self.pos + ahead][0]
+        return None
+
+    def take(self):
+        tok = self.tokens[self.pos]
+        self.pos += 1
+        return tok
+
+    def or_expr(self):
+        children = [self.and_expr()]
+        while self.peek() == 'or':
+            self.take()
+            children.append(self.and_expr())
+        return children[0] if len(children) == 1 else Or(children)
+
+    def and_expr(self):
+        children = [self.not_expr()]
+        while self.peek() == 'and':
+            self.take()
+            children.append(self.not_expr())
+        return children[0] if len(children) == 1 else And(children)
+
+    def not_expr(self):
+        if self.peek() == 'not':
+            self.take()
+            return Not(self.not_expr())
+        return self.comparison()
+
+    def comparison(self):
+        # a < b < c is (a < b) and (b < c), as in python.
+        left = self.sum_expr()
+        parts = []
+        while True:
+            if self.peek() in COMPARE:
+                op = self.take()[0]
+                right = self.sum_expr()
+                parts.append(Compare(op, left, right))
+            elif self.peek() == 'in' or (self.peek() == 'not' and self.peek(1) == 'in'):
+                op = 'in'
+                if self.take()[0] == 'not':
+                    self.take()
+                    op = 'not in'
+                right = self.container()
+                parts.append(Contains(op, left, right))
+                if isinstance(right, tuple):
+                    break
+            else:
+                break
+            left = right
+        if not parts:
+            return left
+        return parts[0] if len(parts) == 1 else And(parts)
+
+    def container(self):
+        """
+        the right side of in / not in: a tuple of constants, e.g. (HET,
+        HOM_ALT), or an expression whose value is a string.
+        """
+        if self.peek() != '(':
+            return self._string(self.sum_expr())
+        self.take()
+        items = [self.sum_expr()]
+        comma = False
+        while self.peek() == ',':
+            self.take()
+            comma = True
+            if self.peek() == ')':
+                break
+            items.append(self.sum_expr())
+        if self.peek() != ')':
+            self.error("missing ')'")
+        self.take()
+        if not comma:
+            return self._string(items[0])
+        if any(item.columns for item in items):
+            self.error("in needs a tuple of constants, e.g. (HET, HOM_ALT)")
+        return tuple(item.evaluate(None) for item in items)
+
+    def _string(self, node):
+        if isinstance(node, Const) and not isinstance(node.value, str):
+            self.error("in needs a tuple of constants, e.g. (HET, HOM_ALT), or a string")
+        return node
+
+    def sum_expr(self):
+        left = self.term()
+        while self.peek() in ('+', '-'):
+            left = Arithmetic(self.take()[0], left, self.term())
+        return left
+
+    def term(self):
+        left = self.unary()
+        while self.peek() in ('*', '/', '%'):
+            left = Arithmetic(self.take()[0], left, self.unary())
+        return left
+
+    def unary(self):
+        if self.peek() == '-':
+            self.take()
+            return Arithmetic('-', Const(0), self.unary())
+        return self.atom()
+
+    def atom(self):
+        kind = self.peek()
+        if kind in ('const', 'ref', 'wild'):
+            return self.take()[1]
+        if kind == '(':
+            self.take()
+            node = self.or_expr()
+            if self.peek() != ')':
+                self.error("missing ')'")
+            self.take()
+            return node
+        if kind is None:
+            self.error("unexpected end of filter")
+        self.error("unexpected %r" % (self.tokens[self.pos][1],))
+
+
+def parse(gt_filter, gt_cols, sample_to_idx, match_samples):
+    """
+    Parse a --gt-filter into an expression tree.
+
+    gt_cols is the list of gt_* columns in the database, sample_to_idx maps
+    sample names to their offset in the genotype arrays and match_samples(sql)
+    returns the (offset, name) tuples of the samples matching a wildcard such
+    as "phenotype==2" or "*". Raises ValueError on anything that is not a
+    valid genotype filter.
+    """
+    return _Parser(gt_filter, gt_cols, sample_to_idx, match_samples).parse()
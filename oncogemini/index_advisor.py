@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+"""
+Find the tables a query reads in full (EXPLAIN QUERY PLAN) and the indexes
+that would let SQLite search them instead. Databases only come with indexes
+on the usual columns, while the tools filter on columns of their own
+(is_somatic_<patient>, civic_gene_abbreviations, ...) and users on any.
+
+An index is only suggested if SQLite would use it for the query: it is
+tried in an empty, in-memory copy of the schema of the database.
+
+With the index_advisor section of gemini-config.yaml, the indexes suggested
+for the queries GeminiQuery runs are counted in the table index_advice of
+the database and, with auto_index, created once suggested that many times::
+
+    index_advisor:
+      record: true
+      auto_index: 5
+"""
+from __future__ import absolute_import, print_function
+
+import collections
+import re
+import sqlite3
+import sys
+
+import sqlalchemy as sql
+
+from . import database
+
+ADVISOR_PROFILE = dict(
+    record=False,    # count the indexes suggested for the queries run
+    auto_index=0,    # create an index once suggested this many times (0: never)
+)
+
+# the most columns a covering index is suggested with
+COVERING_MAX_COLUMNS = 6
+
+_profile = None
+
+
+def get_profile():
+    """ ADVISOR_PROFILE updated with the index_advisor section of the config file """
+    global _profile
+    if _profile is None:
+        from .config import read_config_section
+        _profile = read_config_section("index_advisor", ADVISOR_PROFILE)
+    return _profile
+
+
+PlanStep = collections.namedtuple("PlanStep", "id parent detail")
+
+
+class Index(collections.namedtuple("Index", "name table columns where")):
+    __slots__ = ()
+
+    @property
+    def statement(self):
+        """
+        >>> Index("var_gene_idx", "variants", ["gene"], None).statement
+        'CREATE INDEX IF NOT EXISTS var_gene_idx ON variants ("gene")'
+        """
+        s = "CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (
+            self.name, self.table, ", ".join('"%s"' % c for c in self.columns))
+        if self.where:
+            s += " WHERE " + self.where
+        return s
+
+
+Advice = collections.namedtuple("Advice", "plan scans indexes")
+
+
+def query_plan(cursor, query):
+    """ the steps of the EXPLAIN QUERY PLAN of `query` """
+    return [PlanStep(r[0], r[1], r[-1])
+            for r in cursor.execute("EXPLAIN QUERY PLAN " + query).fetchall()]
+
+
+def format_plan(plan, indent="  "):
+    """
+    the steps of a plan, one per line, indented by their depth.
+
+    >>> print(format_plan([PlanStep(2, 0, 'SCAN v'), PlanStep(7, 0, 'LIST SUBQUERY 1'),
+    ...                    PlanStep(9, 7, 'SCAN variants')]))
+    SCAN v
+    LIST SUBQUERY 1
+      SCAN variants
+    """
+    depth = {}
+    lines = []
+    for step in plan:
+        depth[step.id] = depth.get(step.parent, -1) + 1
+        lines.append(indent * depth[step.id] + step.detail)
+    return "\n".join(lines)
+
+
+_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?(.*)$")
+
+
+def full_scans(plan, names):
+    """
+    the tables that `plan` reads in full, without an index. `names` maps
+    the tables and their aliases in the query to the tables.
+
+    >>> full_scans([PlanStep(2, 0, 'SCAN v'),
+    ...             PlanStep(5, 0, 'SEARCH s USING INDEX sample_name_idx (name=?)'),
+    ...             PlanStep(9, 0, 'SCAN samples USING COVERING INDEX sample_name_idx')],
+    ...            {'v': 'variants', 's': 'samples', 'samples': 'samples'})
+    ['variants']
+    """
+    scans = []
+    for step in plan:
+        m = _SCAN.match(step.detail)
+        if m is None or "USING" in m.group(3):
+            continue
+        table = names.get(m.group(2) or m.group(1))
+        if table and table not in scans:
+            scans.append(table)
+    return scans
+
+
+# string literals (and double-quoted strings, which sqlite allows as such)
+_STRING = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"")
+
+_KEYWORDS = set("""select from where join inner left right full outer cross natural
+                   on using group order by limit offset union intersect except as
+                   and or not having""".split())
+
+
+def table_names(query, tables):
+    """
+    map the names and aliases of the `tables` that `query` reads to the tables.
+
+    >>> sorted(table_names("select v.chrom from variants v, samples as s where s.name = 'x'",
+    ...                    ['variants', 'samples', 'vcf_header']).items())
+    [('s', 'samples'), ('samples', 'samples'), ('v', 'variants'), ('variants', 'variants')]
+    """
+    query = _STRING.sub("?", query)
+    names = {}
+    for table in tables:
+        for m in re.finditer(r"\b%s\b(?!\.)(?:\s+(?:as\s+)?(\w+))?" % re.escape(table),
+                             query, re.I):
+            names[table] = table
+            alias = m.group(1)
+            if alias and alias.lower() not in _KEYWORDS:
+                names[alias] = table
+    return names
+
+
+_TERM = re.compile(r"(?<![\w.])(?:(\w+)\.)?([A-Za-z_]\w*)\s*"
+                   r"(==|=|<=|>=|<>|!=|<|>|\bis\s+not\s+null\b|\bis\s+not\b|\bis\b"
+                   r"|\bnot\s+in\b|\bin\b|\bbetween\b)\s*([-+]?\d+(?:\.\d+)?(?![\w.]))?",
+                   re.I)
+
+_OPS = {"=": "eq", "==": "eq", "is": "eq", "in": "eq",
+        "<": "range", ">": "range", "<=": "range", ">=": "range", "between": "range"}
+
+
+def predicates(query):
+    """
+    the (qualifier, column, kind, number) of the comparisons in `query`
+    that an index could serve. kind is eq, range or notnull and number the
+    numeric literal a column is compared to, if any.
+
+    >>> predicates("select * from variants v where v.is_somatic_B == 1 and gene = 'x' "
+    ...            "and start > 10 and impact != 'y' and cgi_gene_abbreviations is not null")
+    [('v', 'is_somatic_B', 'eq', '1'), (None, 'gene', 'eq', None), (None, 'start', 'range', '10'), (None, 'cgi_gene_abbreviations', 'notnull', None)]
+    """
+    terms = []
+    for qualifier, column, op, number in _TERM.findall(_STRING.sub("?", query)):
+        op = " ".join(op.lower().split())
+        kind = "notnull" if op == "is not null" else _OPS.get(op)
+        if kind is not None and column.lower() not in _KEYWORDS:
+            terms.append((qualifier or None, column, kind, number or None))
+    return terms
+
+
+def _columns(cursor, table):
+    """ (name, declared type, pk) of the columns of `table` """
+    return [(r[1], (r[2] or "").lower(), r[5])
+            for r in cursor.execute('PRAGMA table_info("%s")' % table).fetchall()]
+
+
+def _is_flag(column, ctype, number):
+    """ a boolean column compared to 0 or 1, e.g. is_somatic_<patient> == 1 """
+    return number in ("0", "1") and (ctype.startswith("bool") or
+                                     column.lower().startswith(("is_", "in_")))
+
+
+def _index_name(table, parts):
+    prefix = "var" if table == "variants" else table
+    return "_".join([prefix] + [re.sub(r"\W", "_", p) for p in parts] + ["idx"])
+
+
+def _candidates(cursor, query, table, names):
+    """
+    the indexes that could serve the comparisons of `query` on `table`, best
+    first: a partial index for a flag or a NOT NULL column, a covering index
+    if the query reads a few plain columns of the table, or an index of the
+    columns compared to a value (those of the equalities, then a range).
+    """
+    columns = _columns(cursor, table)
+    types = {c.lower(): (c, t) for c, t, _ in columns}
+    pk = [c for c, _, p in sorted(columns, key=lambda x: x[2]) if p] or [columns[0][0]]
+    # an INTEGER PRIMARY KEY is the rowid, which every index holds
+    rowid = pk[0] if len(pk) == 1 and types[pk[0].lower()][1] == "integer" else None
+
+    eq, rng, partial = [], [], None
+    for qualifier, column, kind, number in predicates(query):
+        if (qualifier and names.get(qualifier) != table) or column.lower() not in types:
+            continue
+        column, ctype = types[column.lower()]
+        if "blob" in ctype:
+            continue
+        if partial is None and kind == "notnull":
+            partial = (column, '"%s" IS NOT NULL' % column, [column, "notnull"])
+        elif partial is None and kind == "eq" and _is_flag(column, ctype, number):
+            partial = (column, '"%s" == %s' % (column, number), [column, number])
+        elif kind == "eq" and column not in eq:
+            eq.append(column)
+        elif kind == "range" and column not in rng:
+            rng.append(column)
+    keys = [c for c in eq + rng[:1] if partial is None or c != partial[0]]
+
+    indexes = []
+    if partial is not None:
+        column, where, parts = partial
+        indexes.append(Index(_index_name(table, parts + keys), table, keys or pk, where))
+    if keys:
+        # the plain columns of the table the query reads
+        masked = _STRING.sub("?", query)
+        read = []
+        for qualifier, column in re.findall(r"(?<![\w.])(?:(\w+)\.)?([A-Za-z_]\w*)(?!\s*\()",
+                                            masked):
+            if (qualifier and names.get(qualifier) != table) or column.lower() not in types:
+                continue
+            column, ctype = types[column.lower()]
+            if column not in keys + read + [rowid]:
+                read.append(column)
+        star = re.search(r"(?<![\w.])(?:\w+\.)?\*", masked)
+        if star is None and all("blob" not in types[c.lower()][1] for c in read) \
+           and len(keys + read) <= COVERING_MAX_COLUMNS and read:
+            indexes.append(Index(_index_name(table, keys + ["cov"]), table, keys + read, None))
+        indexes.append(Index(_index_name(table, keys), table, keys, None))
+    return indexes
+
+
+def _schema_copy(cursor):
+    """ an empty in-memory database with the schema of that of `cursor` """
+    copy = sqlite3.connect(":memory:")
+    rows = cursor.execute("SELECT type, sql FROM sqlite_master WHERE sql IS NOT NULL "
+                          "AND name NOT LIKE 'sqlite_%'").fetchall()
+    order = {"table": 0, "index": 1, "view": 2}
+    for kind, statement in sorted(rows, key=lambda r: order.get(r[0], 3)):
+        if kind in order:
+            try:
+                copy.execute(statement)
+            except sqlite3.Error:
+                # e.g. a virtual table of a module we don't have
+                pass
+    return copy
+
+
+def advise(cursor, query):
+    """
+    the plan of `query` on the database of (DB-API) `cursor`, the tables it
+    scans in full and, for each of those, the first of its _candidates that
+    SQLite uses in an empty copy of the schema.
+    """
+    plan = query_plan(cursor, query)
+    tables = [r[0] for r in cursor.execute("SELECT name FROM sqlite_master "
+                                           "WHERE type = 'table'").fetchall()]
+    names = table_names(query, tables)
+    scans = full_scans(plan, names)
+
+    indexes = []
+    copy = None
+    for table in scans:
+        for index in _candidates(cursor, query, table, names):
+            if copy is None:
+                copy = _schema_copy(cursor)
+            try:
+                copy.execute(index.statement)
+                steps = query_plan(copy, query)
+            except sqlite3.Error:
+                continue
+            finally:
+                copy.execute("DROP INDEX IF EXISTS %s" % index.name)
+            if table not in full_scans(steps, names) and \
+               any(index.name in s.detail for s in steps):
+                indexes.append(index)
+                break
+    if copy is not None:
+        copy.close()
+    return Advice(plan, scans, indexes)
+
+
+def create(db, statements):
+    """ run the CREATE INDEX `statements` on `db` """
+    with database.database_transaction(db) as conn:
+        for statement in statements:
+            conn.execute(statement)
+
+
+def recorded(db):
+    """ the (statement, uses) recorded for `db`, most used first """
+    conn, metadata = database.get_session_metadata(db, read_only=True)
+    try:
+        if "index_advice" not in metadata.tables:
+            return []
+        return [tuple(r) for r in conn.execute(sql.text(
+            "SELECT statement, uses FROM index_advice ORDER BY uses DESC, statement"))]
+    finally:
+        conn.close()
+
+
+_warned = False
+
+
+def record(db, query):
+    """
+    count the indexes suggested for `query` in the table index_advice of
+    `db` and create those suggested auto_index times, if the index_advisor
+    section of the config says so.
+    """
+    global _warned
+    profile = get_profile()
+    # the workers of parallel.imap each run the query for a range of variants
+    if not profile["record"] or database._variant_range is not None:
+        return
+    session, _ = database.get_session_metadata(db)
+    try:
+        conn = session.connection().connection
+        cursor = conn.cursor()
+        # rather than wait for the locks of other users, skip the query
+        cursor.execute("PRAGMA busy_timeout = 0")
+        advice = advise(cursor, query)
+        if not advice.indexes:
+            return
+        cursor.execute("CREATE TABLE IF NOT EXISTS index_advice "
+                       "(statement TEXT PRIMARY KEY, uses INTEGER)")
+        for index in advice.indexes:
+            cursor.execute("INSERT OR IGNORE INTO index_advice VALUES (?, 0)",
+                           (index.statement,))
+            cursor.execute("UPDATE index_advice SET uses = uses + 1 WHERE statement = ?",
+                           (index.statement,))
+            uses = cursor.execute("SELECT uses FROM index_advice WHERE statement = ?",
+                                  (index.statement,)).fetchone()[0]
+            if profile["auto_index"] and uses >= profile["auto_index"]:
+                cursor.execute(index.statement)
+                sys.stderr.write("index advisor: created index %s, suggested %d times\n"
+                                 % (index.name, uses))
+        conn.commit()
+    except (sqlite3.Error, sql.exc.SQLAlchemyError) as e:
+        if not _warned:
+            sys.stderr.write("index advisor: can't record the indexes for the queries: %s\n" % e)
+            _warned = True
+    finally:
+        session.close()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+Split a scan of the variants table across worker processes (--cores).
+
+The variant_ids are cut into ranges and each range is handed to a forked
+worker whose read-only connections only see the variants of that range: a
+TEMP view named variants shadows the table (see database.restrict_variants),
+so the query of a command runs unchanged, whatever its joins, --region or
+--gt-filter. The results of the ranges are put back together in variant_id
+order. imap_chunks() runs a command over chunks of its own instead (e.g. the
+chromosomes of dump --genotypes).
+"""
+from __future__ import absolute_import
+
+import multiprocessing
+import re
+
+import sqlalchemy as sql
+
+from . import database
+
+# ranges per worker, so that workers that are done early take on more
+RANGES_PER_CORE = 8
+
+# queries whose result isn't the concatenation of their results per range
+_UNSPLITTABLE = re.compile(r"\b(order\s+by|group\s+by|limit|distinct|union|intersect|except)\b"
+                           r"|\b(count|sum|avg|min|max|total|group_concat)\s*\("
+                           r"|\bover\s*\(", re.I)
+
+
+def can_split(query):
+    """
+    whether the rows of `query` are those of the variants found range by
+    range. queries of other tables, sorted, grouped, aggregated or window
+    function ones are run in a single process.
+
+    >>> can_split("select chrom, start from variants where gene = 'TP53'")
+    True
+    >>> can_split("select gene, count(*) from variants group by gene")
+    False
+    >>> can_split("select * from samples")
+    False
+    >>> can_split("select chrom, row_number() over (partition by chrom) from variants")
+    False
+    """
+    return bool(re.search(r"\bvariants\b", query, re.I)) and \
+        not _UNSPLITTABLE.search(query)
+
+
+def variant_ranges(db, n):
+    """
+    up to `n` [lo, hi) ranges of the variant_ids of `db`, of equal width.
+    """
+    conn, _ = database.get_session_metadata(db, read_only=True)
+    try:
+        lo, hi = conn.execute(sql.text("SELECT min(variant_id), max(variant_id) "
+                                       "FROM variants")).fetchone()
+    finally:
+        conn.close()
+    if lo is None:
+        return []
+    hi += 1
+    n = min(n, hi - lo)
+    bounds = [lo + (hi - lo) * i // n for i in range(n)] + [hi]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+# what the workers run, set before they are forked
+_work = None
+
+
+def _run_chunk(chunk):
+    return list(_work(chunk))
+
+
+def _run_range(work):
+    def run(bounds):
+        database.restrict_variants(*bounds)
+        return work()
+    return run
+
+
+def imap_chunks(cores, work, chunks, header=False):
+    """
+    yield what the generator function work(chunk) yields for each of
+    `chunks`, in order. with cores > 1, the chunks are run by a pool of
+    `cores` forked processes; otherwise (or if there is no fork) one after
+    the other, here. with `header`, the first item work() yields is the
+    same for every chunk and is only yielded once.
+    """
+    chunks = list(chunks)
+    if cores < 2 or len(chunks) < 2 or "fork" not in multiprocessing.get_all_start_methods():
+        for i, chunk in enumerate(chunks):
+            for j, item in enumerate(work(chunk)):
+                if not (header and i and j == 0):
+                    yield item
+        return
+
+    global _work
+    _work = work
+    pool = multiprocessing.get_context("fork").Pool(cores)
+    try:
+        for i, items in enumerate(pool.imap(_run_chunk, chunks)):
+            for item in items[1 if header and i else 0:]:
+                yield item
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _work = None
+
+
+def imap(db, cores, work, header=False):
+    """
+    yield what the generator function work() yields for the variants of
+    `db`. with cores > 1, work() is run for each range of variants by a
+    pool of `cores` forked processes and yields what it yields for the
+    range; otherwise (or if there is no fork) it's run once, here. with
+    `header`, the first item work() yields is the same for every range
+    (e.g. the header of the output) and is only yielded once.
+    """
+    ranges = []
+    if cores > 1 and "fork" in multiprocessing.get_all_start_methods():
+        ranges = variant_ranges(db, cores * RANGES_PER_CORE)
+    if len(ranges) < 2:
+        for item in work():
+            yield item
+        return
+    for item in imap_chunks(cores, _run_range(work), ranges, header=header):
+        yield item
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""
+TPED and PLINK binary (.bed/.bim/.fam) output of query results (query
+--format tped [--plink PREFIX]).
+
+The calls of all samples of a variant are coded at once from gt_types as
+one of the pairs of its two alleles a0 (the ref) and a1 (the alt):
+
+    0  missing        1  a0 a0        2  a0 a1
+    3  a1 a1          4  a1 a0 (e.g. a phased het with the alt first)
+
+The sex rules of TPED (no Y calls for females, no hets outside the PARs
+for males on X and Y) are applied as masks of the samples that are
+computed once per chromosome. Only the calls gt_types doesn't describe,
+haploid calls and calls of one allele (e.g. A/.), and multi-allelic
+variants are taken from gts one sample at a time.
+"""
+from __future__ import absolute_import
+
+import re
+
+import numpy as np
+import sqlalchemy as sql
+
+from . import database
+from .gemini_constants import BUFFER_SIZE, HET, HOM_ALT, HOM_REF, UNKNOWN
+
+VALID_CHROMOSOMES = set(list(map(str, range(1, 23))) + ["X", "Y", "XY", "MT"])
+POSSIBLE_HAPLOID = ("X", "Y")
+PAR_REGIONS = {"X": [(60001, 2699520), (154931044, 155260560)],
+               "Y": [(10001, 2649520), (59034050, 59363566)]}
+NULL_GENOTYPES = ["."]
+PED_MISSING = ["0", "0"]
+
+# code by gt_type
+TYPE_CODES = np.zeros(4, dtype=np.uint8)
+TYPE_CODES[[HOM_REF, HET, UNKNOWN, HOM_ALT]] = [1, 2, 0, 3]
+
+# .bed bits by code, with a1 as PLINK's allele 1 and a0 as allele 2
+BED_BITS = np.array([0b01, 0b11, 0b10, 0b00, 0b10], dtype=np.uint8)
+BED_MAGIC = b"\x6c\x1b\x01"
+
+_splitter = re.compile(r"\||/")
+
+
+def tped_chrom(chrom):
+    """
+    >>> tped_chrom('chrX'), tped_chrom('10'), tped_chrom('chrUn_gl000220')
+    ('X', '10', '0')
+    """
+    chrom = chrom[3:] if chrom.startswith("chr") else chrom
+    return chrom if chrom in VALID_CHROMOSOMES else "0"
+
+
+def in_par(chrom, start):
+    return any(s < start < e for s, e in PAR_REGIONS.get(chrom, ()))
+
+
+def fix_genotype(chrom, start, genotype, sex):
+    """
+    the TPED format has to have both alleles set, even if it is haploid.
+    this fixes that setting Y calls on the female to missing,
+    heterozygotic calls on the male non PAR regions to missing and haploid
+    calls on non-PAR regions to be the haploid call for both alleles
+
+    >>> fix_genotype('X', 5000000, ['A'], '1'), fix_genotype('1', 100, ['A'], '1')
+    (['A', 'A'], ['0', '0'])
+    >>> fix_genotype('X', 5000000, ['A', 'C'], '1'), fix_genotype('X', 5000000, ['A', '.'], '1')
+    (['0', '0'], ['A', 'A'])
+    """
+    haploid = len(genotype) < 2
+    missing = any(allele in NULL_GENOTYPES for allele in genotype)
+    if sex == "2":
+        # set female Y calls and haploid calls to missing
+        if haploid or chrom == "Y" or missing:
+            return PED_MISSING
+        return genotype
+    if chrom in POSSIBLE_HAPLOID and sex == "1":
+        # remove the missing genotype calls
+        genotype = [x for x in genotype if x not in NULL_GENOTYPES]
+        # if all genotypes are missing skip
+        if not genotype:
+            return PED_MISSING
+        # heterozygote males in non PAR regions are a mistake
+        if len(genotype) == 2 and genotype[0] != genotype[1] and not in_par(chrom, start):
+            return PED_MISSING
+        # set haploid males to be homozygous for the allele
+        if len(genotype) < 2:
+            return [genotype[0], genotype[0]]
+
+    # if a genotype is missing or is haploid set it to missing
+    if missing or haploid:
+        return PED_MISSING
+    return genotype
+
+
+class Genotypes(object):
+    """
+    codes the calls of variants for samples of the given sexes ('1' male,
+    '2' female, anything else unknown), in the order of the gt arrays.
+    """
+
+    def __init__(self, sexes):
+        self.sexes = [str(s) for s in sexes]
+        sexes = np.array(self.sexes, dtype=object)
+        self.female = sexes == "2"
+        self.male = sexes == "1"
+        self._masks = {}
+
+    def masks(self, chrom):
+        """
+        the samples whose calls on `chrom` are missing and those whose
+        hets are missing outside the PARs.
+        """
+        if chrom not in self._masks:
+            none = np.zeros(len(self.sexes), dtype=bool)
+            self._masks[chrom] = (self.female if chrom == "Y" else none,
+                                  self.male if chrom in POSSIBLE_HAPLOID else none)
+        return self._masks[chrom]
+
+    def has_alleles(self, gts, alts):
+        """ whether the gts of a variant call between 1 and 2 alleles """
+        if len(alts) > 1:
+            alleles = set(a for g in gts.tolist() for a in _splitter.split(g))
+            return 0 < len(alleles.difference(NULL_GENOTYPES)) <= 2
+        return bool((np.char.strip(gts, "./|") != "").any())
+
+    def code(self, chrom, start, ref, alt, gt_types, gts):
+        """
+        the two alleles (a0, a1) of a variant on the TPED `chrom` and the
+        code of each sample's call (see the module docstring).
+        """
+        alts = alt.split(",") if alt else []
+        if len(alts) > 1:
+            return self._code_alleles(chrom, start, ref, alts, gts)
+        codes = TYPE_CODES[gt_types]
+        het = codes == 2
+        if het.any():
+            ref_first = (np.char.startswith(gts, ref + "/") |
+                         np.char.startswith(gts, ref + "|"))
+            codes[het & ~ref_first] = 4
+        missing, haploid = self.masks(chrom)
+        codes[missing] = 0
+        if not in_par(chrom, start):
+            codes[haploid & ((codes == 2) | (codes == 4))] = 0
+        # haploid calls and calls of one allele
+        diploid = (np.char.find(gts, "/") >= 0) | (np.char.find(gts, "|") >= 0)
+        partial = (np.char.find(gts, ".") >= 0) & (np.char.strip(gts, "./|") != "")
+        alleles = [ref, alts[0] if alts else "."]
+        for i in np.flatnonzero(~diploid | partial).tolist():
+            codes[i] = self._pair_code(chrom, start, gts[i], i, alleles)
+        return alleles, codes
+
+    def _pair_code(self, chrom, start, gt, i, alleles):
+        pair = fix_genotype(chrom, start, _splitter.split(str(gt)), self.sexes[i])
+        if pair == PED_MISSING:
+            return 0
+        a, b = (alleles.index(x) if x in alleles else 0 for x in pair)
+        return {(0, 0): 1, (0, 1): 2, (1, 1): 3, (1, 0): 4}[(a, b)]
+
+    def _code_alleles(self, chrom, start, ref, alts, gts):
+        gts = gts.tolist()
+        called = set(a for g in gts for a in _splitter.split(g))
+        alleles = [a for a in [ref] + alts if a in called]
+        alleles += [a for a in [ref] + alts if a not in alleles]
+        alleles = alleles[:2]
+        codes = np.array([self._pair_code(chrom, start, g, i, alleles)
+                          for i, g in enumerate(gts)], dtype=np.uint8)
+        return alleles, codes
+
+
+def tped_genotypes(alleles, codes):
+    """
+    >>> tped_genotypes(['C', 'T'], np.array([0, 1, 2, 3, 4], dtype=np.uint8))
+    '0 0 C C C T T T T C'
+    """
+    a0, a1 = alleles
+    pairs = np.array(["0 0", a0 + " " + a0, a0 + " " + a1, a1 + " " + a1, a1 + " " + a0],
+                     dtype=object)
+    return " ".join(pairs[codes].tolist())
+
+
+def bed_bytes(codes):
+    """
+    the .bed (SNP-major) bytes of a variant: 2 bits per sample, the first
+    sample in the lowest bits.
+
+    >>> bed_bytes(np.array([0, 1, 2, 3, 4], dtype=np.uint8))
+    b'-\\x02'
+    """
+    bits = BED_BITS[codes]
+    pad = -len(bits) % 4
+    if pad:
+        # PLINK ignores the bits after the last sample
+        bits = np.concatenate([bits, np.zeros(pad, dtype=np.uint8)])
+    bits = bits.reshape(-1, 4)
+    return (bits[:, 0] | (bits[:, 1] << 2) | (bits[:, 2] << 4) | (bits[:, 3] << 6)).tobytes()
+
+
+def blocks(gq, formatter, size=BUFFER_SIZE):
+    """
+    the (.bim lines, .bed bytes) of the rows of `gq`, a GeminiQuery run
+    with the TPEDRowFormat `formatter`, `size` variants at a time.
+    """
+    bim, bed = [], []
+    for row in gq:
+        chrom, alleles, codes = formatter.code(row)
+        bim.append(formatter.bim(row, chrom, alleles) + "\n")
+        bed.append(bed_bytes(codes))
+        if len(bim) == size:
+            yield "".join(bim), b"".join(bed)
+            bim, bed = [], []
+    if bim:
+        yield "".join(bim), b"".join(bed)
+
+
+def fam_line(sample):
+    """
+    a sample's line of the .fam file, from its family_id, name,
+    paternal_id, maternal_id, sex and phenotype. unknown values are 0 (-9
+    for the phenotype).
+
+    >>> fam_line(('1', 'M10475', None, '0', '1', None))
+    '1 M10475 0 0 1 -9'
+    """
+    missing = ["0", None, "0", "0", "0", "-9"]
+    return " ".join(str(m if v is None else v) for v, m in zip(sample, missing))
+
+
+class BedWriter(object):
+    """ writes the .bed, .bim and .fam files of the PLINK fileset `prefix` of `db` """
+
+    def __init__(self, prefix, db):
+        conn, metadata = database.get_session_metadata(db, read_only=True)
+        try:
+            samples = conn.execute(sql.text(
+                "SELECT family_id, name, paternal_id, maternal_id, sex, phenotype "
+                "FROM samples ORDER BY sample_id")).fetchall()
+        finally:
+            conn.close()
+        with open(prefix + ".fam", "w") as fam:
+            for sample in samples:
+                fam.write(fam_line(sample) + "\n")
+        self.bed = open(prefix + ".bed", "wb")
+        self.bed.write(BED_MAGIC)
+        self.bim = open(prefix + ".bim", "w")
+
+    def write(self, block):
+        """ write a (.bim lines, .bed bytes) block of variants """
+        bim, bed = block
+        self.bim.write(bim)
+        self.bed.write(bed)
+
+    def close(self):
+        self.bed.close()
+        self.bim.close()
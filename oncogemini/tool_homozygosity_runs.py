@@ -4,6 +4,7 @@ import sys
 from collections import defaultdict
 from .gemini_constants import *
 from . import GeminiQuery
+from . import parallel
 
 class Site(object):
     def __init__(self, row):
@@ -65,7 +66,10 @@ def sweep_genotypes_for_rohs(args, chrom, samples):
     Note: If the genotype was homozygous, the end position
           of the variant is stored.  Otherwise 'H' for het
           and 'U' for unknown.
+
+    Returns the lines of the ROHs that are found.
     """
+    lines = []
     hom_count = 0
     het_count = 0
     unk_count = 0
@@ -112,7 +116,7 @@ def sweep_genotypes_for_rohs(args, chrom, samples):
                 # report the run if it is long enough.
                 if run_length >= args.min_size:
                     density_per_kb = float(len(curr_run) * 1000) / float(run_length)
-                    print("\t".join(str(s) for s in [chrom,
+                    lines.append("\t".join(str(s) for s in [chrom,
                         run_start, run_end, sample,
                         hom_count, round(density_per_kb, 4),
                         run_length]))
@@ -121,51 +125,27 @@ def sweep_genotypes_for_rohs(args, chrom, samples):
                 hom_count = 0
                 het_count = 0
                 unk_count = 0
+    return lines
 
 
-
-def get_homozygosity_runs(args):
-
+def _chrom_rohs(args, sm_index, chrom=None):
+    """
+    the lines of the ROHs of the variants (on `chrom`) of args.db, a
+    chromosome at a time.
+    """
     gq = GeminiQuery.GeminiQuery(args.db)
-
-    # get a mapping of sample ids to sample indices
     idx2smp = gq.index2sample
-    smp2idx = gq.sample2index
-    sm_index = []
-
-    # prepare a lookup of just the samples
-    # for which the user wishes to search for ROHs
-    if args.samples is not None:
-        sample_filter = args.samples.strip().split(",")
-        for sample in sample_filter:
-            try:
-                idx = smp2idx[sample]
-            except:
-                raise ValueError("Sample %s could not be found.\n" \
-                    % (sample))
-            sm_index.append(smp2idx[sample])
-    else:
-        for sample in smp2idx:
-            sm_index.append(smp2idx[sample])
 
-    ###########################################################################
-    # Phase 1. Retrieve the variants for each chrom/sample
-    ###########################################################################
     query  = "SELECT chrom, start, end, gt_types, gt_depths \
               FROM variants \
               WHERE type = 'snp' \
               AND   filter is NULL \
-              AND   depth >= " + str(args.min_total_depth) + \
-              " ORDER BY chrom, end"
-
-    sys.stderr.write("LOG: Querying and ordering variants by chromosomal position.\n")
+              AND   depth >= " + str(args.min_total_depth)
+    if chrom is not None:
+        query += " AND chrom = '%s'" % chrom.replace("'", "''")
+    query += " ORDER BY chrom, end"
     gq.run(query, needs_genotypes=True)
 
-    print("\t".join(['chrom',
-        'start', 'end', 'sample',
-        'num_of_snps','density_per_kb',
-        'run_length_in_bp']))
-
     variants_seen = 0
     samples = defaultdict(list)
     prev_chrom = None
@@ -182,7 +162,8 @@ def get_homozygosity_runs(args):
 
         # the chromosome has changed. search for ROHs in the previous chrom
         if curr_chrom != prev_chrom and prev_chrom is not None:
-            sweep_genotypes_for_rohs(args, prev_chrom, samples)
+            for line in sweep_genotypes_for_rohs(args, prev_chrom, samples):
+                yield line
             samples = defaultdict(list)
 
         # associate the genotype for the variant with each sample
@@ -205,7 +186,55 @@ def get_homozygosity_runs(args):
         prev_chrom = curr_chrom
 
     # search for ROHs in the final chromosome
-    sweep_genotypes_for_rohs(args, curr_chrom, samples)
+    for line in sweep_genotypes_for_rohs(args, curr_chrom, samples):
+        yield line
+
+
+def get_homozygosity_runs(args):
+
+    gq = GeminiQuery.GeminiQuery(args.db)
+
+    # get a mapping of sample ids to sample indices
+    idx2smp = gq.index2sample
+    smp2idx = gq.sample2index
+    sm_index = []
+
+    # prepare a lookup of just the samples
+    # for which the user wishes to search for ROHs
+    if args.samples is not None:
+        sample_filter = args.samples.strip().split(",")
+        for sample in sample_filter:
+            try:
+                idx = smp2idx[sample]
+            except:
+                raise ValueError("Sample %s could not be found.\n" \
+                    % (sample))
+            sm_index.append(smp2idx[sample])
+    else:
+        for sample in smp2idx:
+            sm_index.append(smp2idx[sample])
+
+    ###########################################################################
+    # Phase 1. Retrieve the variants for each chrom/sample
+    ###########################################################################
+    sys.stderr.write("LOG: Querying and ordering variants by chromosomal position.\n")
+
+    print("\t".join(['chrom',
+        'start', 'end', 'sample',
+        'num_of_snps','density_per_kb',
+        'run_length_in_bp']))
+
+    # runs don't span chromosomes, so with --cores each chromosome is
+    # searched by a separate process.
+    chroms = [None]
+    if args.cores > 1:
+        gq.run("SELECT DISTINCT chrom FROM variants ORDER BY chrom")
+        chroms = [row['chrom'] for row in gq]
+
+    for line in parallel.imap_chunks(args.cores,
+                                     lambda chrom: _chrom_rohs(args, sm_index, chrom),
+                                     chroms):
+        print(line)
 
 
 def run(parser, args):
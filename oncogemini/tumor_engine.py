@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+"""
+Shared machinery of the tumor evolution tools (truncal, loh, bottleneck and
+unique).
+
+The variants of a query are read in chunks and the alt allele frequencies,
+depths and genotype qualities of the patient's samples are stacked into
+(variants x samples) matrices, so that each tool evaluates its criteria as
+numpy masks over a whole chunk instead of sample by sample in python. Only
+the variants that pass are formatted and printed.
+
+>>> afs = AlleleFreqs(np.array([[0.3, -1, 0.9], [0.0, 0.2, 0.6]], dtype=np.float32))
+>>> afs.valid().tolist()
+[[True, False, True], [True, True, True]]
+>>> afs.any(operator.gt, 0.3, np.array([True, True, False])).tolist()
+[False, False]
+>>> [afs.format(0, j) for j in range(3)]
+[['0.3'], ['-1.0'], ['0.9']]
+
+with purity, AFs are divided by the sample's purity (see utils.purityAF) and
+the raw AF is reported next to the corrected one:
+
+>>> afs = AlleleFreqs(np.array([[0.25, -1, 0.9]], dtype=np.float32), [0.5, 0.5, 0])
+>>> afs.values.tolist()
+[[0.5, -2.0, 0.8999999761581421]]
+>>> afs.format(0, 0), afs.format(0, 2)
+(['0.5', '0.25'], ['0.9', '0.9'])
+"""
+from __future__ import absolute_import, print_function
+
+import operator
+import sys
+
+import numpy as np
+
+from . import gemini_utils as utils
+from . import parallel
+from . import writer
+from .GeminiQuery import GeminiQuery
+
+# variants whose genotype values are held in memory at once
+CHUNK_SIZE = 5000
+
+
+def _scalar_type(dtype):
+    """
+    the type of python arithmetic on a single element of an array of `dtype`.
+    numpy < 2 promotes a float32 scalar to float64 when it meets a python
+    float, numpy >= 2 keeps float32; the matrices follow the same rules as
+    the per-sample code did so that thresholds select the same variants.
+    """
+    return type(dtype.type(1) / 1.0)
+
+
+def linregress(y, mask):
+    """
+    the slope, intercept and r of the least squares fit of each row's values
+    of y where mask is True against their position among them, i.e. what
+    scipy.stats.linregress(range(len(v)), v) gives for each row's values v,
+    for all rows at once. r is nan where the values are all the same and
+    all three are nan for rows with fewer than 2 values.
+
+    >>> y = np.array([[0.1, -1, 0.2, 0.4], [0.5, 0.5, -1, -1], [0.3, -1, -1, -1]])
+    >>> slope, intercept, r = linregress(y, y >= 0)
+    >>> np.round(slope, 6).tolist(), np.round(intercept, 6).tolist(), np.round(r, 6).tolist()
+    ([0.15, 0.0, nan], [0.083333, 0.5, nan], [0.981981, nan, nan])
+    """
+    # move each row's values to the front so that x is the column index
+    order = np.argsort(~mask, axis=1, kind='stable')
+    mask = np.take_along_axis(mask, order, axis=1)
+    y = np.where(mask, np.take_along_axis(y, order, axis=1), 0)
+    n = mask.sum(axis=1)
+    x = np.arange(y.shape[1], dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xmean = (n - 1) / 2.0
+        # numpy sums fewer than 8 values in order and more pairwise
+        ymean = np.where(n < 8, np.cumsum(y, axis=1)[:, -1], y.sum(axis=1)) / n
+        dx = np.where(mask, x - xmean[:, None], 0)
+        dy = np.where(mask, y - ymean[:, None], 0)
+        # the covariance matrix of each row, as numpy.cov(x, y, bias=1)
+        d = np.stack([dx, dy], axis=1)
+        cov = np.matmul(d, d.transpose(0, 2, 1)) * (1.0 / n)[:, None, None]
+        ssxm, ssxym, ssym = cov[:, 0, 0], cov[:, 0, 1], cov[:, 1, 1]
+        r = np.clip(ssxym / np.sqrt(ssxm * ssym), -1.0, 1.0)
+        flat = (ssxm == 0) | (ssym == 0)
+        r[flat] = np.where(ssxym[flat] == 0, np.nan, 0.0)
+        slope = ssxym / ssxm
+        intercept = ymean - slope * xmean
+    few = n < 2
+    slope[few] = intercept[few] = r[few] = np.nan
+    return slope, intercept, r
+
+
+def ordered_samples(timepoints, samples):
+    """ the samples in `samples`, in the order of their timepoints """
+    return [s for key in timepoints for s in timepoints[key] if s in samples]
+
+
+def column_mask(columns, names):
+    """ boolean mask of the `columns` that are in `names` """
+    return np.array([c in names for c in columns], dtype=bool)
+
+
+class AlleleFreqs(object):
+    """
+    the (purity corrected) alt allele frequencies of a chunk of variants.
+    `values` holds them as float64; thresholds are applied to each column in
+    the precision in which a single value of that column compares.
+    """
+
+    def __init__(self, raw, purity=None):
+        self.raw = raw
+        self.purity = purity
+        work = raw.astype(_scalar_type(raw.dtype))
+        self.values = work.astype(np.float64)
+        corrected = np.zeros(raw.shape[1], dtype=bool)
+        if purity is not None:
+            for j, p in enumerate(purity):
+                if p > 0:
+                    self.values[:, j] = np.minimum(work[:, j] / p, 1)
+                    corrected[j] = True
+        self._single = ~corrected & (work.dtype == np.float32)
+
+    def valid(self):
+        return self.values >= 0
+
+    def compare(self, op, threshold):
+        t = np.where(self._single, float(np.float32(threshold)), threshold)
+        return op(self.values, t)
+
+    def any(self, op, threshold, columns):
+        """ variants with a valid AF in `columns` for which op(AF, threshold) """
+        return (self.valid() & columns & self.compare(op, threshold)).any(axis=1)
+
+    def value(self, i, j):
+        """ the AF of variant i in column j as the per-sample code saw it """
+        if self.purity is None:
+            return self.raw[i, j]
+        return utils.purityAF(self.raw[i, j], self.purity[j])
+
+    def format(self, i, j):
+        if self.purity is None:
+            return [str(self.raw[i, j])]
+        return [str(self.value(i, j)), str(self.raw[i, j])]
+
+    def take(self, cols):
+        """ the AFs of the columns at `cols` """
+        afs = AlleleFreqs.__new__(AlleleFreqs)
+        afs.raw = self.raw[:, cols]
+        afs.values = self.values[:, cols]
+        afs.purity = None if self.purity is None else [self.purity[j] for j in cols]
+        afs._single = self._single[cols]
+        return afs
+
+
+class Chunk(object):
+    """
+    the genotype values of `samples` (indices into the gt arrays) for `rows`.
+    the values of any other `gt_cols` (e.g. gt_types) are in chunk.gt[col].
+    """
+
+    def __init__(self, rows, indices, purity=None, gt_cols=()):
+        self.rows = rows
+        self.afs = AlleleFreqs(self._stack('gt_alt_freqs', indices), purity)
+        self.depths = self._stack('gt_depths', indices)
+        self.quals = self._stack('gt_quals', indices)
+        self.gt = dict((col, self._stack(col, indices)) for col in gt_cols)
+        # per variant values a tool adds after the AFs of the passing variants
+        self.extra = {}
+
+    def _stack(self, col, indices):
+        return np.vstack([row.gt_subset(col, indices) for row in self.rows])
+
+    def take(self, cols):
+        """ the chunk restricted to the samples at `cols` (e.g. one patient's) """
+        chunk = Chunk.__new__(Chunk)
+        chunk.rows = self.rows
+        chunk.afs = self.afs.take(cols)
+        chunk.depths = self.depths[:, cols]
+        chunk.quals = self.quals[:, cols]
+        chunk.gt = dict((col, v[:, cols]) for col, v in self.gt.items())
+        chunk.extra = {}
+        return chunk
+
+    def well_covered(self, minDP, minGQ):
+        """ variants with every sample at or above minDP and minGQ """
+        return (self.depths >= minDP).all(axis=1) & (self.quals >= minGQ).all(axis=1)
+
+
+def iter_chunks(gq, samples, purity=None, chunk_size=CHUNK_SIZE, gt_cols=()):
+    indices = [gq.sample_to_idx[s] for s in samples]
+    if purity is not None:
+        purity = [purity[s] for s in samples]
+    rows = []
+    for row in gq:
+        rows.append(row)
+        if len(rows) == chunk_size:
+            yield Chunk(rows, indices, purity, gt_cols)
+            rows = []
+    if rows:
+        yield Chunk(rows, indices, purity, gt_cols)
+
+
+class PatientError(Exception):
+    """ a patient's samples don't allow running the tool """
+    pass
+
+
+def patient_samples(names, patient, samples, batch=False):
+    """
+    the samples of `patient` to use: all of them or those of `samples`.
+    with --all-patients, `samples` may name samples of several patients.
+    """
+    if samples == 'All':
+        return names[patient]
+    if batch:
+        found = [s for s in samples if s in names[patient]]
+        if not found:
+            raise PatientError("none of the specified samples belong to patient " + patient)
+        return found
+    return utils.get_samples(patient, names, samples)
+
+
+def patients_to_run(args, patient, patients, names, setup):
+    """
+    call setup(patient) for the patient given with --patient (or the only
+    one) or, with --all-patients, for each patient in turn. setup returns
+    the Report for the patient or raises a PatientError, which ends the
+    tool for a single patient and skips the patient with --all-patients.
+    """
+    if not args.all_patients:
+        try:
+            return [setup(utils.get_patient(patient, patients))]
+        except PatientError as e:
+            sys.exit(str(e))
+    if patient != 'none':
+        sys.exit("--patient and --all-patients can't be used together")
+    reports = []
+    for p in sorted(set(patients)):
+        try:
+            report = setup(p)
+        except PatientError as e:
+            sys.stderr.write("skipping patient %s: %s\n" % (p, e))
+            continue
+        report.path = "%s.%s.txt" % (args.prefix, p)
+        reports.append(report)
+    if not reports:
+        sys.exit("None of the patients could be processed")
+    return reports
+
+
+class Report(object):
+    """
+    what a tool does for one patient: the `samples` (in the order their
+    AFs are reported) and `select(chunk)`, the mask of the variants to
+    print given a chunk of those samples. only the AFs of the `report`
+    samples are printed (default: all) followed by what select put in
+    chunk.extra. with `somatic`, only variants with that column set to 1
+    (see set_somatic) are considered. `pushdown` is a condition that
+    selects (at least) the variants that may pass select, see
+    gemini_patient_stats.pushdown. the output goes to `path` or stdout.
+    """
+
+    def __init__(self, samples, select, report=None, extra_header=(),
+                 somatic=None, pushdown=None, path=None):
+        self.samples = samples
+        self.select = select
+        self.report = samples if report is None else report
+        self.extra_header = list(extra_header)
+        self.somatic = somatic
+        self.pushdown = pushdown
+        self.path = path
+
+
+def variant_query(args, cancers, is_somatic=None, hidden=(), pushdown=None):
+    """
+    the query of the variants the tool looks at. the `hidden` columns are
+    added to the select for the tool's use and stripped from the output by
+    run(). the `pushdown` condition is added to the where clause.
+    """
+    columns = args.columns
+    if args.columns is not None and cancers != 'none':
+        columns = args.columns + ",civic_gene_abbreviations,cgi_gene_abbreviations"
+    if columns is not None and hidden:
+        columns = columns + "," + ",".join(hidden)
+    if args.filter is not None:
+        filter = args.filter
+        if is_somatic is not None:
+            filter = args.filter + 'and ' + is_somatic + '==1'
+    else:
+        filter = str(1)
+        if is_somatic is not None:
+            filter = is_somatic + '==1'
+    if pushdown is not None:
+        filter = '(' + filter + ') and ' + pushdown
+    return utils.make_query(columns, filter)
+
+
+def query_variants(gq, args, cancers, reports):
+    """
+    run the query of the variants the reports look at on `gq` and return
+    the columns it added for them (see run) and the is_somatic column the
+    variants of each report are still to be checked against. the somatic
+    variants of a single patient are selected by the query; with several
+    patients their is_somatic_<patient> columns are added to the select
+    instead, unless all columns are selected anyway. the pushdown of a
+    single patient is added to the query.
+    """
+    if not args.all_patients:
+        gq.run(variant_query(args, cancers, reports[0].somatic,
+                             pushdown=reports[0].pushdown))
+        return [], [None]
+    hidden = []
+    if args.columns is not None:
+        hidden = [r.somatic for r in reports if r.somatic is not None]
+    gq.run(variant_query(args, cancers, hidden=hidden))
+    return hidden, [r.somatic for r in reports]
+
+
+def _in_cancers(row, cancers):
+    abbrevs = str(row['civic_gene_abbreviations']).split(',') + \
+        str(row['cgi_gene_abbreviations']).split(',')
+    return any(c in abbrevs for c in cancers)
+
+
+def _scan(args, reports, samples, purity, cancers, chunk_size):
+    """
+    query the variants of the reports and yield the columns of the query,
+    then the lines of each report for each chunk of variants.
+    """
+    gq = GeminiQuery(args.db, include_gt_cols=True)
+    hidden, somatic = query_variants(gq, args, cancers, reports)
+    strip = len(hidden) + (2 if cancers != 'none' else 0)
+    fmt = writer.LineFormatter()
+
+    def fields(values):
+        return values[:len(values)-strip] if strip else values
+
+    yield fields(gq.header.split('\t'))
+    for chunk in iter_chunks(gq, samples, purity, chunk_size):
+        lines = []
+        for report, is_somatic in zip(reports, somatic):
+            lines.append([])
+            patient = chunk.take(report.cols) if len(reports) > 1 else chunk
+            passed = report.select(patient)
+            if is_somatic is not None:
+                passed &= np.array([row[is_somatic] == 1 for row in chunk.rows], dtype=bool)
+            for i in np.flatnonzero(passed):
+                row = chunk.rows[i]
+                if cancers != 'none' and not _in_cancers(row, cancers):
+                    continue
+                extra = []
+                for j in report.report_cols:
+                    extra.extend(patient.afs.format(i, j))
+                extra.extend(patient.extra.get(i, ()))
+                lines[-1].append(fmt.line(fields(row.print_fields.values()), extra))
+        yield lines
+
+
+def run(args, reports, purity=None, cancers='none', chunk_size=CHUNK_SIZE):
+    """
+    evaluate the `reports` (one per patient) over the variants of the tool's
+    query (see variant_query), decoding the genotype values of each variant
+    once for all of them. with --cores, the variants are split across
+    processes.
+    """
+    samples = []
+    for report in reports:
+        samples.extend(s for s in report.samples if s not in samples)
+        report.cols = [samples.index(s) for s in report.samples]
+        report.report_cols = [report.samples.index(s) for s in report.report]
+
+    def scan():
+        return _scan(args, reports, samples, purity, cancers, chunk_size)
+
+    output = parallel.imap(args.db, args.cores, scan, header=True)
+    columns = next(output)
+    stdout = writer.BlockWriter(sys.stdout)
+    for report in reports:
+        report.out = writer.BlockWriter(open(report.path, "w")) if report.path else stdout
+        header = list(columns)
+        for s in report.report:
+            header.append('alt_AF.' + s)
+            if purity is not None:
+                header.append('raw.alt_AF.' + s)
+        header.extend(report.extra_header)
+        report.out.write('\t'.join(header))
+
+    for lines in output:
+        for report, report_lines in zip(reports, lines):
+            for line in report_lines:
+                report.out.write(line)
+
+    for report in reports:
+        report.out.flush()
+        if report.out.fh is not sys.stdout:
+            report.out.fh.close()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+VCF output of query results (query --format vcf).
+
+The genotype columns of a record are built for all samples of a variant at
+once from the gt arrays: GT from gt_types and gt_phases through a lookup
+table (the GTs of hets, of calls of one allele, e.g. 0/., and of
+multi-allelic variants are taken from gts), and the AD, DP, GQ and AF
+FORMAT fields from gt_ref_depths / gt_alt_depths, gt_depths, gt_quals and
+gt_alt_freqs, as far as the database has them. Negative (missing) values
+are written as '.'.
+
+With query --bgzip, the VCF is written BGZF compressed and indexed with
+tabix (through pysam) once it is written.
+"""
+from __future__ import absolute_import
+
+import re
+
+import numpy as np
+import sqlalchemy as sql
+
+from . import database
+from . import gemini_utils as util
+from .gemini_constants import HET, UNKNOWN
+
+COLUMNS = ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"]
+
+# FORMAT field: the gt columns it is made of
+FORMAT_COLUMNS = [("AD", ("gt_ref_depths", "gt_alt_depths")),
+                  ("DP", ("gt_depths",)),
+                  ("GQ", ("gt_quals",)),
+                  ("AF", ("gt_alt_freqs",))]
+
+FORMAT_HEADERS = {
+    "GT": '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+    "AD": '##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths for the ref and alt alleles">',
+    "DP": '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth">',
+    "GQ": '##FORMAT=<ID=GQ,Number=1,Type=Float,Description="Genotype Quality">',
+    "AF": '##FORMAT=<ID=AF,Number=A,Type=Float,Description="Alt allele frequency (gt_alt_freqs)">',
+}
+
+# GT by gt_type + 4 * phased
+GT_TABLE = np.array(["0/0", "0/1", "./.", "1/1", "0|0", "0|1", ".|.", "1|1"], dtype=object)
+
+
+def genotypes(gt_types, gt_phases):
+    """
+    the GT of each sample of a bi-allelic variant by its gt_type.
+
+    >>> genotypes(np.array([0, 1, 2, 3]), np.array([False, False, True, True]))
+    ['0/0', '0/1', '.|.', '1|1']
+    """
+    return GT_TABLE[gt_types.astype(np.intp) + 4 * gt_phases].tolist()
+
+
+def allele_genotypes(gts, gt_phases, ref, alts):
+    """
+    the GT of each sample of a (multi-allelic) variant from its gts.
+
+    >>> allele_genotypes(['A/G', 'C|G', './.'], [False, True, False], 'A', ['C', 'G'])
+    ['0/2', '1|2', './.']
+    """
+    index = dict((a, str(i)) for i, a in enumerate([ref] + list(alts)))
+    out = []
+    for gt, phased in zip(gts, gt_phases):
+        out.append(("|" if phased else "/").join(
+            index.get(a, ".") for a in re.split(r"[/|]", gt)))
+    return out
+
+
+def values(v):
+    """
+    the values of a gt array as strings, '.' for the negative (missing)
+    ones. floats are written with up to 7 significant digits (about the
+    precision of the float32 they are kept in).
+
+    >>> values(np.array([10, -1, 3], dtype=np.int32))
+    ['10', '.', '3']
+    >>> values(np.array([0.5, -1, 1 / 3.], dtype=np.float32))
+    ['0.5', '.', '0.3333333']
+    >>> values(np.array([99.0, -1], dtype=np.float32))
+    ['99', '.']
+    """
+    s = list(map("%.7g".__mod__ if v.dtype.kind == "f" else str, v.tolist()))
+    for i in np.flatnonzero(v < 0).tolist():
+        s[i] = "."
+    return s
+
+
+def _ad(ref, alt):
+    return ["." if r == a == "." else r + "," + a
+            for r, a in zip(values(ref), values(alt))]
+
+
+class RecordFormatter(object):
+    """
+    formats GeminiRows of the variants of `db` as VCF records, with the
+    FORMAT fields of the gt columns `db` has.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        conn, metadata = database.get_session_metadata(db, read_only=True)
+        try:
+            gt_cols = util.get_gt_cols(metadata)
+            self.vcf_header = None
+            if "vcf_header" in metadata.tables:
+                row = conn.execute(sql.text("SELECT vcf_header FROM vcf_header")).fetchone()
+                self.vcf_header = None if row is None else util.to_str(row[0])
+            self.samples = []
+            if "samples" in metadata.tables:
+                self.samples = [util.to_str(r[0]) for r in conn.execute(sql.text(
+                    "SELECT name FROM samples ORDER BY sample_id"))]
+        finally:
+            conn.close()
+        self.fields = [(f, cols) for f, cols in FORMAT_COLUMNS
+                       if all(c in gt_cols for c in cols)]
+        self.format = ":".join(["GT"] + [f for f, _ in self.fields])
+
+    def header(self):
+        """
+        the header of the database's VCF (if it kept it) for its samples,
+        with the FORMAT lines of the fields that are written.
+        """
+        lines = ["##fileformat=VCFv4.2"]
+        if self.vcf_header:
+            lines = [l for l in self.vcf_header.strip().splitlines() if l.startswith("##")]
+        declared = set(re.findall(r"^##FORMAT=<ID=([^,>]+)", "\n".join(lines), re.M))
+        lines.extend(FORMAT_HEADERS[f] for f in ["GT"] + [f for f, _ in self.fields]
+                     if f not in declared)
+        lines.append("\t".join(COLUMNS + self.samples))
+        return "\n".join(lines)
+
+    def sample_columns(self, row):
+        """ the FORMAT column values of each sample of `row` """
+        ref, alt = row['ref'], row['alt']
+        alts = alt.split(",") if alt else []
+        phases = row['gt_phases'].astype(bool)
+        if len(alts) > 1:
+            gts = row['gts'].tolist()
+            columns = [allele_genotypes(gts, phases, ref, alts)]
+        else:
+            gt_types = row['gt_types']
+            gt = genotypes(gt_types, phases)
+            # the gts of hets (0|1 or 1|0) and of calls of one allele only
+            # (e.g. 0/.) tell more than their gt_type
+            gts = row['gts'].tolist()
+            redo = [i for i, (t, g) in enumerate(zip(gt_types.tolist(), gts))
+                    if t == HET or (t != UNKNOWN and "." in g)]
+            if redo:
+                redone = allele_genotypes([gts[i] for i in redo], phases[redo], ref, alts)
+                for i, g in zip(redo, redone):
+                    gt[i] = g
+            columns = [gt]
+        for f, cols in self.fields:
+            if f in ("AD", "AF") and len(alts) > 1:
+                # only the depth / freq of all alt alleles together is kept
+                columns.append(["."] * len(phases))
+            elif f == "AD":
+                columns.append(_ad(row[cols[0]], row[cols[1]]))
+            else:
+                columns.append(values(row[cols[0]]))
+        return map(":".join, zip(*columns))
+
+    def record(self, row, info):
+        """ the VCF line of `row`, with its `info` string """
+        rec = [row['chrom'], row['start'] + 1,
+               '.' if row['vcf_id'] is None else row['vcf_id'],
+               row['ref'], row['alt'], row['qual'],
+               'PASS' if row['filter'] is None else row['filter'],
+               info, self.format]
+        rec = [str(c) if c is not None else "." for c in rec]
+        rec.extend(self.sample_columns(row))
+        return "\t".join(rec)
+
+
+class BgzfFile(object):
+    """
+    a text file written BGZF compressed to `path`, indexed with tabix when
+    it is closed: the VCF records must be sorted by chrom and position.
+    """
+
+    def __init__(self, path):
+        import pysam
+        if not path.endswith(".gz"):
+            raise ValueError("--bgzip %s: the file name must end in .gz" % path)
+        self.pysam = pysam
+        self.path = path
+        self.fh = pysam.BGZFile(path, "wb")
+
+    def write(self, text):
+        self.fh.write(text.encode(util.ENC))
+
+    def flush(self):
+        self.fh.flush()
+
+    def close(self):
+        self.fh.close()
+        try:
+            self.pysam.tabix_index(self.path, preset="vcf", force=True)
+        except OSError:
+            raise ValueError("%s was written but could not be indexed with tabix: "
+                             "are the variants sorted by chrom and start?" % self.path)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Buffered text output of rows for query and the tumor tools.
+
+LineFormatter turns the values of a row (e.g. GeminiRow.print_fields) into
+a tab separated line as str(PDict) does, with a converter per column that
+is looked up by the type of its value only when that changes, and lets a
+tool append its own columns (e.g. AFs) to the line without splitting it
+again. BlockWriter and blocks() put lines together so they are written in
+blocks of BLOCK_SIZE characters instead of one print() per row.
+"""
+from __future__ import absolute_import
+
+import numpy as np
+
+from .gemini_utils import ENC, to_str
+
+# characters of output written (or handed from a --cores worker) at once
+BLOCK_SIZE = 1 << 20
+
+
+def _bytes(v):
+    return v.decode(ENC)
+
+
+def strings(v):
+    """
+    the values of a genotype array as str() shows them.
+
+    >>> strings(np.array([0.5, 0.25], dtype=np.float32)), strings(np.array([1, 3]))
+    (['0.5', '0.25'], ['1', '3'])
+    """
+    kind = v.dtype.kind
+    if kind in "iubU" or v.dtype == np.float64:
+        # the python values print as the numpy scalars do
+        return list(map(str, v.tolist()))
+    if kind == "f":
+        return list(map(str, v))
+    return [str(to_str(x)) for x in v]
+
+
+def _array(v):
+    """
+    a genotype array as str(PDict) shows it: its values joined by commas.
+
+    >>> _array(np.array([0.5, 0.25], dtype=np.float32)), _array(np.array([1, 3]))
+    ('0.5,0.25', '1,3')
+    """
+    return ",".join(strings(v))
+
+
+_CONVERTERS = {str: None, bytes: _bytes, np.ndarray: _array}
+
+
+class LineFormatter(object):
+    """
+    formats the values of rows as tab separated lines.
+
+    >>> f = LineFormatter()
+    >>> f.line(['chr1', 10, None, np.array(['A/A', 'A/T'])], ['0.5'])
+    'chr1\\t10\\tNone\\tA/A,A/T\\t0.5'
+    >>> f.line(['chr2', None, 1.5, np.array(['T/T', 'A/T'])])
+    'chr2\\tNone\\t1.5\\tT/T,A/T'
+    """
+
+    def __init__(self):
+        self._types = []
+        self._converters = []
+
+    def _converter(self, j, value):
+        t = type(value)
+        if j == len(self._types):
+            self._types.append(None)
+            self._converters.append(None)
+        if self._types[j] is not t:
+            self._types[j] = t
+            self._converters[j] = _CONVERTERS.get(t, str)
+        return self._converters[j]
+
+    def line(self, values, extra=()):
+        """ the line of `values` followed by the (str) `extra` columns """
+        out = []
+        for j, v in enumerate(values):
+            convert = self._converter(j, v)
+            out.append(v if convert is None else convert(v))
+        out.extend(extra)
+        return "\t".join(out)
+
+
+class BlockWriter(object):
+    """ writes lines to `fh` in blocks of about `size` characters """
+
+    def __init__(self, fh, size=BLOCK_SIZE):
+        self.fh = fh
+        self.size = size
+        self._lines = []
+        self._n = 0
+
+    def write(self, line):
+        self._lines.append(line)
+        self._n += len(line) + 1
+        if self._n >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self._lines:
+            self._lines.append("")
+            self.fh.write("\n".join(self._lines))
+            self._lines = []
+            self._n = 0
+        self.fh.flush()
+
+
+def blocks(lines, size=BLOCK_SIZE):
+    """
+    the `lines` joined into blocks of about `size` characters, each line
+    ending with a newline.
+
+    >>> list(blocks(['a', 'b', 'c'], size=3))
+    ['a\\nb\\n', 'c\\n']
+    """
+    block, n = [], 0
+    for line in lines:
+        block.append(line)
+        n += len(line) + 1
+        if n >= size:
+            block.append("")
+            yield "\n".join(block)
+            block, n = [], 0
+    if block:
+        block.append("")
+        yield "\n".join(block)
@@ -19,7 +19,8 @@ setup(
         name="oncogemini",
         version=version,
         install_requires=install_requires,
-        requires=['python (>=2.5, <3.0)'],
+        requires=['python (>=3.4)'],
+        python_requires='>=3.4',
         packages=['oncogemini',
                   'oncogemini.scripts',
                   'oncogemini.tests',
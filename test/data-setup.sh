@@ -4,6 +4,8 @@ echo "##### creating oncogemini_test.db #####"
 vcf2db.py test.oncogemini.vcf oncogemini_test.manifest oncogemini_test.db 
 echo "##### creating somatic_tests_tool.db #####"
 cp oncogemini_test.db somatic_tests_tools.db
+echo "##### creating test.add_samples.db #####"
+vcf2db.py test.add-samples.vcf test.add-samples.ped test.add_samples.db
 echo "##### creating test.vep.extra.db #####"
 vcf2db.py test-vep-extra.vcf test-vep-extra.ped test.vep.extra.db 
 echo "##### creating test.eff.db #####"
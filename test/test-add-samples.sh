@@ -0,0 +1,75 @@
+check()
+{
+	if diff $1 $2; then
+    	echo ok
+	else
+    	echo fail
+	fi
+}
+export -f check
+
+# test.add_samples.db is test.oncogemini.vcf without the samples of patient D
+# and without the variant at 13:32912963
+cp test.add_samples.db test.add_samples.tmp.db
+oncogemini add-samples \
+    --vcf test.oncogemini.vcf \
+    --ped oncogemini_test.manifest \
+    test.add_samples.tmp.db 2> /dev/null
+
+####################################################################
+# 1. The variants already loaded get the genotypes of the new samples
+####################################################################
+echo "    add-samples.t01...\c"
+COLS="chrom, start, ref, alt, num_hom_ref, num_het, num_hom_alt, num_unknown, aaf, call_rate, gts, gt_types, gt_depths, gt_alt_freqs, gt_quals"
+oncogemini query -q "select $COLS from variants where start != 32912963 order by chrom, start" \
+    oncogemini_test.db > exp
+oncogemini query -q "select $COLS from variants where start != 32912963 order by chrom, start" \
+    test.add_samples.tmp.db > obs
+check obs exp
+
+####################################################################
+# 2. Variants that are not in the database are added, unknown for the
+#    samples that were already loaded
+####################################################################
+echo "    add-samples.t02...\c"
+echo "13	32912963	TGAAA	T	2	0	0	11	0.0	0.15384615384615385	2,2,2,2,2,2,2,2,2,2,2,0,0" > exp
+oncogemini query -q "select chrom, start, ref, alt, num_hom_ref, num_het, num_hom_alt, num_unknown, aaf, call_rate, gt_types from variants where start = 32912963" \
+    test.add_samples.tmp.db > obs
+check obs exp
+
+####################################################################
+# 3. The samples are added to the samples table
+####################################################################
+echo "    add-samples.t03...\c"
+oncogemini query -q "select * from samples" oncogemini_test.db > exp
+oncogemini query -q "select * from samples" test.add_samples.tmp.db > obs
+check obs exp
+
+####################################################################
+# 4. The new samples can be queried
+####################################################################
+echo "    add-samples.t04...\c"
+oncogemini query -q "select chrom, start from variants" --gt-filter "gt_types.D1 == HOM_REF" \
+    oncogemini_test.db > exp
+oncogemini query -q "select chrom, start from variants" --gt-filter "gt_types.D1 == HOM_REF" \
+    test.add_samples.tmp.db > obs
+check obs exp
+
+rm obs exp test.add_samples.tmp.db
+
+####################################################################
+# 5. Added variants get the defaults of the columns they don't set
+####################################################################
+echo "    add-samples.t05...\c"
+cp test.add_samples.db test.add_samples.tmp.db
+oncogemini set_somatic test.add_samples.tmp.db > /dev/null 2>&1
+oncogemini add-samples \
+    --vcf test.oncogemini.vcf \
+    --ped oncogemini_test.manifest \
+    test.add_samples.tmp.db 2> /dev/null
+echo "13	32912963	0	0" > exp
+oncogemini query -q "select chrom, start, is_somatic_B, is_somatic_C from variants where start = 32912963" \
+    test.add_samples.tmp.db > obs
+check obs exp
+
+rm obs exp test.add_samples.tmp.db
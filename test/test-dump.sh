@@ -19,3 +19,18 @@ echo "1 M10475 None None 1 1
 oncogemini dump --tfam test4.snpeff.ped.db > obs
 check obs exp
 rm obs exp
+
+####################################################################
+# 2. Test the genotypes dump, with depths and in the wide layout
+####################################################################
+echo "    dump.t02...\c"
+echo "chr10	48003991	48003992	C	T	snp	ts	0.5	None	M10475	T/T	28
+chr10	48003991	48003992	C	T	snp	ts	0.5	None	M10478	C/T	38
+chr10	48003991	48003992	C	T	snp	ts	0.5	None	M10500	C/T	44
+chr10	48003991	48003992	C	T	snp	ts	0.5	None	M128215	C/C	55
+chr10	48003991	48003992	C	T	snp	ts	0.5	None	T/T	C/T	C/T	C/C	28	38	44	55" > exp
+oncogemini dump --genotypes --gt-cols gt_depths test4.snpeff.ped.db | grep 48003991 > obs
+oncogemini dump --genotypes --gt-cols gt_depths --layout wide --cores 2 test4.snpeff.ped.db \
+    | grep 48003991 >> obs
+check obs exp
+rm obs exp
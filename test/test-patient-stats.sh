@@ -0,0 +1,64 @@
+check()
+{
+	if diff $1 $2; then
+    	echo ok
+	else
+    	echo fail
+	fi
+}
+export -f check
+
+cp oncogemini_test.db test.patient_stats.db
+oncogemini patient_stats test.patient_stats.db 2> /dev/null
+
+####################################################################
+# 1. The statistics of a patient's variants
+####################################################################
+echo "    patient_stats.t01...\c"
+oncogemini query -q "select v.chrom, v.start, s.normal_min_af, s.normal_max_af, s.tumor_min_af, s.tumor_max_af, s.min_dp from variants v, patient_variant_stats s where s.variant_id = v.variant_id and s.patient_id = 'B' order by v.chrom, v.start" \
+    test.patient_stats.db > obs
+echo "13	32912963	0.5072463768115942	0.5072463768115942	0.875	0.9866666666666667	48
+16	68842399	0.06172839506172839	0.06172839506172839	0.5633802816901409	1.0	22
+3	10089729	0.0	0.0	0.0058823529411764705	0.2676056338028169	124
+5	56168738	0.5581395348837209	0.5581395348837209	0.041666666666666664	1.0	24
+5	56183305	0.2	0.2	0.5428571428571428	1.0	25
+5	112176755	1.0	1.0	1.0	1.0	37
+6	152419919	0.0	0.0	0.38333333333333336	0.5526315789473685	60
+6	152419921	0.0	0.0	0.0	1.0	1
+9	102595635	0.0	0.0	0.0	0.35	53" > exp
+check obs exp
+
+####################################################################
+# 2. truncal, loh and unique select the same variants with them
+####################################################################
+echo "    patient_stats.t02...\c"
+for patient in B C; do
+    oncogemini truncal --patient $patient --maxNorm 0.1 oncogemini_test.db
+    oncogemini loh --patient $patient --minDP 5 oncogemini_test.db
+done > exp
+for patient in B C; do
+    oncogemini truncal --patient $patient --maxNorm 0.1 test.patient_stats.db
+    oncogemini loh --patient $patient --minDP 5 test.patient_stats.db
+done > obs
+check obs exp
+
+echo "    patient_stats.t03...\c"
+oncogemini unique --patient B --specific B1,B2 --maxOthers 0.2 oncogemini_test.db > exp
+oncogemini unique --patient C --specific C2 oncogemini_test.db >> exp
+oncogemini unique --patient B --specific B1,B2 --maxOthers 0.2 test.patient_stats.db > obs
+oncogemini unique --patient C --specific C2 test.patient_stats.db >> obs
+check obs exp
+
+####################################################################
+# 3. Out of date statistics are reported and not used
+####################################################################
+echo "    patient_stats.t04...\c"
+cp test.add_samples.db test.patient_stats.added.db
+oncogemini patient_stats test.patient_stats.added.db 2> /dev/null
+oncogemini add-samples --vcf test.oncogemini.vcf --ped oncogemini_test.manifest \
+    test.patient_stats.added.db 2> /dev/null
+echo "patient_variant_stats of test.patient_stats.added.db is out of date; re-run \`oncogemini patient_stats\`" > exp
+oncogemini truncal --patient B test.patient_stats.added.db 2> obs > /dev/null
+check obs exp
+
+rm obs exp test.patient_stats.db test.patient_stats.added.db
@@ -796,3 +796,180 @@ oncogemini query -q "select chrom, start, end, ref, alt, gene, gts.1094PC0018, g
                  --gt-filter "(gt_quals).(=HET).(>20).(all)" test.query.db > obs
 check obs exp
 rm obs exp
+
+####################################################################
+# 44. Test that the genotype index gives the same results
+####################################################################
+echo "    query.t44...\c"
+oncogemini query -q "select chrom, start, end, ref, alt, gene, gts.1094PC0018, gts.1094PC0019 \
+                 from variants" \
+             --gt-filter "gt_types.1094PC0018 == HET and gt_types.1094PC0019 == HOM_REF \
+                          and (gt_depths).(*).(>=0).(count>=10)" test.query.db > exp
+oncogemini gt_index --cols gt_types,gt_depths test.query.db 2> /dev/null
+oncogemini query -q "select chrom, start, end, ref, alt, gene, gts.1094PC0018, gts.1094PC0019 \
+                 from variants" \
+             --gt-filter "gt_types.1094PC0018 == HET and gt_types.1094PC0019 == HOM_REF \
+                          and (gt_depths).(*).(>=0).(count>=10)" \
+             --use-gt-index test.query.db > obs
+check obs exp
+rm obs exp
+rm -Rf test.query.db.gts
+
+####################################################################
+# 45. Test that migrating the genotype blobs gives the same results
+####################################################################
+echo "    query.t45...\c"
+oncogemini query -q "select chrom, start, end, gts.1094PC0018, gt_alt_freqs.1094PC0019 \
+                 from variants limit 20" \
+             --gt-filter "gt_types.1094PC0018 == HET" test.query.db > exp
+cp test.query.db test.migrated.db
+oncogemini migrate-blobs test.migrated.db 2> /dev/null
+oncogemini query -q "select chrom, start, end, gts.1094PC0018, gt_alt_freqs.1094PC0019 \
+                 from variants limit 20" \
+             --gt-filter "gt_types.1094PC0018 == HET" test.migrated.db > obs
+check obs exp
+rm obs exp test.migrated.db
+
+####################################################################
+# 46. Test that splitting the variants across processes gives the same results
+####################################################################
+echo "    query.t46...\c"
+oncogemini query -q "select chrom, start, end, ref, alt, gene, gts.1094PC0018, gts.1094PC0019 \
+                 from variants" \
+             --gt-filter "gt_types.1094PC0018 == HET" test.query.db > exp
+oncogemini query -q "select chrom, start, end, ref, alt, gene, gts.1094PC0018, gts.1094PC0019 \
+                 from variants" \
+             --gt-filter "gt_types.1094PC0018 == HET" \
+             --cores 3 test.query.db > obs
+check obs exp
+rm obs exp
+
+####################################################################
+# 47. Test that explain suggests an index for a full scan and creates it
+####################################################################
+echo "    query.t47...\c"
+echo '    CREATE INDEX IF NOT EXISTS var_gene_cov_idx ON variants ("gene", "chrom", "start");
+no full table scans' > exp
+cp oncogemini_test.db test.explain.db
+oncogemini explain -q "select chrom, start from variants where gene = 'ESR1'" \
+             --create-indexes test.explain.db | grep "CREATE INDEX" > obs
+oncogemini explain -q "select chrom, start from variants where gene = 'ESR1'" \
+             test.explain.db | grep "full table scans" >> obs
+check obs exp
+rm obs exp test.explain.db
+
+####################################################################
+# 48. Test that the genotype bitmaps give the same sample filter results
+####################################################################
+echo "    query.t48...\c"
+oncogemini query --sample-filter "phenotype=2" --in only all \
+             -q "select gts, gt_types from variants" test4.snpeff.ped.db > exp
+oncogemini query --min-kindreds 2 --family-wise --sample-filter "phenotype=2" --in all \
+             -q "select gts, gt_types from variants" test.family.db >> exp
+oncogemini gt_index test4.snpeff.ped.db 2> /dev/null
+oncogemini gt_index test.family.db 2> /dev/null
+oncogemini query --sample-filter "phenotype=2" --in only all \
+             -q "select gts, gt_types from variants" --use-gt-index test4.snpeff.ped.db > obs
+oncogemini query --min-kindreds 2 --family-wise --sample-filter "phenotype=2" --in all \
+             -q "select gts, gt_types from variants" --use-gt-index test.family.db >> obs
+check obs exp
+rm obs exp
+rm -Rf test4.snpeff.ped.db.gts test.family.db.gts
+
+####################################################################
+# 49. Test that the npz format holds the values of the text output
+####################################################################
+echo "    query.t49...\c"
+oncogemini query -q "select chrom, start, gene, gt_types, gt_depths.1094PC0019 from variants" \
+             --gt-filter "gt_types.1094PC0018 == HET" test.query.db > exp
+oncogemini query -q "select chrom, start, gene, gt_types, gt_depths.1094PC0019 from variants" \
+             --gt-filter "gt_types.1094PC0018 == HET" --format npz test.query.db > obs.npz
+python -c "
+import numpy as np
+z = np.load('obs.npz')
+for i in range(len(z['chrom'])):
+    gene = 'None' if 'gene.mask' in z.files and z['gene.mask'][i] else z['gene'][i]
+    print('\t'.join([z['chrom'][i], str(z['start'][i]), gene,
+                     ','.join(map(str, z['gt_types'][i])), str(z['gt_depths.1094PC0019'][i])]))
+" > obs
+check obs exp
+rm obs exp obs.npz
+
+####################################################################
+# 50. Test the FORMAT fields of a bgzipped, indexed VCF
+####################################################################
+echo "    query.t50...\c"
+oncogemini query -q "select chrom, start, gt_types.1094PC0018, gt_depths.1094PC0018 from variants" \
+             test.query.db > exp
+echo "obs.vcf.gz.tbi" >> exp
+oncogemini query -q "select chrom from variants" --format vcf --bgzip obs.vcf.gz test.query.db
+python -c "
+import gzip
+for line in gzip.open('obs.vcf.gz', 'rt'):
+    f = line.rstrip('\n').split('\t')
+    if line.startswith('#CHROM'):
+        i = f.index('1094PC0018')
+    elif not line.startswith('#'):
+        fmt = dict(zip(f[8].split(':'), f[i].split(':')))
+        gt = {'0/0': 0, '0/1': 1, '1/0': 1, './.': 2, '1/1': 3}[fmt['GT'].replace('|', '/')]
+        print('\t'.join([f[0], str(int(f[1]) - 1), str(gt), fmt['DP'].replace('.', '-1')]))
+" > obs
+ls obs.vcf.gz.tbi >> obs
+check obs exp
+rm obs exp obs.vcf.gz obs.vcf.gz.tbi
+
+####################################################################
+# 51. Test that a PLINK binary fileset holds the TPED calls
+####################################################################
+echo "    query.t51...\c"
+oncogemini query --format tped -q "select * from variants" test4.snpeff.ped.db > exp
+oncogemini query --format tped --plink obs -q "select * from variants" test4.snpeff.ped.db
+python -c "
+bim = [l.split() for l in open('obs.bim')]
+fam = [l.split() for l in open('obs.fam')]
+bed = open('obs.bed', 'rb').read()
+assert bed[:3] == b'\x6c\x1b\x01'
+n = (len(fam) + 3) // 4
+for i, (chrom, vid, cm, pos, a1, a2) in enumerate(bim):
+    calls = []
+    for j in range(len(fam)):
+        bits = (bed[3 + i * n + j // 4] >> (2 * (j % 4))) & 3
+        calls.append({0: a1 + ' ' + a1, 1: '0 0', 2: a2 + ' ' + a1, 3: a2 + ' ' + a2}[bits])
+    print(' '.join([chrom, vid, cm, pos] + calls))
+" > obs
+check obs exp
+rm obs exp obs.bed obs.bim obs.fam
+
+####################################################################
+# 52. Test in and not in with tuples of constants and strings
+####################################################################
+echo "    query.t52...\c"
+oncogemini query -q "select chrom, start, gts.1094PC0009 from variants" \
+             --gt-filter "(gt_types.1094PC0005 == HET or gt_types.1094PC0005 == HOM_ALT) \
+                          and not gts.1094PC0009 == 'C/C'" test.query.db > exp
+oncogemini query -q "select chrom, start, gts.1094PC0009 from variants" \
+             --gt-filter "gt_types.1094PC0005 in (HET, HOM_ALT) \
+                          and gts.1094PC0009 not in ('C/C',)" test.query.db > obs
+check obs exp
+oncogemini query -q "select chrom, start, gts.1094PC0009 from variants" \
+             --gt-filter "gt_types.1094PC0005 not in (HOM_REF, UNKNOWN) \
+                          and gts.1094PC0009 != 'C/C'" test.query.db > obs
+check obs exp
+echo "chr1	886816	C/CATTTT" > exp
+oncogemini query -q "select chrom, start, gts.1094PC0009 from variants" \
+             --gt-filter "gt_types.1094PC0005 != HOM_REF and 'CATTTT' in gts.1094PC0009" \
+             test.query.db > obs
+check obs exp
+rm obs exp
+
+####################################################################
+# 53. Test arithmetic on the genotype columns of two samples
+####################################################################
+echo "    query.t53...\c"
+echo "chr1	891400	72	70
+chr1	892236	49	62
+chr1	1158666	62	61" > exp
+oncogemini query -q "select chrom, start, gt_depths.1094PC0005, gt_depths.1094PC0009 from variants" \
+             --gt-filter "gt_depths.1094PC0005 + gt_depths.1094PC0009 > 100" test.query.db > obs
+check obs exp
+rm obs exp
@@ -123,3 +123,37 @@ echo "$(oncogemini truncal \
     oncogemini_test.db 2>&1 > /dev/null)" > obs
 check obs exp
 rm obs exp
+
+###################################################################
+# 5. Test --all-patients
+###################################################################
+printf "testing --all-patients...\n"
+printf "    truncal.all_patients...\n"
+oncogemini truncal \
+    --patient B \
+    --columns "chrom,start,end,ref,alt,gene" \
+    oncogemini_test.db > exp
+oncogemini truncal \
+    --all-patients \
+    --prefix test.truncal \
+    --columns "chrom,start,end,ref,alt,gene" \
+    oncogemini_test.db 2> /dev/null
+check test.truncal.B.txt exp
+rm exp test.truncal.*.txt
+
+###################################################################
+# 6. Test --cores
+###################################################################
+printf "testing --cores...\n"
+printf "    truncal.cores...\n"
+oncogemini truncal \
+    --patient B \
+    --columns "chrom,start,end,ref,alt,gene" \
+    oncogemini_test.db > exp
+oncogemini truncal \
+    --patient B \
+    --cores 2 \
+    --columns "chrom,start,end,ref,alt,gene" \
+    oncogemini_test.db > obs
+check obs exp
+rm obs exp